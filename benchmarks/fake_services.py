@@ -0,0 +1,368 @@
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Any, List, Tuple
+from urllib.parse import urlsplit, parse_qsl
+import hashlib
+import json
+import logging
+import random
+import re
+import threading
+import time
+import uuid
+
+from utils.cart_utils import format_price
+
+logger = logging.getLogger(__name__)
+
+Response = Tuple[int, Dict[str, Any]]
+
+
+class FakeMotlin:
+    """
+    This class answers Motlin API queries which are sent by bot, all objects are kept in memory.
+    Products, images and pizzerias are generated on init, carts, customers and flow entries are created by queries.
+    Only answers shape is emulated, so authorization, validation and filtering are the simplest.
+    """
+
+    def __init__(self, products_count: int = 40, pizzerias_count: int = 100,
+                 pizzeria_addresses_flow_slug: str = 'pizzeria-addresses', deliveryman_chat_id: int = 1, seed: int = 0):
+        """Init fake
+        :param products_count: int, number of generated products
+        :param pizzerias_count: int, number of generated pizzerias
+        :param pizzeria_addresses_flow_slug: str, slug of flow with pizzerias
+        :param deliveryman_chat_id: int, chat id of deliveryman of every pizzeria
+        :param seed: int, seed of random generator, the same seed generates the same pizzerias
+        """
+        self.pizzeria_addresses_flow_slug = pizzeria_addresses_flow_slug
+        randomizer = random.Random(seed)
+
+        self.files = {}
+        self.products = []
+        for product_number in range(1, products_count + 1):
+            file_id = str(uuid.UUID(int=randomizer.getrandbits(128)))
+            self.files[file_id] = {
+                'type': 'file',
+                'id': file_id,
+                'link': {'href': f'https://example.com/images/pizza-{product_number}.jpg'},
+            }
+            price_amount = randomizer.randrange(300, 900) * 100
+            formatted_price = format_price(price_amount)
+            self.products.append({
+                'type': 'product',
+                'id': str(uuid.UUID(int=randomizer.getrandbits(128))),
+                'name': f'Пицца {product_number}',
+                'slug': f'pizza-{product_number}',
+                'sku': f'pizza-{product_number}',
+                'description': f'Описание пиццы {product_number}',
+                'price': [{'amount': price_amount, 'currency': 'RUB', 'includes_tax': True}],
+                'meta': {
+                    'display_price': {
+                        'with_tax': {'amount': price_amount, 'currency': 'RUB', 'formatted': formatted_price},
+                    },
+                },
+                'relationships': {'main_image': {'data': {'type': 'main_image', 'id': file_id}}},
+            })
+        self.products_by_id = {product['id']: product for product in self.products}
+
+        self.flows = {pizzeria_addresses_flow_slug: []}
+        for pizzeria_number in range(1, pizzerias_count + 1):
+            self.flows[pizzeria_addresses_flow_slug].append({
+                'type': 'entry',
+                'id': str(uuid.UUID(int=randomizer.getrandbits(128))),
+                'pizzeria-addresses-alias': f'pizzeria-{pizzeria_number}',
+                'pizzeria-addresses-address': f'Москва, Пиццерийная улица, {pizzeria_number}',
+                'pizzeria-addresses-latitude': 55.75 + randomizer.uniform(-0.15, 0.15),
+                'pizzeria-addresses-longitude': 37.62 + randomizer.uniform(-0.25, 0.25),
+                'pizzeria-addresses-deliveryman-telegram-chat-id': deliveryman_chat_id,
+            })
+
+        self.carts = {}
+        self.customers = []
+
+        self._lock = threading.Lock()
+
+        self.routes = [
+            ('POST', r'/oauth/access_token', self.create_access_token),
+            ('GET', r'/v2/products', self.get_products),
+            ('GET', r'/v2/products/(?P<product_id>[^/]+)', self.get_product),
+            ('GET', r'/v2/files/(?P<file_id>[^/]+)', self.get_file),
+            ('GET', r'/v2/carts/(?P<reference>[^/]+)/items', self.get_cart_items),
+            ('POST', r'/v2/carts/(?P<reference>[^/]+)/items', self.add_cart_item),
+            ('PUT', r'/v2/carts/(?P<reference>[^/]+)/items/(?P<cart_item_id>[^/]+)', self.update_cart_item),
+            ('DELETE', r'/v2/carts/(?P<reference>[^/]+)/items/(?P<cart_item_id>[^/]+)', self.delete_cart_item),
+            ('GET', r'/v2/customers', self.get_customers),
+            ('POST', r'/v2/customers', self.create_customer),
+            ('GET', r'/v2/flows', self.get_flows),
+            ('GET', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', self.get_entries),
+            ('POST', r'/v2/flows/(?P<flow_slug>[^/]+)/entries', self.create_entry),
+        ]
+
+    def get_pizzerias_lat_lons(self) -> List[Tuple[float, float]]:
+        return [
+            (entry['pizzeria-addresses-latitude'], entry['pizzeria-addresses-longitude'])
+            for entry in self.flows[self.pizzeria_addresses_flow_slug]
+        ]
+
+    @staticmethod
+    def _get_page(path: str, objects: List[Dict[str, Any]], query: Dict[str, str]) -> Dict[str, Any]:
+        page_size = int(query.get('page[limit]', 100))
+        page_offset = int(query.get('page[offset]', 0))
+        next_page_offset = page_offset + page_size
+        next_page = None
+        if next_page_offset < len(objects):
+            next_page = f'{path}?page[limit]={page_size}&page[offset]={next_page_offset}'
+        return {
+            'data': objects[page_offset:next_page_offset],
+            'links': {'next': next_page},
+            'meta': {'results': {'total': len(objects)}},
+        }
+
+    def create_access_token(self, query: Dict[str, str], body: Any) -> Response:
+        return HTTPStatus.OK, {
+            'access_token': uuid.uuid4().hex,
+            'token_type': 'Bearer',
+            'expires': int(time.time()) + 3600,
+        }
+
+    def get_products(self, query: Dict[str, str], body: Any) -> Response:
+        return HTTPStatus.OK, self._get_page('/v2/products', self.products, query)
+
+    def get_product(self, query: Dict[str, str], body: Any, product_id: str) -> Response:
+        product = self.products_by_id.get(product_id)
+        if product is None:
+            return HTTPStatus.NOT_FOUND, {'errors': [{'title': 'Not Found'}]}
+
+        response = {'data': product}
+        if query.get('include') == 'main_image':
+            response['included'] = {'main_images': [self.files[product['relationships']['main_image']['data']['id']]]}
+        return HTTPStatus.OK, response
+
+    def get_file(self, query: Dict[str, str], body: Any, file_id: str) -> Response:
+        if file_id not in self.files:
+            return HTTPStatus.NOT_FOUND, {'errors': [{'title': 'Not Found'}]}
+        return HTTPStatus.OK, {'data': self.files[file_id]}
+
+    def _render_cart(self, reference: str) -> Dict[str, Any]:
+        items = []
+        total_price_amount = 0
+        for item in self.carts.get(reference, []):
+            product = self.products_by_id[item['product_id']]
+            price_per_unit_amount = product['meta']['display_price']['with_tax']['amount']
+            item_total_price_amount = price_per_unit_amount * item['quantity']
+            total_price_amount += item_total_price_amount
+            items.append({
+                'type': 'cart_item',
+                'id': item['id'],
+                'product_id': item['product_id'],
+                'name': product['name'],
+                'description': product['description'],
+                'quantity': item['quantity'],
+                'meta': {
+                    'display_price': {
+                        'with_tax': {
+                            'unit': {'amount': price_per_unit_amount, 'formatted': format_price(price_per_unit_amount)},
+                            'value': {'amount': item_total_price_amount,
+                                      'formatted': format_price(item_total_price_amount)},
+                        },
+                    },
+                },
+            })
+        return {
+            'data': items,
+            'meta': {
+                'display_price': {
+                    'with_tax': {'amount': total_price_amount, 'formatted': format_price(total_price_amount)},
+                },
+            },
+        }
+
+    def get_cart_items(self, query: Dict[str, str], body: Any, reference: str) -> Response:
+        with self._lock:
+            return HTTPStatus.OK, self._render_cart(reference)
+
+    def add_cart_item(self, query: Dict[str, str], body: Any, reference: str) -> Response:
+        product_id = body['data']['id']
+        quantity = body['data']['quantity']
+        if product_id not in self.products_by_id or not isinstance(quantity, int):
+            return HTTPStatus.BAD_REQUEST, {'errors': [{'title': 'Bad Request'}]}
+
+        with self._lock:
+            cart = self.carts.setdefault(reference, [])
+            for item in cart:
+                if item['product_id'] == product_id:
+                    item['quantity'] += quantity
+                    break
+            else:
+                cart.append({'id': str(uuid.uuid4()), 'product_id': product_id, 'quantity': quantity})
+            return HTTPStatus.CREATED, self._render_cart(reference)
+
+    def update_cart_item(self, query: Dict[str, str], body: Any, reference: str, cart_item_id: str) -> Response:
+        quantity = body['data']['quantity']
+        if not isinstance(quantity, int):
+            return HTTPStatus.BAD_REQUEST, {'errors': [{'title': 'Bad Request'}]}
+
+        with self._lock:
+            for item in self.carts.get(reference, []):
+                if item['id'] == cart_item_id:
+                    item['quantity'] = quantity
+                    return HTTPStatus.OK, self._render_cart(reference)
+            return HTTPStatus.NOT_FOUND, {'errors': [{'title': 'Not Found'}]}
+
+    def delete_cart_item(self, query: Dict[str, str], body: Any, reference: str, cart_item_id: str) -> Response:
+        with self._lock:
+            cart = self.carts.get(reference, [])
+            self.carts[reference] = [item for item in cart if item['id'] != cart_item_id]
+            return HTTPStatus.OK, self._render_cart(reference)
+
+    def get_customers(self, query: Dict[str, str], body: Any) -> Response:
+        customers = self.customers
+        filter_match = re.fullmatch(r'eq\(name,(.*)\):eq\(email,(.*)\)', query.get('filter', ''))
+        if filter_match:
+            name, email = filter_match.groups()
+            customers = [customer for customer in customers if customer['name'] == name and customer['email'] == email]
+        return HTTPStatus.OK, {'data': customers}
+
+    def create_customer(self, query: Dict[str, str], body: Any) -> Response:
+        name = body['data'].get('name')
+        email = body['data'].get('email') or ''
+        if not name or '@' not in email:
+            return HTTPStatus.UNPROCESSABLE_ENTITY, {'errors': [{'title': 'Failed Validation'}]}
+
+        with self._lock:
+            if any(customer['email'] == email for customer in self.customers):
+                return HTTPStatus.CONFLICT, {'errors': [{'title': 'Duplicate email'}]}
+            customer = {'type': 'customer', 'id': str(uuid.uuid4()), 'name': name, 'email': email}
+            self.customers.append(customer)
+        return HTTPStatus.CREATED, {'data': customer}
+
+    def get_flows(self, query: Dict[str, str], body: Any) -> Response:
+        flows = [{'type': 'flow', 'id': flow_slug, 'slug': flow_slug} for flow_slug in self.flows]
+        return HTTPStatus.OK, {'data': flows}
+
+    def get_entries(self, query: Dict[str, str], body: Any, flow_slug: str) -> Response:
+        with self._lock:
+            entries = list(self.flows.get(flow_slug, []))
+        return HTTPStatus.OK, self._get_page(f'/v2/flows/{flow_slug}/entries', entries, query)
+
+    def create_entry(self, query: Dict[str, str], body: Any, flow_slug: str) -> Response:
+        entry = dict(body['data'])
+        entry['id'] = str(uuid.uuid4())
+        with self._lock:
+            self.flows.setdefault(flow_slug, []).append(entry)
+        return HTTPStatus.CREATED, {'data': entry}
+
+
+class FakeGeocoder:
+    """
+    This class answers yandex geocoder queries.
+    Every address is placed near one of :lat_lons: points, the same address always gets the same coordinates.
+    """
+
+    def __init__(self, lat_lons: List[Tuple[float, float]], max_offset_degrees: float = 0.01):
+        """Init fake
+        :param lat_lons: list of tuples, latitude and longitude of points which addresses are placed near
+        :param max_offset_degrees: float, maximum distance between address and point in degrees
+        """
+        self.lat_lons = lat_lons
+        self.max_offset_degrees = max_offset_degrees
+
+        self.routes = [
+            ('GET', r'/1.x/?', self.geocode),
+        ]
+
+    def geocode(self, query: Dict[str, str], body: Any) -> Response:
+        address = query.get('geocode', '').strip()
+        found_places = []
+        if address:
+            address_hash = int(hashlib.md5(address.encode('utf-8')).hexdigest(), 16)
+            randomizer = random.Random(address_hash)
+            lat, lon = randomizer.choice(self.lat_lons)
+            lat += randomizer.uniform(-self.max_offset_degrees, self.max_offset_degrees)
+            lon += randomizer.uniform(-self.max_offset_degrees, self.max_offset_degrees)
+            found_places.append({'GeoObject': {'Point': {'pos': f'{lon} {lat}'}}})
+
+        return HTTPStatus.OK, {'response': {'GeoObjectCollection': {'featureMember': found_places}}}
+
+
+class FakeServicesServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 256
+
+    def __init__(self, server_address: Tuple[str, int], services: List[Any], latency_seconds: float = 0):
+        super().__init__(server_address, FakeServicesRequestHandler)
+        self.latency_seconds = latency_seconds
+        self.routes = [
+            (method, re.compile(path_pattern), handler)
+            for service in services
+            for method, path_pattern, handler in service.routes
+        ]
+
+    def route(self, method: str, path: str, query: Dict[str, str], body: Any) -> Response:
+        for route_method, path_pattern, handler in self.routes:
+            path_match = path_pattern.fullmatch(path)
+            if route_method == method and path_match:
+                return handler(query, body, **path_match.groupdict())
+        return HTTPStatus.NOT_FOUND, {'errors': [{'title': 'Not Found'}]}
+
+
+class FakeServicesRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, bot keeps pooled connections
+    protocol_version = 'HTTP/1.1'
+
+    def _handle(self, method: str) -> None:
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query))
+        content_length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(content_length) if content_length else None
+        if body and 'json' in self.headers.get('Content-Type', ''):
+            body = json.loads(body)
+
+        if self.server.latency_seconds:
+            time.sleep(self.server.latency_seconds)
+
+        status, payload = self.server.route(method, url.path, query, body)
+
+        response_body = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response_body)))
+        self.end_headers()
+        self.wfile.write(response_body)
+
+    def do_GET(self):
+        self._handle('GET')
+
+    def do_POST(self):
+        self._handle('POST')
+
+    def do_PUT(self):
+        self._handle('PUT')
+
+    def do_DELETE(self):
+        self._handle('DELETE')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_server(services: List[Any], listen: str = '127.0.0.1', port: int = 0,
+                      latency_seconds: float = 0) -> FakeServicesServer:
+    """Start daemon thread which answers queries of :services:.
+    :param services: list, objects with 'routes' - list of tuples (method, path regex, handler)
+    :param listen: str, address to listen
+    :param port: int, port to listen, free port is taken if 0
+    :param latency_seconds: float, every query is answered after this delay, like real API over network
+    :return: FakeServicesServer, server_address has real port
+    """
+    httpd = FakeServicesServer((listen, port), services, latency_seconds)
+    thread = threading.Thread(target=httpd.serve_forever, name='fake-services', daemon=True)
+    thread.start()
+    logger.debug(f'fake services are served on {httpd.server_address[0]}:{httpd.server_address[1]}')
+
+    return httpd
+
+
+def get_server_url(httpd: FakeServicesServer, path: str = '') -> str:
+    host, port = httpd.server_address[:2]
+    return f'http://{host}:{port}{path}'
@@ -0,0 +1,300 @@
+"""
+Load test of bot state machine without telegram, Motlin and yandex geocoder.
+
+Motlin and geocoder are replaced by local fake HTTP server (see fake_services.py), telegram is replaced by fake bot
+which only records sent messages. Every virtual user goes through the whole order:
+/start -> product -> add to cart -> cart -> payment -> email -> address -> delivery type (invoice).
+Updates go through :tg_bot.handle_chat_update: like real updates, so sessions, carts and caches live in real Redis.
+All users run as tasks of one event loop, the same way as chats run in the bot.
+
+Use empty Redis, never production one: benchmark writes sessions, carts and caches of fake users.
+
+    python -m benchmarks.run_benchmark --users 5000 --concurrency 1000 --motlin-latency-ms 50
+"""
+from collections import Counter, defaultdict
+from types import SimpleNamespace
+from typing import Dict, Any, List, Optional, Tuple
+import argparse
+import asyncio
+import itertools
+import logging
+import math
+import os
+import random
+import time
+
+import environs
+
+import tg_bot
+from benchmarks.fake_services import FakeGeocoder, FakeMotlin, get_server_url, start_fake_server
+from utils import metrics_utils
+from utils.session_utils import load_session
+
+logger = logging.getLogger(__name__)
+
+PERCENTILES = (50, 95, 99)
+
+
+class FakeBot:
+    """
+    This class replaces telegram.Bot in handlers: it waits :latency_seconds: like telegram API
+    and remembers the last keyboard of every chat, so virtual user can press its buttons.
+    """
+
+    def __init__(self, latency_seconds: float = 0):
+        self.latency_seconds = latency_seconds
+        self.calls = Counter()
+        self.keyboards = {}
+        self._message_ids = itertools.count(1)
+
+    async def _call(self, method_name: str, chat_id: Optional[int] = None, reply_markup: Any = None,
+                    **message_params) -> SimpleNamespace:
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+
+        self.calls[method_name] += 1
+        if chat_id is not None and reply_markup is not None:
+            self.keyboards[chat_id] = reply_markup
+
+        return SimpleNamespace(message_id=next(self._message_ids), chat_id=chat_id, **message_params)
+
+    def get_buttons(self, chat_id: int) -> List[Any]:
+        keyboard = self.keyboards.get(chat_id)
+        if keyboard is None:
+            return []
+        return [button for row in keyboard.inline_keyboard for button in row]
+
+    async def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        return await self._call('send_message', chat_id, reply_markup, text=text)
+
+    async def send_photo(self, chat_id, photo, caption=None, reply_markup=None, **kwargs):
+        photo_sizes = [SimpleNamespace(file_id=f'tg-file-{abs(hash(photo))}')]
+        return await self._call('send_photo', chat_id, reply_markup, caption=caption, photo=photo_sizes)
+
+    async def send_location(self, chat_id, latitude=None, longitude=None, **kwargs):
+        return await self._call('send_location', chat_id)
+
+    async def delete_message(self, chat_id, message_id, **kwargs):
+        await self._call('delete_message', chat_id)
+        return True
+
+    async def send_invoice(self, chat_id, *args, **kwargs):
+        return await self._call('send_invoice', chat_id)
+
+    async def answer_pre_checkout_query(self, *args, **kwargs):
+        await self._call('answer_pre_checkout_query')
+        return True
+
+
+async def answer_nothing(*args, **kwargs) -> None:
+    """Replaces answers to user which are not recorded, like update.message.reply_text."""
+
+
+def make_message_update(chat_id: int, text: str) -> SimpleNamespace:
+    chat = SimpleNamespace(id=chat_id, username=f'bench{chat_id}')
+    message = SimpleNamespace(
+        text=text,
+        chat_id=chat_id,
+        chat=chat,
+        location=None,
+        message_id=0,
+        reply_text=answer_nothing,
+    )
+    user = SimpleNamespace(id=chat_id, username=chat.username)
+    return SimpleNamespace(message=message, callback_query=None, effective_chat=chat, effective_user=user)
+
+
+def make_callback_update(chat_id: int, data: str) -> SimpleNamespace:
+    chat = SimpleNamespace(id=chat_id, username=f'bench{chat_id}')
+    query = SimpleNamespace(
+        data=data,
+        message=SimpleNamespace(chat_id=chat_id, message_id=0),
+        answer=answer_nothing,
+    )
+    user = SimpleNamespace(id=chat_id, username=chat.username)
+    return SimpleNamespace(message=None, callback_query=query, effective_chat=chat, effective_user=user)
+
+
+class Benchmark:
+    """This class runs virtual users and collects durations of updates by state of user."""
+
+    def __init__(self, bot_data: Dict[str, Any], bot: FakeBot, think_seconds: float = 0, seed: int = 0):
+        self.bot_data = bot_data
+        self.bot = bot
+        self.think_seconds = think_seconds
+        self.randomizer = random.Random(seed)
+
+        self.durations = defaultdict(list)
+        self.errors = Counter()
+        self.completed_orders = 0
+
+    async def send_update(self, chat_id: int, user_data: Dict[str, Any], update: SimpleNamespace,
+                          user_reply: str) -> None:
+        user_state, _ = await load_session(self.bot_data['db'], chat_id)
+        if user_state is None or user_reply == '/start':
+            user_state = 'START'
+
+        context = SimpleNamespace(bot=self.bot, bot_data=self.bot_data, user_data=user_data)
+        started_at = time.perf_counter()
+        try:
+            await tg_bot.handle_chat_update(update, context)
+        except Exception as e:
+            self.errors[f'{user_state}: {type(e).__name__}'] += 1
+            raise
+        finally:
+            self.durations[user_state].append(time.perf_counter() - started_at)
+
+        if self.think_seconds:
+            await asyncio.sleep(self.think_seconds)
+
+    async def press_button(self, chat_id: int, user_data: Dict[str, Any], callback_data: str) -> None:
+        await self.send_update(chat_id, user_data, make_callback_update(chat_id, callback_data), callback_data)
+
+    async def send_text(self, chat_id: int, user_data: Dict[str, Any], text: str) -> None:
+        await self.send_update(chat_id, user_data, make_message_update(chat_id, text), text)
+
+    def find_button(self, chat_id: int, prefixes: List[str]) -> Optional[str]:
+        for button in self.bot.get_buttons(chat_id):
+            if any(button.callback_data.startswith(prefix) for prefix in prefixes):
+                return button.callback_data
+        return None
+
+    async def run_user(self, chat_id: int) -> None:
+        """Make one order from /start to invoice."""
+        user_data = {}
+        try:
+            await self.send_text(chat_id, user_data, '/start')
+
+            products_buttons = [
+                button.callback_data for button in self.bot.get_buttons(chat_id)
+                if button.callback_data != 'cart' and not button.callback_data.startswith('page-')
+            ]
+            product_id = self.randomizer.choice(products_buttons)
+            await self.press_button(chat_id, user_data, product_id)
+            await self.press_button(chat_id, user_data, f'{product_id}\n1')
+            await self.press_button(chat_id, user_data, 'cart')
+            await self.press_button(chat_id, user_data, 'payment')
+            await self.send_text(chat_id, user_data, f'bench{chat_id}@example.com')
+            await self.send_text(chat_id, user_data, f'Москва, улица Нагрузочная, дом {chat_id}')
+
+            delivery_type = self.find_button(chat_id, ['delivery', 'pickup'])
+            if delivery_type is None:
+                raise RuntimeError('bot did not offer delivery type')
+            await self.press_button(chat_id, user_data, delivery_type)
+        except Exception:
+            logger.exception(f'order of {chat_id} was not finished')
+            return
+
+        self.completed_orders += 1
+
+    async def run(self, first_chat_id: int, users: int, concurrency: int) -> float:
+        """Run :users: virtual users, :concurrency: of them at the same time.
+        :return: float, seconds of run
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def run_user_in_turn(chat_id: int) -> None:
+            async with semaphore:
+                await self.run_user(chat_id)
+
+        started_at = time.perf_counter()
+        await asyncio.gather(*(run_user_in_turn(chat_id) for chat_id in range(first_chat_id, first_chat_id + users)))
+        return time.perf_counter() - started_at
+
+
+def get_percentile(sorted_values: List[float], percentile: float) -> float:
+    rank = max(math.ceil(percentile / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def print_report(benchmark: Benchmark, users: int, elapsed_seconds: float) -> None:
+    updates_count = sum(len(durations) for durations in benchmark.durations.values())
+    print(f'users: {users}, completed orders: {benchmark.completed_orders}, invoices: '
+          f'{benchmark.bot.calls["send_invoice"]}')
+    print(f'updates: {updates_count} in {elapsed_seconds:.2f} sec, {updates_count / elapsed_seconds:.1f} updates/sec')
+    print()
+
+    percentile_titles = ''.join(f'{f"p{percentile}, ms":>12}' for percentile in PERCENTILES)
+    print(f'{"state":<24}{"count":>8}{percentile_titles}{"max, ms":>12}')
+    for user_state, durations in sorted(benchmark.durations.items()):
+        durations = sorted(durations)
+        percentile_values = ''.join(
+            f'{get_percentile(durations, percentile) * 1000:>12.1f}' for percentile in PERCENTILES
+        )
+        print(f'{user_state:<24}{len(durations):>8}{percentile_values}{durations[-1] * 1000:>12.1f}')
+
+    if benchmark.errors:
+        print()
+        print('errors:')
+        for error_name, count in benchmark.errors.most_common():
+            print(f'  {error_name}: {count}')
+
+
+def get_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Load test of bot with fake Motlin, geocoder and telegram.')
+    parser.add_argument('--users', type=int, default=200, help='number of virtual users, every user makes one order')
+    parser.add_argument('--concurrency', type=int, default=32, help='number of users which make order at once')
+    parser.add_argument('--think-ms', type=float, default=0, help='pause of user between updates')
+    parser.add_argument('--products', type=int, default=40, help='number of products in fake catalog')
+    parser.add_argument('--pizzerias', type=int, default=100, help='number of pizzerias in fake flow')
+    parser.add_argument('--motlin-latency-ms', type=float, default=50, help='delay of every fake API response')
+    parser.add_argument('--telegram-latency-ms', type=float, default=30, help='delay of every fake telegram call')
+    parser.add_argument('--redis-address', default='localhost')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-password', default=None)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--print-metrics', action='store_true', help='print collected metrics in prometheus format')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+
+async def run_benchmark(config: Dict[str, Any], args: argparse.Namespace) -> Tuple[Benchmark, float]:
+    bot = FakeBot(args.telegram_latency_ms / 1000)
+    bot_data = await tg_bot.init_bot_data(config, bot)
+
+    # chat ids are new on every run, so carts and sessions of previous runs don't interfere
+    first_chat_id = random.randrange(10 ** 9, 2 * 10 ** 9)
+    benchmark = Benchmark(bot_data, bot, args.think_ms / 1000, args.seed)
+    try:
+        elapsed_seconds = await benchmark.run(first_chat_id, args.users, args.concurrency)
+    finally:
+        await tg_bot.close_bot_data(bot_data)
+    return benchmark, elapsed_seconds
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(format='%(asctime)s  %(name)s  %(levelname)s  %(message)s', level=args.log_level)
+
+    fake_motlin = FakeMotlin(args.products, args.pizzerias, seed=args.seed)
+    fake_geocoder = FakeGeocoder(fake_motlin.get_pizzerias_lat_lons())
+    httpd = start_fake_server([fake_motlin, fake_geocoder], latency_seconds=args.motlin_latency_ms / 1000)
+
+    # config is read like in bot, but .env is not read, so benchmark never goes to real services
+    os.environ.update({
+        'TG_BOT_TOKEN': 'benchmark',
+        'MOTLIN_CLIENT_ID': 'benchmark',
+        'MOTLIN_API_URL': get_server_url(httpd),
+        'YANDEX_GEO_APIKEY': 'benchmark',
+        'YANDEX_GEO_URL': get_server_url(httpd, '/1.x'),
+        'BANK_TOKEN': 'benchmark',
+        'REDIS_DB_ADDRESS': args.redis_address,
+        'REDIS_DB_PORT': str(args.redis_port),
+        'REDIS_DB_PASSWORD': args.redis_password or '',
+        'MOTLIN_POOL_SIZE': str(max(args.concurrency, 10)),
+    })
+    tg_bot.env = environs.Env()
+    config = tg_bot.get_config()
+    config['redis_db_password'] = args.redis_password
+
+    benchmark, elapsed_seconds = asyncio.run(run_benchmark(config, args))
+    httpd.shutdown()
+
+    print_report(benchmark, args.users, elapsed_seconds)
+    if args.print_metrics:
+        print()
+        print(metrics_utils.registry.render())
+
+
+if __name__ == '__main__':
+    main()
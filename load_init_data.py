@@ -1,13 +1,118 @@
 import copy
 import json
-import random
-from typing import Dict, Any, List
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Dict, Any, List, Callable, Optional
 
 import environs
 import requests
 from slugify import Slugify, CYRILLIC
+from urllib3.exceptions import ConnectTimeoutError
 
 import motlin_api
+from utils.rate_limit_utils import TokenBucket
+
+
+class ImportJournal:
+    """
+    This class keep in file what import uploaded to Motlin and what can't be read back from Motlin:
+    url of image which was uploaded for product, so image is uploaded again only if it was changed in menu.
+    What exists in Motlin is always read from Motlin, so journal of wiped store doesn't skip anything.
+    File is rewritten after every record, so journal is not lost if import is interrupted.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.records = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.records = json.load(f)
+
+    def get(self, section: str, key: str, default: Any = None) -> Any:
+        with self._lock:
+            return self.records.get(section, {}).get(key, default)
+
+    def set(self, section: str, key: str, value: Any) -> None:
+        with self._lock:
+            self.records.setdefault(section, {})[key] = value
+            tmp_path = f'{self.path}.tmp'
+            with open(tmp_path, 'w') as f:
+                json.dump(self.records, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+
+def is_request_not_done(error: requests.RequestException) -> bool:
+    """Check that Motlin did not do failed query for sure: query was rejected by rate limit or was not sent at all.
+    Else query could be done by Motlin although response was lost (read timeout, 5xx of balancer).
+    """
+    if error.response is not None:
+        return error.response.status_code == 429
+
+    if isinstance(error, motlin_api.MotlinUnavailable) and error.__cause__ is None:
+        # circuit of endpoint is open, query was rejected by client
+        return True
+
+    cause = error.__cause__ if isinstance(error.__cause__, requests.RequestException) else error
+    # connection was not established, ConnectTimeout and refused connection have this reason
+    reason = getattr(cause.args[0], 'reason', None) if cause.args else None
+    return isinstance(cause, requests.ConnectionError) and isinstance(reason, ConnectTimeoutError)
+
+
+def call_with_retries(func: Callable, *args, attempts: int = 3, backoff_seconds: float = 1,
+                      is_idempotent: bool = True, find_done: Optional[Callable[[], Any]] = None):
+    """Call :func: and repeat it if Motlin is not available or rate limit is exceeded.
+    Not idempotent query is repeated only if it was not done for sure, else :find_done: looks for object created
+    by failed query. Found object is returned instead of repeating, so query is not done twice.
+    :param func: function, query to Motlin
+    :param attempts: int, maximum number of calls
+    :param backoff_seconds: float, sleep between calls is backoff_seconds * (2 ** attempt number)
+    :param is_idempotent: bool, can query be repeated whatever happened to previous call
+    :param find_done: function without params, returns result of query if it was done, else None
+    """
+    for attempt in range(attempts):
+        try:
+            return func(*args)
+        except requests.RequestException as e:
+            is_client_error = e.response is not None and 400 <= e.response.status_code < 500
+            if attempt == attempts - 1 or (is_client_error and e.response.status_code != 429):
+                raise
+            could_be_done = not is_idempotent and not is_request_not_done(e)
+            if could_be_done and find_done is None:
+                raise
+            time.sleep(backoff_seconds * 2 ** attempt)
+
+            if could_be_done:
+                result = find_done()
+                if result is not None:
+                    return result
+
+
+def run_concurrently(func: Callable, items: List[Any], workers: int, title: str) -> List[Any]:
+    """Call :func: for every item in pool of threads and print progress.
+    :return: list, results of successful calls
+    """
+    started_at = time.monotonic()
+    results = []
+    failed_count = 0
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(func, item) for item in items]
+        for done_count, future in enumerate(as_completed(futures), start=1):
+            try:
+                results.append(future.result())
+            except requests.RequestException as e:
+                failed_count += 1
+                print(f'{title}: upload failed: {e}')
+            print(f'{title}: {done_count}/{len(items)}', end='\r')
+
+    elapsed_seconds = time.monotonic() - started_at
+    throughput = len(items) / elapsed_seconds if elapsed_seconds else 0
+    print(f'{title}: {len(results)} uploaded, {failed_count} failed in {elapsed_seconds:.1f} sec '
+          f'({throughput:.1f} per sec)')
+
+    return results
 
 
 def get_api_suitable_product(product: Dict[str, Any]) -> Dict[str, Any]:
@@ -18,7 +123,8 @@ def get_api_suitable_product(product: Dict[str, Any]) -> Dict[str, Any]:
             'type': 'product',
             'name': product['name'],
             'slug': slugify_ru(product['name']),
-            'sku': str(random.randint(1, 2 ** 32)),
+            # sku is the same for every import of product, so product can be found again
+            'sku': slugify_ru(product['name']),
             'description': product.get('description', ''),
             'manage_stock': False,
             'price': [
@@ -35,25 +141,90 @@ def get_api_suitable_product(product: Dict[str, Any]) -> Dict[str, Any]:
     return suitable_for_api_product
 
 
-def upload_menu(menu: List[Dict[str, Any]], access_keeper: motlin_api.Access):
-    for product in menu:
-        product_to_api = get_api_suitable_product(product)
-        product_id = motlin_api.create_product(access_keeper, product_to_api)
-        image_url = product.get('product_image', {}).get('url', '')
-        if image_url:
-            motlin_api.upload_image_to_product(access_keeper, product_id, image_url)
+def is_product_changed(product_to_api: Dict[str, Any], existing_product: Dict[str, Any]) -> bool:
+    compared_params = ['name', 'sku', 'description', 'price', 'status']
+    return any(
+        product_to_api['data'][param_name] != existing_product.get(param_name)
+        for param_name in compared_params
+    )
+
+
+def upload_product(product: Dict[str, Any], access_keeper: motlin_api.Access,
+                   existing_products: Dict[str, Dict[str, Any]], journal: ImportJournal) -> str:
+    """Create product or update it if it was changed, then upload image if product has no image or
+    image uploaded by previous import was changed in menu. Image which was not uploaded by import is kept.
+    """
+    product_to_api = get_api_suitable_product(product)
+    slug = product_to_api['data']['slug']
+    existing_product = existing_products.get(slug)
+    image_url = product.get('product_image', {}).get('url', '')
+
+    if existing_product is None:
+        product_id = call_with_retries(
+            motlin_api.create_product, access_keeper, product_to_api,
+            is_idempotent=False,
+            find_done=lambda: motlin_api.get_product_id_by_slug(access_keeper, slug),
+        )
+        # product is created by this run, so it has no image whatever journal says
+        is_image_needed = bool(image_url)
+    else:
+        if is_product_changed(product_to_api, existing_product):
+            product_id = call_with_retries(motlin_api.update_product, access_keeper, existing_product['id'],
+                                           product_to_api)
+        else:
+            product_id = existing_product['id']
+
+        has_image = existing_product.get('relationships', {}).get('main_image', {}).get('data') is not None
+        uploaded_image_url = journal.get('product_images', slug)
+        is_image_changed = uploaded_image_url is not None and uploaded_image_url != image_url
+        is_image_needed = bool(image_url) and (not has_image or is_image_changed)
+
+    if is_image_needed:
+        # uploaded file can't be found by url, so upload is repeated only if it was not done for sure
+        image_id = call_with_retries(motlin_api.upload_image, access_keeper, image_url, is_idempotent=False)
+        call_with_retries(motlin_api.link_main_image_to_product, access_keeper, product_id, image_id)
+        journal.set('product_images', slug, image_url)
+
+    return product_id
+
+
+def upload_menu(menu: List[Dict[str, Any]], access_keeper: motlin_api.Access, journal: ImportJournal,
+                workers: int = 1):
+    # menu is compared with catalog by slug, so only new and changed products are uploaded
+    existing_products = {product['slug']: product for product in motlin_api.iterate_products(access_keeper)}
+    # product which is twice in menu is uploaded once, else both copies are created in parallel
+    unique_menu = list({get_api_suitable_product(product)['data']['slug']: product for product in menu}.values())
+
+    # every product goes through create -> image upload -> link in own thread, products are uploaded in parallel
+    run_concurrently(
+        lambda product: upload_product(product, access_keeper, existing_products, journal),
+        unique_menu,
+        workers,
+        'products',
+    )
 
 
 def create_address_flow(access_keeper, address_flow_data):
     address_flow = address_flow_data['address_flow']
-    address_flow_id = motlin_api.create_flow(access_keeper, address_flow)
+    flow_slug = address_flow['data']['slug']
+
+    # flow is found in motlin by slug, so flow of wiped store is created again
+    existing_flows = {flow['slug']: flow for flow in motlin_api.get_all_flows(access_keeper)}
+    if flow_slug in existing_flows:
+        address_flow_id = existing_flows[flow_slug]['id']
+    else:
+        address_flow_id = motlin_api.create_flow(access_keeper, address_flow)
 
     field_template = address_flow_data['field_template']
     field_template['data']['relationships']['flow']['data']['id'] = address_flow_id
 
     address_fields = address_flow_data['address_fields']
+    existing_field_slugs = {field['slug'] for field in motlin_api.get_fields_of_flow(access_keeper, flow_slug)}
 
     for address_field in address_fields:
+        if address_field['slug'] in existing_field_slugs:
+            continue
+
         field_data = copy.deepcopy(field_template)
         for param_name, param_value in address_field.items():
             field_data['data'][param_name] = param_value
@@ -73,12 +244,44 @@ def get_api_suitable_address(address):
     return suitable_for_api_address
 
 
-def upload_addresses(addresses, access_keeper, address_slug, test_telegram_chat_id=None):
+def find_entry_id_by_alias(access_keeper, address_slug, alias):
+    for entry in motlin_api.iterate_entries_of_flow(access_keeper, address_slug):
+        if entry['pizzeria-addresses-alias'] == alias:
+            return entry['id']
+    return None
+
+
+def upload_address(address, access_keeper, address_slug, test_telegram_chat_id=None):
+    address_to_api = get_api_suitable_address(address)
+    if test_telegram_chat_id is not None:
+        address_to_api['data']['pizzeria-addresses-deliveryman-telegram-chat-id'] = test_telegram_chat_id
+    entry_id = call_with_retries(
+        motlin_api.upload_entry_to_flow, access_keeper, address_to_api, address_slug,
+        is_idempotent=False,
+        find_done=lambda: find_entry_id_by_alias(access_keeper, address_slug, address['alias']),
+    )
+    return entry_id
+
+
+def upload_addresses(addresses, access_keeper, address_slug, test_telegram_chat_id=None, workers=1):
+    # addresses are found in flow by alias, so only addresses which are not in flow are uploaded
+    existing_aliases = {
+        entry['pizzeria-addresses-alias']
+        for entry in motlin_api.iterate_entries_of_flow(access_keeper, address_slug)
+    }
+    new_addresses = {}
     for address in addresses:
-        address_to_api = get_api_suitable_address(address)
-        if test_telegram_chat_id is not None:
-            address_to_api['data']['pizzeria-addresses-deliveryman-telegram-chat-id'] = test_telegram_chat_id
-        motlin_api.upload_entry_to_flow(access_keeper, address_to_api, address_slug)
+        # address which is twice in list is uploaded once
+        if address['alias'] not in existing_aliases:
+            new_addresses.setdefault(address['alias'], address)
+    new_addresses = list(new_addresses.values())
+
+    run_concurrently(
+        lambda address: upload_address(address, access_keeper, address_slug, test_telegram_chat_id),
+        new_addresses,
+        workers,
+        'addresses',
+    )
 
 
 def main():
@@ -98,15 +301,21 @@ def main():
     motlin_client_id = env.str('MOTLIN_CLIENT_ID')
     motlin_client_secret = env.str('MOTLIN_CLIENT_SECRET', None)
     test_telegram_chat_id = env.str('TEST_TELEGRAM_CHAT_ID', None)
-    access_keeper = motlin_api.Access(motlin_client_id, motlin_client_secret)
+    workers = env.int('MOTLIN_IMPORT_WORKERS', 8)
+    rate_limit = env.float('MOTLIN_RATE_LIMIT', 20)
+    journal = ImportJournal(env.str('IMPORT_JOURNAL_PATH', 'import_journal.json'))
+
+    rate_limiter = TokenBucket(rate_limit)
+    motlin_client = motlin_api.MotlinClient(pool_size=workers, rate_limiter=rate_limiter)
+    access_keeper = motlin_api.Access(motlin_client_id, motlin_client_secret, motlin_client)
 
-    upload_menu(menu, access_keeper)
+    upload_menu(menu, access_keeper, journal, workers)
 
     with open('pizzeria_address_flow.json') as f:
         pizzeria_address_flow_data = json.load(f)
     create_address_flow(access_keeper, pizzeria_address_flow_data)
     pizzeria_address_slug = pizzeria_address_flow_data['address_flow']['data']['slug']
-    upload_addresses(addresses, access_keeper, pizzeria_address_slug, test_telegram_chat_id)
+    upload_addresses(addresses, access_keeper, pizzeria_address_slug, test_telegram_chat_id, workers)
 
     with open('customer_address_flow.json') as f:
         customer_address_flow_data = json.load(f)
@@ -1,28 +1,203 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
+from redis.exceptions import LockError
+
+from concurrent.futures import ThreadPoolExecutor
+import copy
+import functools
+import json
 import time
 import logging
+import threading
+
+from utils import metrics_utils
+from utils.circuit_breaker_utils import CircuitBreaker
 
 logger = logging.getLogger(__name__)
 
+CONNECT_TIMEOUT_SECONDS = 3.05
+
+# name of module function which sends query now, every thread sends own queries
+_current_call = threading.local()
+
+
+def instrumented(func):
+    """Observe duration of function and mark queries sent by it, so responses are counted per function."""
+    function_name = func.__name__.lstrip('_')
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        outer_function_name = getattr(_current_call, 'function_name', None)
+        _current_call.function_name = function_name
+        try:
+            with metrics_utils.registry.timer('motlin_call_duration_seconds', function=function_name):
+                return func(*args, **kwargs)
+        finally:
+            _current_call.function_name = outer_function_name
+
+    return wrapper
+
+
+class MotlinUnavailable(requests.RequestException):
+    """Motlin did not answer or circuit of endpoint is open, query can be repeated later."""
+    pass
+
+
+class MotlinClient:
+    """
+    This class keep pooled keep-alive HTTP session to Motlin API.
+    Every new connection to Motlin costs TCP+TLS handshake, so connections are reused between queries.
+    Idempotent queries are retried with backoff when Motlin answers 429 or 5xx.
+    Every endpoint (products, carts, customers...) has own timeout and circuit breaker, so when Motlin fails
+    queries are rejected at once by MotlinUnavailable and don't hold threads.
+    MotlinUnavailable is also raised when Motlin does not answer or answers 5xx after retries.
+    """
+
+    def __init__(self, base_url='https://api.moltin.com', pool_size=10, timeout=10, retries=3, backoff_factor=0.3,
+                 rate_limiter=None, endpoint_timeouts=None, failure_threshold=5, reset_timeout_seconds=30):
+        """Init client
+        :param base_url: str, Motlin API url
+        :param pool_size: int, maximum number of kept alive connections (should be not less than number of workers)
+        :param timeout: float or tuple, seconds to wait connection and response (see requests docs),
+            connection is waited not more than CONNECT_TIMEOUT_SECONDS if float is transferred
+        :param retries: int, how many times retry query on 429 and 5xx status codes (connection is retried once)
+        :param backoff_factor: float, sleep between retries is backoff_factor * (2 ** (retry number - 1))
+        :param rate_limiter: object, TokenBucket class instance, every query takes token (no limit if not transfer)
+        :param endpoint_timeouts: dict, timeout by endpoint (for example {'carts': 3}), :timeout: for other endpoints
+        :param failure_threshold: int, number of failed queries in a row which opens circuit of endpoint
+        :param reset_timeout_seconds: float, how long queries to endpoint are rejected after circuit was opened
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.rate_limiter = rate_limiter
+        self.endpoint_timeouts = endpoint_timeouts or {}
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+
+        self.circuit_breakers = {}
+        self._circuit_breakers_lock = threading.Lock()
+
+        # timed out reading is not retried, else slow Motlin holds thread (retries + 1) times longer than timeout
+        retry = Retry(
+            total=retries,
+            connect=min(retries, 1),
+            read=0,
+            backoff_factor=backoff_factor,
+            status_forcelist=(429, 500, 502, 503, 504),
+            respect_retry_after_header=True,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+
+        self.session = requests.Session()
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def request(self, method, path, **kwargs):
+        """Send query to Motlin.
+        :param method: str, HTTP method
+        :param path: str, path of API method, for example '/v2/products'
+        :param kwargs: other params of requests.Session.request
+        :return: requests.Response, response of API
+        """
+        endpoint = self.get_endpoint(path)
+        timeout = self.endpoint_timeouts.get(endpoint, self.timeout)
+        if not isinstance(timeout, tuple):
+            timeout = (min(CONNECT_TIMEOUT_SECONDS, timeout), timeout)
+        kwargs.setdefault('timeout', timeout)
+
+        function_name = getattr(_current_call, 'function_name', None) or 'unknown'
+        circuit_breaker = self._get_circuit_breaker(endpoint)
+        if not circuit_breaker.allow_request():
+            metrics_utils.registry.increment('motlin_responses_total', function=function_name, status='circuit_open')
+            raise MotlinUnavailable(f'circuit of motlin {endpoint} is open')
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire()
+
+        try:
+            response = self.session.request(method, f'{self.base_url}{path}', **kwargs)
+        except requests.RequestException as e:
+            self._record_failure(circuit_breaker, endpoint)
+            metrics_utils.registry.increment('motlin_responses_total', function=function_name, status='error')
+            raise MotlinUnavailable(f'motlin {endpoint} did not answer: {e}') from e
+
+        metrics_utils.registry.increment('motlin_responses_total', function=function_name, status=response.status_code)
+        if response.status_code >= 500:
+            # retries are exhausted already
+            self._record_failure(circuit_breaker, endpoint)
+            raise MotlinUnavailable(f'motlin {endpoint} answered {response.status_code}', response=response)
+
+        circuit_breaker.record_success()
+        return response
+
+    @staticmethod
+    def get_endpoint(path):
+        """Get endpoint of API method, for example 'carts' for '/v2/carts/1/items'."""
+        path_parts = [path_part for path_part in path.split('?')[0].split('/') if path_part]
+        if len(path_parts) > 1 and path_parts[0] == 'v2':
+            return path_parts[1]
+        return path_parts[0] if path_parts else ''
+
+    def _get_circuit_breaker(self, endpoint):
+        with self._circuit_breakers_lock:
+            circuit_breaker = self.circuit_breakers.get(endpoint)
+            if circuit_breaker is None:
+                circuit_breaker = CircuitBreaker(f'motlin {endpoint}', self.failure_threshold,
+                                                 self.reset_timeout_seconds)
+                self.circuit_breakers[endpoint] = circuit_breaker
+            return circuit_breaker
+
+    @staticmethod
+    def _record_failure(circuit_breaker, endpoint):
+        if circuit_breaker.record_failure():
+            metrics_utils.registry.increment('motlin_circuit_opened_total', endpoint=endpoint)
+
+    def get(self, path, **kwargs):
+        return self.request('GET', path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.request('POST', path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.request('PUT', path, **kwargs)
+
+    def delete(self, path, **kwargs):
+        return self.request('DELETE', path, **kwargs)
+
 
 class Access:
     """
     This class keep and update access token of Motlin
-    Motlin token only works until "self.expires_in" arrives.
+    Motlin token only works until "self.expires" arrives.
     It's bad practise asc token every query, better save queries.
+    Token is updated only by one thread at a time, and if Redis is transferred, only by one process at a time,
+    other processes take token from Redis.
     """
 
-    def __init__(self, client_id, client_secret=None):
+    def __init__(self, client_id, client_secret=None, client=None, db=None, refresh_ahead_seconds=60):
         """Init access
         :param client_id: str, internal id of user in motlin
         :param client_secret: str, internal secret code in motlin (if transfer you will get CRUD permissions)
+        :param client: object, MotlinClient class instance which will be used for all queries (created if not transfer)
+        :param db: object, Redis instance to share token between bot processes (token is not shared if not transfer)
+        :param refresh_ahead_seconds: int, how many seconds before expires background refresh updates token
         """
         self.client_id = client_id
         self.client_secret = client_secret
+        self.client = client or MotlinClient()
+        self.db = db
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self.db_key = f'motlin_access_token:{client_id}'
+        self.access_token = None
         self.expires = 0
 
-        self.access_token = self.get_access_token()
+        self._lock = threading.Lock()
+        self._stop_refresh = threading.Event()
+
+        self.get_access_token()
 
     def get_access_token(self):
         """Get token if it active, else update before get.
@@ -32,32 +207,108 @@ class Access:
         # To be sure that key 100% not expire for example user call before 0.5 sec of expires)
         insurance_period_seconds = 10
 
-        token_work = time.time() < self.expires - insurance_period_seconds
-
-        if token_work:
+        if self._is_token_work(self.expires, insurance_period_seconds):
             return self.access_token
 
+        with self._lock:
+            # token could be updated by other thread while this thread was waiting lock
+            if not self._is_token_work(self.expires, insurance_period_seconds):
+                self._update_access_token(insurance_period_seconds)
+
+        return self.access_token
+
+    def start_auto_refresh(self):
+        """Start daemon thread which updates token before it expires, so user queries never wait token update."""
+        thread = threading.Thread(target=self._auto_refresh, name='motlin-access-refresh', daemon=True)
+        thread.start()
+        logger.debug('motlin access token auto refresh was started')
+
+    def stop_auto_refresh(self):
+        self._stop_refresh.set()
+
+    def _auto_refresh(self):
+        seconds_to_retry = 5
+        while not self._stop_refresh.is_set():
+            seconds_to_refresh = self.expires - self.refresh_ahead_seconds - time.time()
+            if self._stop_refresh.wait(max(seconds_to_refresh, 0)):
+                return
+
+            try:
+                with self._lock:
+                    if not self._is_token_work(self.expires, self.refresh_ahead_seconds):
+                        self._update_access_token(self.refresh_ahead_seconds)
+            except (requests.RequestException, LockError):
+                logger.exception('motlin access token was not refreshed')
+                self._stop_refresh.wait(seconds_to_retry)
+
+    @staticmethod
+    def _is_token_work(expires, min_seconds_to_expire):
+        return time.time() < expires - min_seconds_to_expire
+
+    def _update_access_token(self, min_seconds_to_expire):
+        """Take token from Redis if other process already updated it, else request it from API.
+        Should be called under self._lock.
+        :param min_seconds_to_expire: int, token which expires earlier is considered as expired
+        """
+        if self.db is None:
+            self._request_access_token()
+            return
+
+        if self._load_shared_access_token(min_seconds_to_expire):
+            return
+
+        with self.db.lock(f'{self.db_key}:lock', timeout=30, blocking_timeout=30):
+            # token could be updated by other process while this process was waiting lock
+            if self._load_shared_access_token(min_seconds_to_expire):
+                return
+
+            self._request_access_token()
+            access = {'access_token': self.access_token, 'expires': self.expires}
+            seconds_to_expire = max(int(self.expires - time.time()), 1)
+            self.db.set(self.db_key, json.dumps(access), ex=seconds_to_expire)
+
+    def _load_shared_access_token(self, min_seconds_to_expire):
+        """Load token from Redis.
+        :param min_seconds_to_expire: int, token which expires earlier is considered as expired
+        :return: bool, True if token was loaded
+        """
+        shared_access = self.db.get(self.db_key)
+        if shared_access is None:
+            return False
+
+        access = json.loads(shared_access)
+        if not self._is_token_work(access['expires'], min_seconds_to_expire):
+            return False
+
+        # token should be set before expires, because token is read without lock
+        self.access_token = access['access_token']
+        self.expires = access['expires']
+        logger.debug('motlin access token was taken from redis')
+
+        return True
+
+    @instrumented
+    def _request_access_token(self):
         data = {
             'client_id': self.client_id,
             'grant_type': 'implicit'
         }
 
         if self.client_secret is not None:
-            data['client_secret'] = self.client_secret,
+            data['client_secret'] = self.client_secret
             data['grant_type'] = 'client_credentials'
 
-        response = requests.post('https://api.moltin.com/oauth/access_token', data=data)
+        response = self.client.post('/oauth/access_token', data=data)
         response.raise_for_status()
 
         access = response.json()
 
+        # token should be set before expires, because token is read without lock
         self.access_token = access['access_token']
         self.expires = access['expires']
 
         logger.debug('motlin access token was updated')
 
-        return self.access_token
-
 
 class WrongCustomersNumber(ValueError):
     pass
@@ -75,23 +326,97 @@ def get_authorization_headers(access_keeper):
     return headers
 
 
-def get_all_products(access_keeper):
-    """Get list of products
+@instrumented
+def get_page(access_keeper, path, page_size, page_offset):
+    """Get one page of list.
     :param access_keeper: object, Access class instance
-    :return: list of dicts, list of products where product is dict
+    :param path: str, path of API method with list, for example '/v2/products'
+    :param page_size: int, number of objects on page (Motlin maximum is 100)
+    :param page_offset: int, number of objects to skip
+    :return: dict, response of API with keys 'data', 'links' and 'meta'
     """
-    logger.debug('getting products...')
+    logger.debug(f'getting page of {path}, offset={page_offset}...')
     headers = get_authorization_headers(access_keeper)
 
-    response = requests.get('https://api.moltin.com/v2/products', headers=headers)
+    params = {
+        'page[limit]': page_size,
+        'page[offset]': page_offset,
+    }
+    response = access_keeper.client.get(path, headers=headers, params=params)
     response.raise_for_status()
 
-    products = response.json()['data']
+    page = response.json()
+    logger.debug(f'{len(page["data"])} objects was got')
+
+    return page
+
+
+def iterate_pages(access_keeper, path, page_size=100, prefetch=False):
+    """Iterate over all objects of list page by page.
+    Motlin returns only first page by default, so all pages are requested one by one.
+    :param access_keeper: object, Access class instance
+    :param path: str, path of API method with list, for example '/v2/products'
+    :param page_size: int, number of objects on page (Motlin maximum is 100)
+    :param prefetch: bool, if True next page is requested in background while current page is processed
+    :return: generator of dicts, objects of list
+    """
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+    page_offset = 0
+    page = get_page(access_keeper, path, page_size, page_offset)
+    try:
+        while True:
+            objects = page['data']
+            page_offset += len(objects)
+
+            total = page.get('meta', {}).get('results', {}).get('total')
+            has_next_page = bool(objects) and bool(page.get('links', {}).get('next'))
+            has_next_page = has_next_page and len(objects) == page_size
+            if total is not None:
+                has_next_page = has_next_page and page_offset < total
+
+            next_page = None
+            if has_next_page and executor is not None:
+                next_page = executor.submit(get_page, access_keeper, path, page_size, page_offset)
+
+            yield from objects
+
+            if not has_next_page:
+                return
+
+            if next_page is not None:
+                page = next_page.result()
+            else:
+                page = get_page(access_keeper, path, page_size, page_offset)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+
+def iterate_products(access_keeper, page_size=100, prefetch=False):
+    """Iterate over all products
+    :param access_keeper: object, Access class instance
+    :param page_size: int, number of products on page (Motlin maximum is 100)
+    :param prefetch: bool, if True next page is requested in background while current page is processed
+    :return: generator of dicts, products where product is dict
+    """
+    return iterate_pages(access_keeper, '/v2/products', page_size, prefetch)
+
+
+@instrumented
+def get_all_products(access_keeper, page_size=100):
+    """Get list of products
+    :param access_keeper: object, Access class instance
+    :param page_size: int, number of products on page (Motlin maximum is 100)
+    :return: list of dicts, list of products where product is dict
+    """
+    logger.debug('getting products...')
+    products = list(iterate_products(access_keeper, page_size, prefetch=True))
     logger.debug(f'{len(products)} products was got')
 
     return products
 
 
+@instrumented
 def get_product_by_id(access_keeper, product_id):
     """Get one product by id (:product_id:).
     :param access_keeper: object, Access class instance
@@ -101,7 +426,7 @@ def get_product_by_id(access_keeper, product_id):
     logger.debug(f'getting product by id: {product_id}...')
     headers = get_authorization_headers(access_keeper)
 
-    response = requests.get(f'https://api.moltin.com/v2/products/{product_id}', headers=headers)
+    response = access_keeper.client.get(f'/v2/products/{product_id}', headers=headers)
     response.raise_for_status()
 
     product = response.json()['data']
@@ -110,6 +435,53 @@ def get_product_by_id(access_keeper, product_id):
     return product
 
 
+@instrumented
+def get_product_with_main_image(access_keeper, product_id):
+    """Get one product by id (:product_id:) with href of main image by one query.
+    :param access_keeper: object, Access class instance
+    :param product_id: str, id of product
+    :return: tuple, dict with product params and str with href of main image (None if product has no image)
+    """
+    logger.debug(f'getting product with main image by id: {product_id}...')
+    headers = get_authorization_headers(access_keeper)
+
+    params = {
+        'include': 'main_image'
+    }
+    response = access_keeper.client.get(f'/v2/products/{product_id}', headers=headers, params=params)
+    response.raise_for_status()
+
+    product = response.json()['data']
+    main_images = response.json().get('included', {}).get('main_images', [])
+    image_href = main_images[0]['link']['href'] if main_images else None
+    logger.debug('product with main image was got')
+
+    return product, image_href
+
+
+@instrumented
+def get_product_id_by_slug(access_keeper, slug):
+    """Get id of product by slug (:slug:).
+    :param access_keeper: object, Access class instance
+    :param slug: str, slug of product
+    :return: str, id of product, None if there is no product with the slug
+    """
+    logger.debug(f'getting product by slug: {slug}...')
+    headers = get_authorization_headers(access_keeper)
+
+    params = {
+        'filter': f'eq(slug,{slug})'
+    }
+    response = access_keeper.client.get('/v2/products', headers=headers, params=params)
+    response.raise_for_status()
+
+    products = response.json()['data']
+    logger.debug(f'{len(products)} products was got')
+
+    return products[0]['id'] if products else None
+
+
+@instrumented
 def create_product(access_keeper, product):
     """Create new product
     :param access_keeper: object, Access class instance
@@ -119,7 +491,7 @@ def create_product(access_keeper, product):
     logger.debug('create product...')
     headers = get_authorization_headers(access_keeper)
 
-    response = requests.post('https://api.moltin.com/v2/products', headers=headers, json=product)
+    response = access_keeper.client.post('/v2/products', headers=headers, json=product)
     response.raise_for_status()
 
     new_product = response.json()['data']
@@ -129,6 +501,28 @@ def create_product(access_keeper, product):
     return product_id
 
 
+@instrumented
+def update_product(access_keeper, product_id, product):
+    """Update product by id (:product_id:).
+    :param access_keeper: object, Access class instance
+    :param product_id: str, id of product
+    :param product: dict, product params which recorded in dict
+    :return: str, product id
+    """
+    logger.debug(f'update product {product_id}...')
+    headers = get_authorization_headers(access_keeper)
+
+    product = copy.deepcopy(product)
+    product['data']['id'] = product_id
+    response = access_keeper.client.put(f'/v2/products/{product_id}', headers=headers, json=product)
+    response.raise_for_status()
+
+    logger.debug(f'product with id={product_id} was updated')
+
+    return product_id
+
+
+@instrumented
 def get_file_href_by_id(access_keeper, file_id):
     """Get href of file by id (:file_id:).
     :param access_keeper: object, Access class instance
@@ -138,7 +532,7 @@ def get_file_href_by_id(access_keeper, file_id):
     logger.debug(f'getting href by file id: {file_id}...')
     headers = get_authorization_headers(access_keeper)
 
-    response = requests.get(f'https://api.moltin.com/v2/files/{file_id}', headers=headers)
+    response = access_keeper.client.get(f'/v2/files/{file_id}', headers=headers)
     response.raise_for_status()
 
     href = response.json()['data']['link']['href']
@@ -147,6 +541,7 @@ def get_file_href_by_id(access_keeper, file_id):
     return href
 
 
+@instrumented
 def add_product_to_cart(access_keeper, product_id, quantity, reference):
     """Add :quantity: of product to cart by :produt_id: for :reference: client.
     :param access_keeper: object, Access class instance
@@ -168,13 +563,14 @@ def add_product_to_cart(access_keeper, product_id, quantity, reference):
             }
     }
 
-    response = requests.post(f'https://api.moltin.com/v2/carts/{reference}/items', headers=headers, json=data)
+    response = access_keeper.client.post(f'/v2/carts/{reference}/items', headers=headers, json=data)
     response.raise_for_status()
     logger.debug('product was added')
 
     return response.json()
 
 
+@instrumented
 def get_cart_items_info(access_keeper, reference):
     """Get all product in cart for :reference:.
     :param access_keeper: object, Access class instance
@@ -184,12 +580,20 @@ def get_cart_items_info(access_keeper, reference):
     logger.debug(f'getting cart items. reference - {reference}...')
     headers = get_authorization_headers(access_keeper)
 
-    response = requests.get(f'https://api.moltin.com/v2/carts/{reference}/items', headers=headers)
+    response = access_keeper.client.get(f'/v2/carts/{reference}/items', headers=headers)
     response.raise_for_status()
     logger.debug('cart items were got')
 
-    items_in_cart = response.json()['data']
-    response_meta = response.json()['meta']
+    return parse_cart_items_info(response.json())
+
+
+def parse_cart_items_info(cart_items):
+    """Convert response of API with items of cart to format of :get_cart_items_info:.
+    :param cart_items: dict, response of API with keys 'data' and 'meta'
+    :return: dict, keys 'products', 'total_price' and 'total_price_amount'
+    """
+    items_in_cart = cart_items['data']
+    response_meta = cart_items['meta']
 
     logger.debug(f'{len(items_in_cart)} items in cart')
 
@@ -217,6 +621,34 @@ def get_cart_items_info(access_keeper, reference):
     return items_in_cart_for_response
 
 
+@instrumented
+def update_cart_item(access_keeper, reference, cart_item_id, quantity):
+    """Set quantity of item in :reference: cart by :cart_item_id:
+    :param access_keeper: object, Access class instance
+    :param reference: str, some internal string-ID of the client that is used to search for the cart in the future
+    :param cart_item_id: str, id of item in cart
+    :param quantity: str or int, new quantity of product (in pcs)
+    :return: dict, response of API
+    """
+    logger.debug(f'update cart item {cart_item_id}, quantity: {quantity}...')
+    headers = get_authorization_headers(access_keeper)
+    headers['Content-Type'] = 'application/json'
+
+    data = {
+        'data': {
+            'id': cart_item_id,
+            'quantity': int(quantity),
+        },
+    }
+
+    response = access_keeper.client.put(f'/v2/carts/{reference}/items/{cart_item_id}', headers=headers, json=data)
+    response.raise_for_status()
+    logger.debug(f'cart item {cart_item_id} was updated')
+
+    return response.json()
+
+
+@instrumented
 def delete_cart_item(access_keeper, reference, cart_item_id):
     """Delete product from :reference: cart by :cart_item_id:
     :param access_keeper: object, Access class instance
@@ -227,13 +659,14 @@ def delete_cart_item(access_keeper, reference, cart_item_id):
     logger.debug(f'delete cart item {cart_item_id}...')
     headers = get_authorization_headers(access_keeper)
 
-    response = requests.delete(f'https://api.moltin.com/v2/carts/{reference}/items/{cart_item_id}', headers=headers)
+    response = access_keeper.client.delete(f'/v2/carts/{reference}/items/{cart_item_id}', headers=headers)
     response.raise_for_status()
     logger.debug(f'cart item {cart_item_id} was deleted')
 
     return response.json()
 
 
+@instrumented
 def get_customer_id_by_name_and_email(access_keeper, customer_email, customer_name):
     """Get customer filtered by name and email.
     :param access_keeper: object, Access class instance
@@ -248,7 +681,7 @@ def get_customer_id_by_name_and_email(access_keeper, customer_email, customer_na
     params = {
         'filter': f'eq(name,{customer_name}):eq(email,{customer_email})'
     }
-    response = requests.get('https://api.moltin.com/v2/customers', headers=headers, params=params)
+    response = access_keeper.client.get('/v2/customers', headers=headers, params=params)
     response.raise_for_status()
 
     customers = response.json()['data']
@@ -262,6 +695,7 @@ def get_customer_id_by_name_and_email(access_keeper, customer_email, customer_na
     return customer_id
 
 
+@instrumented
 def create_customer(access_keeper, name, email):
     """Create a new customer with name-:name: and email-:email:.
     If the client exists, the status code 409 will be returned.
@@ -284,7 +718,7 @@ def create_customer(access_keeper, name, email):
         }
     }
 
-    response = requests.post('https://api.moltin.com/v2/customers', headers=headers, json=data)
+    response = access_keeper.client.post('/v2/customers', headers=headers, json=data)
     if response.status_code not in [409, 422]:
         response.raise_for_status()
         logger.debug('customer was added')
@@ -293,6 +727,7 @@ def create_customer(access_keeper, name, email):
     return response.status_code
 
 
+@instrumented
 def upload_image(access_keeper, image_url):
     """Upload image to cms
     :param access_keeper: object, Access class instance
@@ -306,7 +741,7 @@ def upload_image(access_keeper, image_url):
         'file_location': (None, image_url),
     }
 
-    response = requests.post('https://api.moltin.com/v2/files', headers=headers, files=files)
+    response = access_keeper.client.post('/v2/files', headers=headers, files=files)
     response.raise_for_status()
 
     image = response.json()['data']
@@ -316,18 +751,31 @@ def upload_image(access_keeper, image_url):
     return image_id
 
 
+@instrumented
 def upload_image_to_product(access_keeper, product_id, image_url):
-    """Link product and image
+    """Upload image and link it with product as main image
     :param access_keeper: object, Access class instance
     :param product_id: str, id of product
     :param image_url: str, url of image
     :return: str, image id
     """
+    image_id = upload_image(access_keeper, image_url)
+    link_main_image_to_product(access_keeper, product_id, image_id)
+
+    return image_id
+
+
+@instrumented
+def link_main_image_to_product(access_keeper, product_id, image_id):
+    """Link product and uploaded image, link replaces previous main image, so it can be repeated
+    :param access_keeper: object, Access class instance
+    :param product_id: str, id of product
+    :param image_id: str, id of uploaded image
+    :return: str, image id
+    """
     logger.debug('link product and image...')
     headers = get_authorization_headers(access_keeper)
 
-    image_id = upload_image(access_keeper, image_url)
-
     data = {
         'data': {
             'type': 'main_image',
@@ -335,8 +783,8 @@ def upload_image_to_product(access_keeper, product_id, image_url):
         },
     }
 
-    url = f'https://api.moltin.com/v2/products/{product_id}/relationships/main-image'
-    response = requests.post(url, headers=headers, json=data)
+    url = f'/v2/products/{product_id}/relationships/main-image'
+    response = access_keeper.client.post(url, headers=headers, json=data)
     response.raise_for_status()
 
     logger.debug(f'image with id={image_id} was linked with product with id={product_id}')
@@ -344,6 +792,7 @@ def upload_image_to_product(access_keeper, product_id, image_url):
     return image_id
 
 
+@instrumented
 def create_flow(access_keeper, flow):
     """Create a new flow.
     :param access_keeper: object, Access class instance
@@ -354,7 +803,7 @@ def create_flow(access_keeper, flow):
     headers = get_authorization_headers(access_keeper)
     headers['Content-Type'] = 'application/json'
 
-    response = requests.post('https://api.moltin.com/v2/flows', headers=headers, json=flow)
+    response = access_keeper.client.post('/v2/flows', headers=headers, json=flow)
     response.raise_for_status()
 
     new_flow = response.json()['data']
@@ -364,6 +813,44 @@ def create_flow(access_keeper, flow):
     return flow_id
 
 
+@instrumented
+def get_all_flows(access_keeper):
+    """Get list of flows
+    :param access_keeper: object, Access class instance
+    :return: list of dicts, list of flows where flow is dict
+    """
+    logger.debug('getting flows...')
+    headers = get_authorization_headers(access_keeper)
+
+    response = access_keeper.client.get('/v2/flows', headers=headers)
+    response.raise_for_status()
+
+    flows = response.json()['data']
+    logger.debug(f'{len(flows)} flows was got')
+
+    return flows
+
+
+@instrumented
+def get_fields_of_flow(access_keeper, flow_slug):
+    """Get list of fields of flow
+    :param access_keeper: object, Access class instance
+    :param flow_slug: str, slug of flow
+    :return: list of dicts, list of fields where field is dict
+    """
+    logger.debug(f'getting fields of flow with slug={flow_slug}...')
+    headers = get_authorization_headers(access_keeper)
+
+    response = access_keeper.client.get(f'/v2/flows/{flow_slug}/fields', headers=headers)
+    response.raise_for_status()
+
+    fields = response.json()['data']
+    logger.debug(f'{len(fields)} fields was got')
+
+    return fields
+
+
+@instrumented
 def create_field(access_keeper, field):
     """Create a new filed linked with flow.
     :param access_keeper: object, Access class instance
@@ -375,7 +862,7 @@ def create_field(access_keeper, field):
     headers = get_authorization_headers(access_keeper)
     headers['Content-Type'] = 'application/json'
 
-    response = requests.post('https://api.moltin.com/v2/fields', headers=headers, json=field)
+    response = access_keeper.client.post('/v2/fields', headers=headers, json=field)
     response.raise_for_status()
 
     new_field = response.json()['data']
@@ -385,6 +872,7 @@ def create_field(access_keeper, field):
     return field_id
 
 
+@instrumented
 def upload_entry_to_flow(access_keeper, entry, flow_slug):
     """Create a new entry in flow.
     :param access_keeper: object, Access class instance
@@ -396,7 +884,7 @@ def upload_entry_to_flow(access_keeper, entry, flow_slug):
     headers = get_authorization_headers(access_keeper)
     headers['Content-Type'] = 'application/json'
 
-    response = requests.post(f'https://api.moltin.com/v2/flows/{flow_slug}/entries', headers=headers, json=entry)
+    response = access_keeper.client.post(f'/v2/flows/{flow_slug}/entries', headers=headers, json=entry)
     response.raise_for_status()
 
     new_entry = response.json()['data']
@@ -406,19 +894,27 @@ def upload_entry_to_flow(access_keeper, entry, flow_slug):
     return entry_id
 
 
-def get_all_entries_of_flow(access_keeper, flow_slug):
+def iterate_entries_of_flow(access_keeper, flow_slug, page_size=100, prefetch=False):
+    """Iterate over all entries of flow
+    :param access_keeper: object, Access class instance
+    :param flow_slug: str, slug of flow
+    :param page_size: int, number of entries on page (Motlin maximum is 100)
+    :param prefetch: bool, if True next page is requested in background while current page is processed
+    :return: generator of dicts, entries where entry is dict
+    """
+    return iterate_pages(access_keeper, f'/v2/flows/{flow_slug}/entries', page_size, prefetch)
+
+
+@instrumented
+def get_all_entries_of_flow(access_keeper, flow_slug, page_size=100):
     """Get list of entries
     :param access_keeper: object, Access class instance
     :param flow_slug: str, slug of flow
+    :param page_size: int, number of entries on page (Motlin maximum is 100)
     :return: list of dicts, list of entries where entry is dict
     """
     logger.debug('getting entries...')
-    headers = get_authorization_headers(access_keeper)
-
-    response = requests.get(f'https://api.moltin.com/v2/flows/{flow_slug}/entries', headers=headers)
-    response.raise_for_status()
-
-    entries = response.json()['data']
+    entries = list(iterate_entries_of_flow(access_keeper, flow_slug, page_size, prefetch=True))
     logger.debug(f'{len(entries)} entries was got')
 
     return entries
@@ -0,0 +1,647 @@
+import asyncio
+import contextvars
+import functools
+import json
+import logging
+import time
+
+import httpx
+from redis.exceptions import LockError
+
+from motlin_api import CONNECT_TIMEOUT_SECONDS, MotlinClient, WrongCustomersNumber, parse_cart_items_info
+from utils import metrics_utils
+from utils.async_utils import wait_event
+from utils.circuit_breaker_utils import CircuitBreaker
+
+logger = logging.getLogger(__name__)
+
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# queries which don't change anything when repeated, POST creates new object on every retry
+IDEMPOTENT_METHODS = ('GET', 'PUT', 'DELETE')
+
+# name of module function which sends query now, every task sends own queries
+_current_call = contextvars.ContextVar('motlin_current_call', default=None)
+
+
+def instrumented(func):
+    """Observe duration of coroutine function and mark queries sent by it, so responses are counted per function."""
+    function_name = func.__name__.lstrip('_')
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        outer_call = _current_call.set(function_name)
+        try:
+            with metrics_utils.registry.timer('motlin_call_duration_seconds', function=function_name):
+                return await func(*args, **kwargs)
+        finally:
+            _current_call.reset(outer_call)
+
+    return wrapper
+
+
+class MotlinUnavailable(httpx.HTTPError):
+    """Motlin did not answer or circuit of endpoint is open, query can be repeated later."""
+
+    def __init__(self, message, response=None):
+        super().__init__(message)
+        self.response = response
+
+
+class AsyncMotlinClient:
+    """
+    This class keep pooled keep-alive asyncio HTTP client to Motlin API, the same as MotlinClient,
+    but query doesn't hold thread while Motlin answers, so one process waits queries of thousands of users at once.
+    Idempotent queries are retried with backoff when Motlin answers 429 or 5xx, failed connection is retried once.
+    Every endpoint has own timeout and circuit breaker, MotlinUnavailable is raised as by MotlinClient.
+    """
+
+    def __init__(self, base_url='https://api.moltin.com', pool_size=10, timeout=10, retries=3, backoff_factor=0.3,
+                 endpoint_timeouts=None, failure_threshold=5, reset_timeout_seconds=30):
+        """Init client
+        :param base_url: str, Motlin API url
+        :param pool_size: int, maximum number of kept alive connections, connections over it are closed after query
+        :param timeout: float or tuple, seconds to wait connection and response,
+            connection is waited not more than CONNECT_TIMEOUT_SECONDS if float is transferred
+        :param retries: int, how many times retry idempotent query on 429 and 5xx status codes
+        :param backoff_factor: float, sleep between retries is backoff_factor * (2 ** (retry number - 1))
+        :param endpoint_timeouts: dict, timeout by endpoint (for example {'carts': 3}), :timeout: for other endpoints
+        :param failure_threshold: int, number of failed queries in a row which opens circuit of endpoint
+        :param reset_timeout_seconds: float, how long queries to endpoint are rejected after circuit was opened
+        """
+        self.base_url = base_url.rstrip('/')
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.endpoint_timeouts = endpoint_timeouts or {}
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+
+        self.circuit_breakers = {}
+
+        # timed out reading is not retried, else slow Motlin holds user (retries + 1) times longer than timeout
+        transport = httpx.AsyncHTTPTransport(
+            retries=min(retries, 1),
+            limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+        )
+        self.session = httpx.AsyncClient(transport=transport)
+
+    async def request(self, method, path, **kwargs):
+        """Send query to Motlin.
+        :param method: str, HTTP method
+        :param path: str, path of API method, for example '/v2/products'
+        :param kwargs: other params of httpx.AsyncClient.request
+        :return: httpx.Response, response of API
+        """
+        endpoint = MotlinClient.get_endpoint(path)
+        timeout = self.endpoint_timeouts.get(endpoint, self.timeout)
+        if isinstance(timeout, tuple):
+            connect_timeout, timeout = timeout
+        else:
+            connect_timeout = min(CONNECT_TIMEOUT_SECONDS, timeout)
+        kwargs.setdefault('timeout', httpx.Timeout(timeout, connect=connect_timeout))
+
+        function_name = _current_call.get() or 'unknown'
+        circuit_breaker = self._get_circuit_breaker(endpoint)
+        if not circuit_breaker.allow_request():
+            metrics_utils.registry.increment('motlin_responses_total', function=function_name, status='circuit_open')
+            raise MotlinUnavailable(f'circuit of motlin {endpoint} is open')
+
+        retries = self.retries if method in IDEMPOTENT_METHODS else 0
+        for retry_number in range(retries + 1):
+            try:
+                response = await self.session.request(method, f'{self.base_url}{path}', **kwargs)
+            except httpx.RequestError as e:
+                self._record_failure(circuit_breaker, endpoint)
+                metrics_utils.registry.increment('motlin_responses_total', function=function_name, status='error')
+                raise MotlinUnavailable(f'motlin {endpoint} did not answer: {e!r}') from e
+
+            if response.status_code not in RETRY_STATUS_CODES or retry_number == retries:
+                break
+            await asyncio.sleep(self._get_retry_seconds(response, retry_number))
+
+        metrics_utils.registry.increment('motlin_responses_total', function=function_name, status=response.status_code)
+        if response.status_code >= 500:
+            # retries are exhausted already
+            self._record_failure(circuit_breaker, endpoint)
+            raise MotlinUnavailable(f'motlin {endpoint} answered {response.status_code}', response=response)
+
+        circuit_breaker.record_success()
+        return response
+
+    def _get_retry_seconds(self, response, retry_number):
+        retry_after = response.headers.get('Retry-After', '')
+        if retry_after.isdigit():
+            return int(retry_after)
+        return self.backoff_factor * (2 ** retry_number)
+
+    def _get_circuit_breaker(self, endpoint):
+        circuit_breaker = self.circuit_breakers.get(endpoint)
+        if circuit_breaker is None:
+            circuit_breaker = CircuitBreaker(f'motlin {endpoint}', self.failure_threshold, self.reset_timeout_seconds)
+            self.circuit_breakers[endpoint] = circuit_breaker
+        return circuit_breaker
+
+    @staticmethod
+    def _record_failure(circuit_breaker, endpoint):
+        if circuit_breaker.record_failure():
+            metrics_utils.registry.increment('motlin_circuit_opened_total', endpoint=endpoint)
+
+    async def get(self, path, **kwargs):
+        return await self.request('GET', path, **kwargs)
+
+    async def post(self, path, **kwargs):
+        return await self.request('POST', path, **kwargs)
+
+    async def put(self, path, **kwargs):
+        return await self.request('PUT', path, **kwargs)
+
+    async def delete(self, path, **kwargs):
+        return await self.request('DELETE', path, **kwargs)
+
+    async def close(self):
+        await self.session.aclose()
+
+
+class AsyncAccess:
+    """
+    This class keep and update access token of Motlin, the same as Access, but for AsyncMotlinClient.
+    Token is updated only by one task at a time, and if Redis is transferred, only by one process at a time,
+    other processes take token from Redis.
+    """
+
+    def __init__(self, client_id, client_secret=None, client=None, db=None, refresh_ahead_seconds=60):
+        """Init access, should be called in running event loop
+        :param client_id: str, internal id of user in motlin
+        :param client_secret: str, internal secret code in motlin (if transfer you will get CRUD permissions)
+        :param client: object, AsyncMotlinClient class instance for all queries (created if not transfer)
+        :param db: object, asyncio Redis instance to share token between bot processes (not shared if not transfer)
+        :param refresh_ahead_seconds: int, how many seconds before expires background refresh updates token
+        """
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.client = client or AsyncMotlinClient()
+        self.db = db
+        self.refresh_ahead_seconds = refresh_ahead_seconds
+        self.db_key = f'motlin_access_token:{client_id}'
+        self.access_token = None
+        self.expires = 0
+
+        self._lock = asyncio.Lock()
+        self._stop_refresh = asyncio.Event()
+        self._refresh_task = None
+
+    async def get_access_token(self):
+        """Get token if it active, else update before get.
+        :return: access_token: str, motlin token
+        """
+
+        # To be sure that key 100% not expire for example user call before 0.5 sec of expires)
+        insurance_period_seconds = 10
+
+        if self._is_token_work(self.expires, insurance_period_seconds):
+            return self.access_token
+
+        async with self._lock:
+            # token could be updated by other task while this task was waiting lock
+            if not self._is_token_work(self.expires, insurance_period_seconds):
+                await self._update_access_token(insurance_period_seconds)
+
+        return self.access_token
+
+    def start_auto_refresh(self):
+        """Start background task which updates token before it expires, so user queries never wait token update."""
+        self._refresh_task = asyncio.create_task(self._auto_refresh(), name='motlin-access-refresh')
+        logger.debug('motlin access token auto refresh was started')
+
+    async def stop_auto_refresh(self):
+        self._stop_refresh.set()
+        if self._refresh_task is not None:
+            await self._refresh_task
+
+    async def _auto_refresh(self):
+        seconds_to_retry = 5
+        while not self._stop_refresh.is_set():
+            seconds_to_refresh = self.expires - self.refresh_ahead_seconds - time.time()
+            if await wait_event(self._stop_refresh, max(seconds_to_refresh, 0)):
+                return
+
+            try:
+                async with self._lock:
+                    if not self._is_token_work(self.expires, self.refresh_ahead_seconds):
+                        await self._update_access_token(self.refresh_ahead_seconds)
+            except (httpx.HTTPError, LockError):
+                logger.exception('motlin access token was not refreshed')
+                await wait_event(self._stop_refresh, seconds_to_retry)
+
+    @staticmethod
+    def _is_token_work(expires, min_seconds_to_expire):
+        return time.time() < expires - min_seconds_to_expire
+
+    async def _update_access_token(self, min_seconds_to_expire):
+        """Take token from Redis if other process already updated it, else request it from API.
+        Should be called under self._lock.
+        :param min_seconds_to_expire: int, token which expires earlier is considered as expired
+        """
+        if self.db is None:
+            await self._request_access_token()
+            return
+
+        if await self._load_shared_access_token(min_seconds_to_expire):
+            return
+
+        async with self.db.lock(f'{self.db_key}:lock', timeout=30, blocking_timeout=30):
+            # token could be updated by other process while this process was waiting lock
+            if await self._load_shared_access_token(min_seconds_to_expire):
+                return
+
+            await self._request_access_token()
+            access = {'access_token': self.access_token, 'expires': self.expires}
+            seconds_to_expire = max(int(self.expires - time.time()), 1)
+            await self.db.set(self.db_key, json.dumps(access), ex=seconds_to_expire)
+
+    async def _load_shared_access_token(self, min_seconds_to_expire):
+        """Load token from Redis.
+        :param min_seconds_to_expire: int, token which expires earlier is considered as expired
+        :return: bool, True if token was loaded
+        """
+        shared_access = await self.db.get(self.db_key)
+        if shared_access is None:
+            return False
+
+        access = json.loads(shared_access)
+        if not self._is_token_work(access['expires'], min_seconds_to_expire):
+            return False
+
+        self.access_token = access['access_token']
+        self.expires = access['expires']
+        logger.debug('motlin access token was taken from redis')
+
+        return True
+
+    @instrumented
+    async def _request_access_token(self):
+        data = {
+            'client_id': self.client_id,
+            'grant_type': 'implicit'
+        }
+
+        if self.client_secret is not None:
+            data['client_secret'] = self.client_secret
+            data['grant_type'] = 'client_credentials'
+
+        response = await self.client.post('/oauth/access_token', data=data)
+        response.raise_for_status()
+
+        access = response.json()
+
+        self.access_token = access['access_token']
+        self.expires = access['expires']
+
+        logger.debug('motlin access token was updated')
+
+
+async def get_authorization_headers(access_keeper):
+    """Construct headers for next API queries.
+    :param access_keeper: object, AsyncAccess class instance
+    :return:
+    """
+    access_token = await access_keeper.get_access_token()
+    headers = {
+        'Authorization': f'Bearer {access_token}'
+    }
+    return headers
+
+
+@instrumented
+async def get_page(access_keeper, path, page_size, page_offset):
+    """Get one page of list.
+    :param access_keeper: object, AsyncAccess class instance
+    :param path: str, path of API method with list, for example '/v2/products'
+    :param page_size: int, number of objects on page (Motlin maximum is 100)
+    :param page_offset: int, number of objects to skip
+    :return: dict, response of API with keys 'data', 'links' and 'meta'
+    """
+    logger.debug(f'getting page of {path}, offset={page_offset}...')
+    headers = await get_authorization_headers(access_keeper)
+
+    params = {
+        'page[limit]': page_size,
+        'page[offset]': page_offset,
+    }
+    response = await access_keeper.client.get(path, headers=headers, params=params)
+    response.raise_for_status()
+
+    page = response.json()
+    logger.debug(f'{len(page["data"])} objects was got')
+
+    return page
+
+
+async def iterate_pages(access_keeper, path, page_size=100, prefetch=False):
+    """Iterate over all objects of list page by page.
+    Motlin returns only first page by default, so all pages are requested one by one.
+    :param access_keeper: object, AsyncAccess class instance
+    :param path: str, path of API method with list, for example '/v2/products'
+    :param page_size: int, number of objects on page (Motlin maximum is 100)
+    :param prefetch: bool, if True next page is requested in background while current page is processed
+    :return: async generator of dicts, objects of list
+    """
+    page_offset = 0
+    page = await get_page(access_keeper, path, page_size, page_offset)
+    next_page = None
+    try:
+        while True:
+            objects = page['data']
+            page_offset += len(objects)
+
+            total = page.get('meta', {}).get('results', {}).get('total')
+            has_next_page = bool(objects) and bool(page.get('links', {}).get('next'))
+            has_next_page = has_next_page and len(objects) == page_size
+            if total is not None:
+                has_next_page = has_next_page and page_offset < total
+
+            if has_next_page and prefetch:
+                next_page = asyncio.create_task(get_page(access_keeper, path, page_size, page_offset))
+
+            for obj in objects:
+                yield obj
+
+            if not has_next_page:
+                return
+
+            if next_page is not None:
+                page = await next_page
+                next_page = None
+            else:
+                page = await get_page(access_keeper, path, page_size, page_offset)
+    finally:
+        if next_page is not None:
+            next_page.cancel()
+
+
+def iterate_products(access_keeper, page_size=100, prefetch=False):
+    """Iterate over all products
+    :param access_keeper: object, AsyncAccess class instance
+    :param page_size: int, number of products on page (Motlin maximum is 100)
+    :param prefetch: bool, if True next page is requested in background while current page is processed
+    :return: async generator of dicts, products where product is dict
+    """
+    return iterate_pages(access_keeper, '/v2/products', page_size, prefetch)
+
+
+@instrumented
+async def get_all_products(access_keeper, page_size=100):
+    """Get list of products
+    :param access_keeper: object, AsyncAccess class instance
+    :param page_size: int, number of products on page (Motlin maximum is 100)
+    :return: list of dicts, list of products where product is dict
+    """
+    logger.debug('getting products...')
+    products = [product async for product in iterate_products(access_keeper, page_size, prefetch=True)]
+    logger.debug(f'{len(products)} products was got')
+
+    return products
+
+
+@instrumented
+async def get_product_with_main_image(access_keeper, product_id):
+    """Get one product by id (:product_id:) with href of main image by one query.
+    :param access_keeper: object, AsyncAccess class instance
+    :param product_id: str, id of product
+    :return: tuple, dict with product params and str with href of main image (None if product has no image)
+    """
+    logger.debug(f'getting product with main image by id: {product_id}...')
+    headers = await get_authorization_headers(access_keeper)
+
+    params = {
+        'include': 'main_image'
+    }
+    response = await access_keeper.client.get(f'/v2/products/{product_id}', headers=headers, params=params)
+    response.raise_for_status()
+
+    product = response.json()['data']
+    main_images = response.json().get('included', {}).get('main_images', [])
+    image_href = main_images[0]['link']['href'] if main_images else None
+    logger.debug('product with main image was got')
+
+    return product, image_href
+
+
+@instrumented
+async def get_file_href_by_id(access_keeper, file_id):
+    """Get href of file by id (:file_id:).
+    :param access_keeper: object, AsyncAccess class instance
+    :param file_id: str, id of file
+    :return: str, href
+    """
+    logger.debug(f'getting href by file id: {file_id}...')
+    headers = await get_authorization_headers(access_keeper)
+
+    response = await access_keeper.client.get(f'/v2/files/{file_id}', headers=headers)
+    response.raise_for_status()
+
+    href = response.json()['data']['link']['href']
+    logger.debug('href was got')
+
+    return href
+
+
+@instrumented
+async def add_product_to_cart(access_keeper, product_id, quantity, reference):
+    """Add :quantity: of product to cart by :produt_id: for :reference: client.
+    :param access_keeper: object, AsyncAccess class instance
+    :param product_id: str, id of product
+    :param quantity: str or int, quantity of product (in pcs)
+    :param reference: str, some internal string-ID of the client that is used to search for the cart in the future
+    :return: dict, response of API
+    """
+    logger.debug(f'adding product {product_id} in cart. quantity: {quantity}. reference: {reference}...')
+    headers = await get_authorization_headers(access_keeper)
+    headers['Content-Type'] = 'application/json'
+
+    data = {
+        'data':
+            {
+                'id': product_id,
+                'type': 'cart_item',
+                'quantity': int(quantity)  # if not int API return 400
+            }
+    }
+
+    response = await access_keeper.client.post(f'/v2/carts/{reference}/items', headers=headers, json=data)
+    response.raise_for_status()
+    logger.debug('product was added')
+
+    return response.json()
+
+
+@instrumented
+async def get_cart_items_info(access_keeper, reference):
+    """Get all product in cart for :reference:.
+    :param access_keeper: object, AsyncAccess class instance
+    :param reference: str, some internal string-ID of the client that is used to search for the cart in the future
+    :return: dict, keys 'products' (value list of dict with product params) and 'total_price' (value string with formatted price)
+    """
+    logger.debug(f'getting cart items. reference - {reference}...')
+    headers = await get_authorization_headers(access_keeper)
+
+    response = await access_keeper.client.get(f'/v2/carts/{reference}/items', headers=headers)
+    response.raise_for_status()
+    logger.debug('cart items were got')
+
+    return parse_cart_items_info(response.json())
+
+
+@instrumented
+async def update_cart_item(access_keeper, reference, cart_item_id, quantity):
+    """Set quantity of item in :reference: cart by :cart_item_id:
+    :param access_keeper: object, AsyncAccess class instance
+    :param reference: str, some internal string-ID of the client that is used to search for the cart in the future
+    :param cart_item_id: str, id of item in cart
+    :param quantity: str or int, new quantity of product (in pcs)
+    :return: dict, response of API
+    """
+    logger.debug(f'update cart item {cart_item_id}, quantity: {quantity}...')
+    headers = await get_authorization_headers(access_keeper)
+    headers['Content-Type'] = 'application/json'
+
+    data = {
+        'data': {
+            'id': cart_item_id,
+            'quantity': int(quantity),
+        },
+    }
+
+    url = f'/v2/carts/{reference}/items/{cart_item_id}'
+    response = await access_keeper.client.put(url, headers=headers, json=data)
+    response.raise_for_status()
+    logger.debug(f'cart item {cart_item_id} was updated')
+
+    return response.json()
+
+
+@instrumented
+async def delete_cart_item(access_keeper, reference, cart_item_id):
+    """Delete product from :reference: cart by :cart_item_id:
+    :param access_keeper: object, AsyncAccess class instance
+    :param reference: str, some internal string-ID of the client that is used to search for the cart in the future
+    :param cart_item_id: str, id of item in cart
+    :return: dict, response of API
+    """
+    logger.debug(f'delete cart item {cart_item_id}...')
+    headers = await get_authorization_headers(access_keeper)
+
+    response = await access_keeper.client.delete(f'/v2/carts/{reference}/items/{cart_item_id}', headers=headers)
+    response.raise_for_status()
+    logger.debug(f'cart item {cart_item_id} was deleted')
+
+    return response.json()
+
+
+@instrumented
+async def get_customer_id_by_name_and_email(access_keeper, customer_email, customer_name):
+    """Get customer filtered by name and email.
+    :param access_keeper: object, AsyncAccess class instance
+    :param customer_email: str, email of customer
+    :param customer_name: str, name of customer
+    :return: str, id of customer
+    """
+    logger.debug(f'getting customer by email: {customer_email} and name {customer_name}...')
+    headers = await get_authorization_headers(access_keeper)
+
+    # motlin filtering - https://documentation.elasticpath.com/commerce-cloud/docs/api/basics/filtering.html
+    params = {
+        'filter': f'eq(name,{customer_name}):eq(email,{customer_email})'
+    }
+    response = await access_keeper.client.get('/v2/customers', headers=headers, params=params)
+    response.raise_for_status()
+
+    customers = response.json()['data']
+    logger.debug('customers was got')
+
+    if len(customers) != 1:
+        raise WrongCustomersNumber(f'Waiting 1 customer but got {len(customers)}')
+
+    customer_id = customers[0]['id']
+
+    return customer_id
+
+
+@instrumented
+async def create_customer(access_keeper, name, email):
+    """Create a new customer with name-:name: and email-:email:.
+    If the client exists, the status code 409 will be returned.
+    If the name or email address is incorrect, status code 422 will be returned.
+    Else result in json will be returned.
+    :param access_keeper: object, AsyncAccess class instance
+    :param name: str, name of client, not Null
+    :param email: str, email of client, should be valid (elasticpath API will check)
+    :return: dict or int, info about creation or status code
+    """
+    logger.debug(f'Creating customer {name} with email {email}...')
+    headers = await get_authorization_headers(access_keeper)
+    headers['Content-Type'] = 'application/json'
+
+    data = {
+        'data': {
+            'type': 'customer',
+            'name': name,
+            'email': email
+        }
+    }
+
+    response = await access_keeper.client.post('/v2/customers', headers=headers, json=data)
+    if response.status_code not in [409, 422]:
+        response.raise_for_status()
+        logger.debug('customer was added')
+        return response.json()
+
+    return response.status_code
+
+
+@instrumented
+async def upload_entry_to_flow(access_keeper, entry, flow_slug):
+    """Create a new entry in flow.
+    :param access_keeper: object, AsyncAccess class instance
+    :param entry: dict, entry data with params
+    :param flow_slug: str, the slug of flow into which entry is loaded
+    :return: int, id of created entry
+    """
+    logger.debug(f'upload entry to flow with slug={flow_slug}...')
+    headers = await get_authorization_headers(access_keeper)
+    headers['Content-Type'] = 'application/json'
+
+    response = await access_keeper.client.post(f'/v2/flows/{flow_slug}/entries', headers=headers, json=entry)
+    response.raise_for_status()
+
+    new_entry = response.json()['data']
+    entry_id = new_entry['id']
+    logger.debug(f'entry with id={entry_id} was created')
+
+    return entry_id
+
+
+def iterate_entries_of_flow(access_keeper, flow_slug, page_size=100, prefetch=False):
+    """Iterate over all entries of flow
+    :param access_keeper: object, AsyncAccess class instance
+    :param flow_slug: str, slug of flow
+    :param page_size: int, number of entries on page (Motlin maximum is 100)
+    :param prefetch: bool, if True next page is requested in background while current page is processed
+    :return: async generator of dicts, entries where entry is dict
+    """
+    return iterate_pages(access_keeper, f'/v2/flows/{flow_slug}/entries', page_size, prefetch)
+
+
+@instrumented
+async def get_all_entries_of_flow(access_keeper, flow_slug, page_size=100):
+    """Get list of entries
+    :param access_keeper: object, AsyncAccess class instance
+    :param flow_slug: str, slug of flow
+    :param page_size: int, number of entries on page (Motlin maximum is 100)
+    :return: list of dicts, list of entries where entry is dict
+    """
+    logger.debug('getting entries...')
+    entries = [entry async for entry in iterate_entries_of_flow(access_keeper, flow_slug, page_size, prefetch=True)]
+    logger.debug(f'{len(entries)} entries was got')
+
+    return entries
@@ -1,17 +1,17 @@
 import logging
 
-from telegram.ext.callbackcontext import CallbackContext
-from telegram.update import Update
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import CallbackContext
 
-import motlin_api
+import motlin_async_api
 from utils.cart_tg_utils import send_cart_info
+from utils.product_tg_utils import has_tg_file_id, send_product_photo
 from states.start import start
 
 logger = logging.getLogger(__name__)
 
 
-def handle_menu(update: Update, context: CallbackContext) -> str:
+async def handle_menu(update: Update, context: CallbackContext) -> str:
     """Menu with products."""
     bot = context.bot
     chat_id = update.effective_chat.id
@@ -21,20 +21,34 @@ def handle_menu(update: Update, context: CallbackContext) -> str:
 
     if query.data == 'cart':
         logger.debug('go to :send_cart_info: function')
-        condition = send_cart_info(context, update)
+        condition = await send_cart_info(context, update)
         return condition
     elif query.data.startswith('page'):
         page_number = int(query.data.split('-')[-1])
         logger.debug(f'go to :start: function with page {page_number}')
-        condition = start(update, context, page_number)
+        condition = await start(update, context, page_number)
         return condition
 
     logger.debug('returning description of product')
 
     product_id = query.data
-    product = motlin_api.get_product_by_id(context.bot_data['access_keeper'], product_id)
+    product = (await context.bot_data['catalog_cache'].get_products_by_id()).get(product_id)
+    image_href = None
+    is_image_sent_before = product is not None and await has_tg_file_id(
+        context.bot_data['db'], product['relationships']['main_image']['data']['id']
+    )
+    if not is_image_sent_before:
+        try:
+            # image href comes in the same query, so it's ready as telegram has no file_id of image yet
+            product, image_href = await motlin_async_api.get_product_with_main_image(
+                context.bot_data['access_keeper'], product_id
+            )
+        except motlin_async_api.MotlinUnavailable:
+            if product is None:
+                raise
+            # image is sent by cached href
+            logger.warning(f'motlin is not available, product {product_id} was taken from catalog')
     image_id = product['relationships']['main_image']['data']['id']
-    image_href = motlin_api.get_file_href_by_id(context.bot_data['access_keeper'], image_id)
 
     msg = f"""
     {product['name']}
@@ -56,6 +70,6 @@ def handle_menu(update: Update, context: CallbackContext) -> str:
     reply_markup = InlineKeyboardMarkup(keyboard)
     logger.debug('Keyboard was constructed')
 
-    bot.send_photo(chat_id=chat_id, photo=image_href, caption=msg, reply_markup=reply_markup)
-    bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
+    await send_product_photo(context, chat_id, image_id, msg, reply_markup, image_href)
+    await bot.delete_message(chat_id=chat_id, message_id=query.message.message_id)
     return 'HANDLE_DESCRIPTION'
@@ -1,60 +1,97 @@
+import asyncio
 import logging
-from typing import Optional
+from typing import Optional, Dict, Any
 
-from telegram import LabeledPrice
-from telegram.ext.callbackcontext import CallbackContext
-from telegram.update import Update
+from telegram import Bot, LabeledPrice, Update
+from telegram.ext import CallbackContext
 
-import motlin_api
+from utils.cart_tg_utils import send_cart_info
+from utils.customer_address_utils import get_customer_lat_lon
 from utils.customer_tg_utils import get_customer_id_or_waiting_email
+from utils.order_utils import create_pending_order, run_order_step
+from utils.outgoing_tg_utils import PRIORITY_HIGH, PRIORITY_LOW
+from utils.scheduler_utils import DelayedJobScheduler
 
 logger = logging.getLogger(__name__)
 
 
-def send_invoice(update: Update, context: CallbackContext, delivery_price: int = 0) -> None:
+async def send_invoice(update: Update, context: CallbackContext, order: Dict[str, Any], delivery_price: int = 0,
+                       cart_items_info: Optional[Dict[str, Any]] = None) -> None:
     bot = context.bot
     chat_id = update.effective_chat.id
     title = "Оплата"
     description = "Пожалуйста, оплатите вашу пиццу"
-    # select a payload just for you to recognize its the donation from your bot
-    payload = "Dvmn-Pizza-Bot-Payload"
     provider_token = context.bot_data['config']['bank_token']
     currency = "RUB"
-    cart_items_info = motlin_api.get_cart_items_info(context.bot_data['access_keeper'], chat_id)
+    # user pays cart total of motlin, so local copy of cart is checked before invoice
+    if cart_items_info is None:
+        cart_items_info = await context.bot_data['cart_mirror'].reconcile(chat_id)
     price = cart_items_info['total_price_amount']
     price += delivery_price
     prices = [LabeledPrice("Test", price)]
+
+    # any bot process can complete paid order, because order is found by payload
+    order['amount'] = price
+    pending_order_ttl_seconds = context.bot_data['config']['pending_order_ttl_seconds']
+    payload = await create_pending_order(context.bot_data['db'], order, pending_order_ttl_seconds)
     logger.debug('preliminaries for invoice sending ready')
 
-    bot.sendInvoice(chat_id, title, description, payload,
-                    provider_token, currency, prices)
+    await bot.send_invoice(chat_id, title, description, payload,
+                           provider_token, currency, prices)
 
 
-def do_delivery(context, chat_id, deliveryman_chat_id, msg, lat, lon):
-    context.bot.send_message(text=msg, chat_id=deliveryman_chat_id)
-    context.bot.send_location(chat_id=deliveryman_chat_id, latitude=lat, longitude=lon)
-    hour_seconds = 60 * 60
-    context.job_queue.run_once(lambda context: callback_feedback(context, chat_id), when=hour_seconds,
-                               context=context)
+async def complete_order(bot: Bot, order: Dict[str, Any], db, scheduler: DelayedJobScheduler) -> None:
+    """Do delivery or pickup of paid order.
+    It's run as job of scheduler, so it's repeated until it succeeds, steps done before failure are not repeated.
+    """
+    order_handlers = {
+        'delivery': do_delivery,
+        'pickup': do_pickup,
+    }
+    await order_handlers[order['type']](bot, order, db, scheduler)
+    logger.debug(f'order {order["order_id"]} was completed')
+
+
+async def do_delivery(bot: Bot, order: Dict[str, Any], db, scheduler: DelayedJobScheduler) -> None:
+    deliveryman_chat_id = order['deliveryman_chat_id']
+    await run_order_step(
+        db, order['order_id'], 'deliveryman_message',
+        lambda: bot.send_message(text=order['msg'], chat_id=deliveryman_chat_id, rate_limit_args=PRIORITY_HIGH),
+    )
+    await run_order_step(
+        db, order['order_id'], 'deliveryman_location',
+        lambda: bot.send_location(chat_id=deliveryman_chat_id, latitude=order['lat'], longitude=order['lon'],
+                                  rate_limit_args=PRIORITY_HIGH),
+    )
+    await schedule_feedback(scheduler, order)
+
 
+async def do_pickup(bot: Bot, order: Dict[str, Any], db, scheduler: DelayedJobScheduler) -> None:
+    await run_order_step(
+        db, order['order_id'], 'customer_message',
+        lambda: bot.send_message(text=order['msg'], chat_id=order['chat_id'], rate_limit_args=PRIORITY_HIGH),
+    )
+    await schedule_feedback(scheduler, order)
 
-def do_pickup(context, msg, chat_id):
-    context.bot.send_message(text=msg, chat_id=chat_id)
+
+async def schedule_feedback(scheduler: DelayedJobScheduler, order: Dict[str, Any]) -> None:
     hour_seconds = 60 * 60
-    context.job_queue.run_once(lambda context: callback_feedback(context, chat_id), when=hour_seconds,
-                               context=context)
+    # order id is dedup key, so order completed twice by retry gets one feedback
+    await scheduler.schedule('feedback', {'chat_id': order['chat_id']}, hour_seconds,
+                       job_id=f'feedback:{order["order_id"]}')
 
 
-def callback_feedback(context: CallbackContext, chat_id) -> None:
+async def callback_feedback(bot: Bot, chat_id: int) -> None:
     msg = '''Приятного аппетита! *место для рекламы*
 *сообщение что делать если пицца не пришла*'''
-    context.bot.send_message(
+    await bot.send_message(
         chat_id=chat_id,
-        text=msg
+        text=msg,
+        rate_limit_args=PRIORITY_LOW
     )
 
 
-def waiting_delivery_type(update: Update, context: CallbackContext) -> Optional[str]:
+async def waiting_delivery_type(update: Update, context: CallbackContext) -> Optional[str]:
     """Condition that wait type of delivery from user."""
     bot = context.bot
     chat_id = update.effective_chat.id
@@ -63,38 +100,65 @@ def waiting_delivery_type(update: Update, context: CallbackContext) -> Optional[
     config = context.bot_data['config']
     access_keeper = context.bot_data['access_keeper']
 
-    customer_id, condition = get_customer_id_or_waiting_email(context, update, access_keeper, chat_id)
-    if condition:
-        return condition
-
     nearest_pizzeria = context.user_data.get('nearest_pizzeria', None)
     if nearest_pizzeria is None:
         logger.warning('No :nearest_pizzeria: in cache')
         msg = 'Что-то пошло не так, пожалуйста, укажите снова свой адрес'
-        bot.send_message(text=msg, chat_id=chat_id)
+        await bot.send_message(text=msg, chat_id=chat_id)
         return 'WAITING_GEO'
 
-    if query.data.startswith('delivery'):
-        delivery_price = int(query.data.split(':')[-1])
-        flow_slug = config['customer_addresses_flow_slug']
-        customers = motlin_api.get_all_entries_of_flow(access_keeper, flow_slug)
-        for customer in customers:
-            if customer[config['customer_addresses_customer_id_slug']] == customer_id:
-                lat = customer[config['customer_addresses_latitude_slug']]
-                lon = customer[config['customer_addresses_longitude_slug']]
-                break
-        deliveryman_chat_id = nearest_pizzeria[config['pizzeria_addresses_deliveryman_telegram_chat_id']]
-        msg = context.user_data['cart_msg']
-        msg += f'\nСтоимость доставки: {delivery_price} руб.'
-        delivery_price *= 100  # from rubles to cents
-        context.user_data['succesful_callback'] = lambda: do_delivery(
-            context, chat_id, deliveryman_chat_id, msg, lat, lon)
-
-    else:
-        delivery_price = 0
-        nearest_pizzeria_address = nearest_pizzeria[config['pizzeria_addresses_address']]
-        msg = f'Спасибо за ваш заказ, ваш заказ будет приготовлен в ближайшей к вам пиццерии по адресу: {nearest_pizzeria_address}'
-        context.user_data['succesful_callback'] = lambda: do_pickup(context, msg, chat_id)
-
-    send_invoice(update, context, delivery_price)
+    # cart is checked with motlin while customer and address are searched
+    cart_items_info_task = asyncio.create_task(context.bot_data['cart_mirror'].reconcile(chat_id))
+
+    try:
+        customer_id, condition = await get_customer_id_or_waiting_email(context, update, access_keeper, chat_id)
+        if condition:
+            return condition
+
+        if query.data.startswith('delivery'):
+            delivery_price = int(query.data.split(':')[-1])
+            customer_lat_lon = await get_customer_lat_lon(access_keeper, context.bot_data['db'], config, customer_id)
+            if customer_lat_lon is None:
+                logger.warning(f'No address of customer {customer_id}')
+                msg = 'Что-то пошло не так, пожалуйста, укажите снова свой адрес'
+                await bot.send_message(text=msg, chat_id=chat_id)
+                return 'WAITING_GEO'
+            lat, lon = customer_lat_lon
+            deliveryman_chat_id = nearest_pizzeria[config['pizzeria_addresses_deliveryman_telegram_chat_id']]
+            msg = context.user_data['cart_msg']
+            msg += f'\nСтоимость доставки: {delivery_price} руб.'
+            delivery_price *= 100  # from rubles to cents
+            order = {
+                'type': 'delivery',
+                'chat_id': chat_id,
+                'deliveryman_chat_id': deliveryman_chat_id,
+                'lat': lat,
+                'lon': lon,
+                'msg': msg,
+            }
+
+        else:
+            delivery_price = 0
+            nearest_pizzeria_address = nearest_pizzeria[config['pizzeria_addresses_address']]
+            msg = f'Спасибо за ваш заказ, ваш заказ будет приготовлен в ближайшей к вам пиццерии по адресу: {nearest_pizzeria_address}'
+            order = {
+                'type': 'pickup',
+                'chat_id': chat_id,
+                'msg': msg,
+            }
+
+        cart_items_info = await cart_items_info_task
+        is_cart_changed = cart_items_info['version'] != context.user_data.get('cart_version')
+        is_total_changed = cart_items_info['total_price_amount'] != context.user_data.get('cart_total_price_amount')
+        if is_cart_changed or is_total_changed:
+            logger.debug('Cart was changed after user saw it')
+            msg = 'Корзина изменилась, пожалуйста, проверьте заказ'
+            await bot.send_message(text=msg, chat_id=chat_id)
+            condition = await send_cart_info(context, update, cart_items_info)
+            return condition
+    finally:
+        # cart is sent to motlin under lock of chat, so reconciliation should not outlive the handler
+        await asyncio.wait([cart_items_info_task])
+
+    await send_invoice(update, context, order, delivery_price, cart_items_info)
     return 'START'
@@ -1,14 +1,15 @@
 import logging
 
-from telegram.ext.callbackcontext import CallbackContext
-from telegram.update import Update
+from telegram import Update
+from telegram.ext import CallbackContext
 
-import motlin_api
+import motlin_async_api
+from utils.customer_tg_utils import CUSTOMER_IDS_DB_KEY, save_customer_id
 
 logger = logging.getLogger(__name__)
 
 
-def waiting_email(update: Update, context: CallbackContext) -> str:
+async def waiting_email(update: Update, context: CallbackContext) -> str:
     """Condition that wait email from user."""
     logger.debug('processing user email..')
     bot = context.bot
@@ -17,26 +18,38 @@ def waiting_email(update: Update, context: CallbackContext) -> str:
     if update.message:
         user_email = update.message.text
 
-    customer_or_status_code = motlin_api.create_customer(access_keeper=context.bot_data['access_keeper'],
-                                                         name=update.message.chat.username,
-                                                         email=user_email)
+    customer_or_status_code = await motlin_async_api.create_customer(access_keeper=context.bot_data['access_keeper'],
+                                                                     name=update.message.chat.username,
+                                                                     email=user_email)
 
     if customer_or_status_code == 422:
         # invalid email
         logger.debug('User entered invalid data')
         msg = 'Вы ввели неправильный email, пожалуйста пришлите снова, пример: example@gmail.com'
-        bot.send_message(text=msg, chat_id=update.message.chat_id)
+        await bot.send_message(text=msg, chat_id=update.message.chat_id)
         return 'WAITING_EMAIL'
 
+    chat_id = update.message.chat_id
     if customer_or_status_code != 409:
         # email has not added to CMS yet
         logger.debug('New customer was created')
         user_email = customer_or_status_code['data']['email']
-        context.user_data['customer_id'] = customer_or_status_code['data']['id']
+        await save_customer_id(context, chat_id, customer_or_status_code['data']['id'])
+    else:
+        logger.debug('Customer already exists')
+        try:
+            customer_id = await motlin_async_api.get_customer_id_by_name_and_email(
+                context.bot_data['access_keeper'], user_email, update.message.chat.username)
+            await save_customer_id(context, chat_id, customer_id)
+        except motlin_async_api.WrongCustomersNumber:
+            # customer with this email has other name, customer id will be asked again later
+            logger.warning('Can not find existing customer by email and name')
+            context.user_data.pop('customer_id', None)
+            await context.bot_data['db'].hdel(CUSTOMER_IDS_DB_KEY, chat_id)
 
     msg = f'Вы прислали мне эту почту: {user_email}.\nПожалуйста, пришлите адрес доставки.'
     context.user_data['email'] = user_email
-    bot.send_message(text=msg, chat_id=update.message.chat_id)
+    await bot.send_message(text=msg, chat_id=update.message.chat_id)
     logger.debug('user email was processed')
 
     return 'WAITING_GEO'
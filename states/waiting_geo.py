@@ -1,21 +1,47 @@
 import logging
 import time
+from typing import Dict, Any, Tuple
 
-from geopy import distance
-from telegram.ext.callbackcontext import CallbackContext
-from telegram.update import Update
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+import httpx
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import CallbackContext
 
-import motlin_api
-from utils.geo_utils import get_address_entry_lat_lon
+import motlin_async_api
+from utils.customer_address_utils import save_customer_address
 from utils.customer_tg_utils import get_customer_id_or_waiting_email
+from utils.customer_tg_utils import submit_customer_id_search
 from utils.geo_utils import get_delivery_price_by_distance
-from utils.geo_utils import fetch_coordinates
+from utils.geo_index_utils import PizzeriaIndex
 
 logger = logging.getLogger(__name__)
 
 
-def waiting_geo(update: Update, context: CallbackContext) -> str:
+async def get_nearest_pizzeria(config: Dict[str, Any], access_keeper: "motlin_async_api.AsyncAccess",
+                               user_lat: float, user_lon: float) -> Tuple[Dict[str, Any], float]:
+    """Find nearest pizzeria, pizzerias are taken from cms not more often than once a day.
+    :return: tuple, pizzeria entry and distance to it in km
+    """
+    now = int(time.time())
+    seconds_in_day = 86400
+
+    # pizzeria_addresses and last update will cache in config
+    pizza_addresses = config.get('pizzeria_addresses', [])
+    pizza_addresses_last_update = config.get('pizzeria_addresses_last_update', 0)
+    need_update_by_time = now - pizza_addresses_last_update > seconds_in_day
+
+    pizzeria_index = config.get('pizzeria_addresses_index')
+    if not pizza_addresses or need_update_by_time or pizzeria_index is None:
+        pizzeria_addresses_flow_slug = config['pizzeria_addresses_flow_slug']
+        pizza_addresses = await motlin_async_api.get_all_entries_of_flow(access_keeper, pizzeria_addresses_flow_slug)
+        pizzeria_index = PizzeriaIndex(pizza_addresses)
+        config['pizzeria_addresses'] = pizza_addresses
+        config['pizzeria_addresses_index'] = pizzeria_index
+        config['pizzeria_addresses_last_update'] = now
+
+    return pizzeria_index.nearest(user_lat, user_lon)[0]
+
+
+async def waiting_geo(update: Update, context: CallbackContext) -> str:
     """Condition that wait geo from user."""
     logger.debug('processing user geo...')
     bot = context.bot
@@ -28,8 +54,13 @@ def waiting_geo(update: Update, context: CallbackContext) -> str:
         current_pos = (update.message.location.longitude, update.message.location.latitude)
     elif update.message:
         logger.debug('user send location by text')
-        apikey = config['yandex_geo_apikey']
-        current_pos = fetch_coordinates(apikey, update.message.text)
+        try:
+            current_pos = await context.bot_data['geocode_cache'].fetch_coordinates(update.message.text)
+        except httpx.HTTPError:
+            logger.warning('geocoder is not available', exc_info=True)
+            msg = 'Не удалось найти адрес, пожалуйста, пришлите его снова или отправьте геопозицию'
+            await bot.send_message(text=msg, chat_id=chat_id)
+            return 'WAITING_GEO'
     else:
         logger.debug('user did not send any message')
         current_pos = None
@@ -37,52 +68,30 @@ def waiting_geo(update: Update, context: CallbackContext) -> str:
     if current_pos is None:
         logger.debug('User entered invalid geo')
         msg = 'Вы указали нусуществующий адрес, пожалуйста пришлите снова'
-        bot.send_message(text=msg, chat_id=update.message.chat_id)
+        await bot.send_message(text=msg, chat_id=update.message.chat_id)
         return 'WAITING_GEO'
 
     user_lon, user_lat = current_pos
-    now = int(time.time())
-    seconds_in_day = 86400
 
-    # pizzeria_addresses and last update will cache in config
-    pizza_addresses = config.get('pizzeria_addresses', [])
-    pizza_addresses_last_update = config.get('pizzeria_addresses_last_update', 0)
-    need_update_by_time = now - pizza_addresses_last_update > seconds_in_day
+    # customer is searched while pizzerias are loaded and searched
+    customer_id_task = submit_customer_id_search(context, update, access_keeper)
+    try:
+        nearest_pizzeria, nearest_pizzeria_distance_km = await get_nearest_pizzeria(config, access_keeper, user_lat,
+                                                                                    user_lon)
+        context.user_data['nearest_pizzeria'] = nearest_pizzeria
 
-    if not pizza_addresses or need_update_by_time:
-        pizzeria_addresses_flow_slug = config['pizzeria_addresses_flow_slug']
-        pizza_addresses = motlin_api.get_all_entries_of_flow(access_keeper, pizzeria_addresses_flow_slug)
-        config['pizzeria_addresses'] = pizza_addresses
-        config['pizzeria_addresses_last_update'] = now
+        customer_id, condition = await get_customer_id_or_waiting_email(context, update, access_keeper, chat_id,
+                                                                        customer_id_task)
+    finally:
+        # search doesn't change anything, so it's not needed after error
+        if customer_id_task is not None:
+            customer_id_task.cancel()
 
-    nearest_pizzeria = min(
-        pizza_addresses,
-        key=lambda entry: distance.distance(
-            get_address_entry_lat_lon(entry),
-            (user_lat, user_lon)
-        )
-    )
-    context.user_data['nearest_pizzeria'] = nearest_pizzeria
-    nearest_pizzeria_distance_km = distance.distance(
-        get_address_entry_lat_lon(nearest_pizzeria),
-        (user_lat, user_lon)
-    ).km
-
-    customer_id, condition = get_customer_id_or_waiting_email(context, update, access_keeper, chat_id)
     if condition:
         return condition
 
     # write to cms customer location
-    customer_addresses_flow_slug = config['customer_addresses_flow_slug']
-    entry = {
-        'data': {
-            'type': 'entry',
-            config['customer_addresses_customer_id_slug']: customer_id,
-            config['customer_addresses_longitude_slug']: float(user_lon),
-            config['customer_addresses_latitude_slug']: float(user_lat),
-        }
-    }
-    motlin_api.upload_entry_to_flow(access_keeper, entry, customer_addresses_flow_slug)
+    await save_customer_address(access_keeper, context.bot_data['db'], config, customer_id, user_lat, user_lon)
 
     # add delivery type buttons
     is_deliverable, delivery_price, msg = get_delivery_price_by_distance(nearest_pizzeria_distance_km)
@@ -94,6 +103,6 @@ def waiting_geo(update: Update, context: CallbackContext) -> str:
         keyboard = [[pickup_btn]]
     reply_markup = InlineKeyboardMarkup(keyboard)
 
-    bot.send_message(text=msg, chat_id=chat_id, reply_markup=reply_markup)
+    await bot.send_message(text=msg, chat_id=chat_id, reply_markup=reply_markup)
 
     return 'WAITING_DELIVERY_TYPE'
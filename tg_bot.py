@@ -1,52 +1,89 @@
+import asyncio
 import environs
+import functools
 import logging
-from typing import Optional, Dict, Any
+from typing import Dict, Any
 
-from redis import Redis
-from telegram.ext import Updater
-from telegram.ext import Filters
+from telegram import Bot, Update
+from telegram.ext import Application
+from telegram.ext import filters
 from telegram.ext import PreCheckoutQueryHandler
 from telegram.ext import CommandHandler
 from telegram.ext import CallbackQueryHandler
 from telegram.ext import MessageHandler
-from telegram.ext.callbackcontext import CallbackContext
-from telegram.update import Update
+from telegram.ext import CallbackContext
 
-from motlin_api import Access
+from redis.exceptions import LockError
+
+from motlin_async_api import AsyncAccess
+from motlin_async_api import AsyncMotlinClient
+from motlin_async_api import MotlinUnavailable
 from states.handle_cart import handle_cart
 from states.handle_description import handle_description
 from states.handle_menu import handle_menu
 from states.start import start
+from states.waiting_delivery_type import callback_feedback
+from states.waiting_delivery_type import complete_order
 from states.waiting_delivery_type import waiting_delivery_type
 from states.waiting_email import waiting_email
 from states.waiting_geo import waiting_geo
+from utils.cart_utils import CartMirror
+from utils.catalog_utils import CatalogCache
+from utils.chat_queue_utils import ChatQueues
+from utils.geo_utils import GEOCODER_URL, GeocodeCache
+from utils.lock_utils import LockKeeper
+from utils import metrics_utils
+from utils.menu_tg_utils import MenuPages
+from utils.order_utils import delete_pending_order, get_pending_order
+from utils.outgoing_tg_utils import OutgoingQueue
+from utils.scheduler_utils import DelayedJobScheduler
+from utils.session_utils import SESSION_FIELDS, load_session, save_session
+from webhook_server import WebhookServer
 
 logger = logging.getLogger(__name__)
 
 
-def successful_payment_callback(update: Update, context: CallbackContext) -> None:
-    update.message.reply_text("Thank you for your payment!")
-    context.user_data['succesful_callback']()
-    del context.user_data['succesful_callback']
+async def successful_payment_callback(update: Update, context: CallbackContext) -> None:
+    await update.message.reply_text("Thank you for your payment!")
+    payload = update.message.successful_payment.invoice_payload
+    order = await get_pending_order(context.bot_data['db'], payload)
+    if order is None:
+        logger.warning(f'Can not find pending order, payload: {payload}')
+    else:
+        # paid order is completed by scheduler, so it's retried until it's done and survives restart of bot.
+        # Order id is dedup key, so order paid twice by retry of telegram is completed once
+        await context.bot_data['scheduler'].schedule('complete_order', {'order': order}, 0,
+                                                     job_id=f'complete_order:{order["order_id"]}')
+        await delete_pending_order(context.bot_data['db'], payload)
 
     msg = 'Отправьте команду /start если хотите сделать новый заказ'
     bot = context.bot
     chat_id = update.effective_chat.id
-    bot.send_message(text=msg, chat_id=chat_id)
+    await bot.send_message(text=msg, chat_id=chat_id)
 
 
-def precheckout_callback(update: Update, context: CallbackContext) -> Optional[str]:
+async def precheckout_callback(update: Update, context: CallbackContext) -> None:
     query = update.pre_checkout_query
-    if 'succesful_callback' not in context.user_data or not context.user_data['succesful_callback']:
-        logger.warning('Can not find succesful_callback')
+    order = await get_pending_order(context.bot_data['db'], query.invoice_payload)
+    if order is None or order['amount'] != query.total_amount:
+        logger.warning(f'Can not find pending order, payload: {query.invoice_payload}')
         msg = 'Что-то пошло не так, пожалуйста, попробуйте снова сделать заказ'
-        context.bot.answer_pre_checkout_query(pre_checkout_query_id=query.id, ok=False, error_message=msg)
-        condition = start(update, context)
-        return condition
-    context.bot.answer_pre_checkout_query(pre_checkout_query_id=query.id, ok=True)
+        await context.bot.answer_pre_checkout_query(pre_checkout_query_id=query.id, ok=False, error_message=msg)
+        # pre-checkout update has no chat, so user is answered in private chat with bot
+        await context.bot.send_message(chat_id=query.from_user.id,
+                                       text='Отправьте команду /start чтобы сделать заказ снова')
+        return
+    await context.bot.answer_pre_checkout_query(pre_checkout_query_id=query.id, ok=True)
+
+
+async def handle_users_reply(update: Update, context: CallbackContext) -> None:
+    """Put update to queue of its chat, updates of one chat are handled one by one by :handle_chat_update:."""
+    if update.effective_chat is None:
+        return
+    context.bot_data['chat_queues'].put(update.effective_chat.id, update, context)
 
 
-def handle_users_reply(update: Update, context: CallbackContext) -> None:
+async def handle_chat_update(update: Update, context: CallbackContext) -> None:
     """Bot's state machine."""
 
     if update.message:
@@ -58,11 +95,40 @@ def handle_users_reply(update: Update, context: CallbackContext) -> None:
     else:
         return
 
+    config = context.bot_data['config']
+    # queue of chat orders updates in this process, redis lock orders bot processes
+    chat_lock = context.bot_data['db'].lock(
+        f'chat_lock:{chat_id}',
+        timeout=config['chat_lock_timeout_seconds'],
+        blocking_timeout=config['chat_lock_wait_timeout_seconds'],
+    )
+    # the wait doesn't block other chats: queue of chat is drained by its own task
+    if not await chat_lock.acquire():
+        logger.warning(f'Update of {chat_id} was skipped, chat is locked too long by other process')
+        await context.bot.send_message(chat_id, 'Предыдущее сообщение ещё обрабатывается, повторите, пожалуйста, позже')
+        return
+    try:
+        # lock is extended while handler works, timeout only frees chat of dead bot process
+        async with LockKeeper(chat_lock):
+            await handle_state(update, context, chat_id, user_reply)
+    finally:
+        try:
+            await chat_lock.release()
+        except LockError:
+            logger.warning(f'Lock of {chat_id} expired before update was handled')
+
+
+async def handle_state(update: Update, context: CallbackContext, chat_id: int, user_reply: str) -> None:
+    """Run handler of user state and save next state with session."""
+    db = context.bot_data['db']
+    user_state, session = await load_session(db, chat_id)
+    if user_state is None:
+        # state of chat which was saved before sessions
+        legacy_user_state = await db.get(chat_id)
+        user_state = legacy_user_state.decode('utf-8') if legacy_user_state is not None else 'START'
+
     if user_reply == '/start':
         user_state = 'START'
-        context.bot_data['db'].set(chat_id, user_state)
-    else:
-        user_state = context.bot_data['db'].get(chat_id).decode("utf-8")
 
     logger.debug(f'User state: {user_state}')
 
@@ -76,11 +142,25 @@ def handle_users_reply(update: Update, context: CallbackContext) -> None:
         'WAITING_DELIVERY_TYPE': waiting_delivery_type
     }
     state_handler = states_functions[user_state]
-    next_state = state_handler(update, context)
-    context.bot_data['db'].set(chat_id, next_state)
+
+    context.user_data.update(session)
+    try:
+        with metrics_utils.registry.timer('bot_state_handler_duration_seconds', state=user_state):
+            next_state = await state_handler(update, context)
+    except MotlinUnavailable:
+        # user can repeat the same action later, so state is not changed
+        logger.warning(f'Motlin is not available, update of {chat_id} was not handled')
+        msg = 'Сервис временно недоступен, попробуйте позже'
+        await context.bot.send_message(text=msg, chat_id=chat_id)
+        next_state = user_state
+    finally:
+        # session lives in redis, process keeps only fields which can't be saved
+        session = {field: context.user_data.pop(field) for field in SESSION_FIELDS if field in context.user_data}
+
+    await save_session(db, chat_id, next_state, session, context.bot_data['config']['session_ttl_seconds'])
 
 
-def error(update: Update, context: CallbackContext) -> None:
+async def error(update: Update, context: CallbackContext) -> None:
     """Log Errors caused by Updates."""
     logger.warning(f'Update "{update}" caused error "{context.error}"')
 
@@ -90,13 +170,48 @@ def get_config() -> Dict[str, Any]:
     config = {
         'tg_bot_token': env.str('TG_BOT_TOKEN'),
         'proxy': env.str('PROXY', None),
+        'bot_concurrent_updates': env.int('BOT_CONCURRENT_UPDATES', 1000),
+        'tg_sender_workers': env.int('TG_SENDER_WORKERS', 8),
+        'tg_global_rate_limit': env.float('TG_GLOBAL_RATE_LIMIT', 30),
+        'tg_chat_rate_limit': env.float('TG_CHAT_RATE_LIMIT', 1),
+        'tg_chat_burst': env.float('TG_CHAT_BURST', 3),
+        'bot_mode': env.str('BOT_MODE', 'polling'),
+        'metrics_port': env.int('METRICS_PORT', None),
+        'metrics_file': env.str('METRICS_FILE', None),
+        'metrics_file_interval_seconds': env.float('METRICS_FILE_INTERVAL_SECONDS', 15),
+        'chat_lock_timeout_seconds': env.int('CHAT_LOCK_TIMEOUT', 60),
+        'chat_lock_wait_timeout_seconds': env.int('CHAT_LOCK_WAIT_TIMEOUT', 30),
+        'session_ttl_seconds': env.int('SESSION_TTL_SECONDS', 7 * 24 * 60 * 60),
+        'pending_order_ttl_seconds': env.int('PENDING_ORDER_TTL_SECONDS', 24 * 60 * 60),
+        'scheduler_workers': env.int('SCHEDULER_WORKERS', 1),
+        'scheduler_poll_interval_seconds': env.float('SCHEDULER_POLL_INTERVAL_SECONDS', 1),
+        'webhook_url': env.str('WEBHOOK_URL', None),
+        'webhook_listen': env.str('WEBHOOK_LISTEN', '0.0.0.0'),
+        'webhook_port': env.int('WEBHOOK_PORT', 8443),
+        'webhook_path': env.str('WEBHOOK_PATH', '/telegram'),
+        'webhook_secret_token': env.str('WEBHOOK_SECRET_TOKEN', None),
         'motlin_client_id': env.str("MOTLIN_CLIENT_ID"),
         'motlin_client_secret': env.str("MOTLIN_CLIENT_SECRET", None),
+        'motlin_api_url': env.str("MOTLIN_API_URL", 'https://api.moltin.com'),
+        'motlin_pool_size': env.int("MOTLIN_POOL_SIZE", 32),
+        'motlin_timeout': env.float("MOTLIN_TIMEOUT", 10),
+        'motlin_retries': env.int("MOTLIN_RETRIES", 3),
+        'motlin_endpoint_timeouts': env.dict("MOTLIN_ENDPOINT_TIMEOUTS", {'carts': 3, 'customers': 5, 'flows': 5},
+                                             subcast_values=float),
+        'motlin_failure_threshold': env.int("MOTLIN_FAILURE_THRESHOLD", 5),
+        'motlin_reset_timeout_seconds': env.float("MOTLIN_RESET_TIMEOUT_SECONDS", 30),
         'redis_db_password': env.str("REDIS_DB_PASSWORD"),
         'redis_db_address': env.str("REDIS_DB_ADDRESS"),
         'redis_db_port': env.int("REDIS_DB_PORT"),
         'products_on_page': env.int("PRODUCTS_ON_PAGE", 8),
+        'catalog_ttl_seconds': env.int("CATALOG_TTL_SECONDS", 300),
+        'catalog_shared': env.bool("CATALOG_SHARED", False),
+        'cart_sync_interval_seconds': env.float("CART_SYNC_INTERVAL_SECONDS", 1),
         'yandex_geo_apikey': env.str("YANDEX_GEO_APIKEY"),
+        'yandex_geo_url': env.str("YANDEX_GEO_URL", GEOCODER_URL),
+        'geocode_cache_size': env.int("GEOCODE_CACHE_SIZE", 10000),
+        'geocode_cache_ttl_seconds': env.int("GEOCODE_CACHE_TTL_SECONDS", 30 * 24 * 60 * 60),
+        'geocoder_timeout': env.float("GEOCODER_TIMEOUT", 5),
         'pizzeria_addresses_flow_slug': env.str("PIZZERIA_ADDRESSES_FLOW_SLUG", "pizzeria-addresses"),
         'customer_addresses_flow_slug': env.str("CUSTOMER_ADDRESSES_FLOW_SLUG", "customer-addresses"),
         'customer_addresses_customer_id_slug': env.str("CUSTOMER_ADDRESSES_CUSTOMER_ID_SLUG",
@@ -116,48 +231,144 @@ def get_config() -> Dict[str, Any]:
     return config
 
 
-def main():
-    logging.basicConfig(format='%(asctime)s  %(name)s  %(levelname)s  %(message)s', level=logging.DEBUG)
+async def init_bot_data(config: Dict[str, Any], bot: Bot) -> Dict[str, Any]:
+    """Connect to Motlin and Redis, create caches and start background tasks, it should be called in running loop.
+    :return: dict, objects which handlers take from :context.bot_data:
+    """
+    motlin_client = AsyncMotlinClient(
+        base_url=config['motlin_api_url'],
+        pool_size=config['motlin_pool_size'],
+        timeout=config['motlin_timeout'],
+        retries=config['motlin_retries'],
+        endpoint_timeouts=config['motlin_endpoint_timeouts'],
+        failure_threshold=config['motlin_failure_threshold'],
+        reset_timeout_seconds=config['motlin_reset_timeout_seconds'],
+    )
 
-    config = get_config()
+    db = metrics_utils.InstrumentedRedis(
+        host=config['redis_db_address'],
+        port=config['redis_db_port'],
+        password=config['redis_db_password']
+    )
 
-    request_kwargs = None
-    if config['proxy']:
-        request_kwargs = {'proxy_url': config['proxy']}
-        logger.debug(f'Using proxy - {config["proxy"]}')
-    updater = Updater(
-        token=config['tg_bot_token'],
-        use_context=True,
-        request_kwargs=request_kwargs,
+    access_keeper = AsyncAccess(config['motlin_client_id'], config['motlin_client_secret'], motlin_client, db)
+    access_keeper.start_auto_refresh()
+
+    catalog_db = db if config['catalog_shared'] else None
+    catalog_cache = CatalogCache(access_keeper, config['catalog_ttl_seconds'], catalog_db)
+
+    cart_mirror = CartMirror(access_keeper, db, catalog_cache, config['cart_sync_interval_seconds'])
+    cart_mirror.start_sync_worker()
+
+    job_handlers = {
+        'feedback': callback_feedback,
+    }
+    scheduler = DelayedJobScheduler(db, bot, job_handlers, config['scheduler_poll_interval_seconds'])
+    # completion of order schedules feedback, so it gets scheduler itself
+    job_handlers['complete_order'] = functools.partial(complete_order, db=db, scheduler=scheduler)
+    scheduler.start(config['scheduler_workers'])
+
+    geocode_cache = GeocodeCache(
+        config['yandex_geo_apikey'],
+        config['geocode_cache_size'],
+        db,
+        config['geocode_cache_ttl_seconds'],
+        geocoder_url=config['yandex_geo_url'],
+        timeout=config['geocoder_timeout'],
     )
-    logger.debug('Connection with TG was established')
 
-    updater.dispatcher.add_handler(CallbackQueryHandler(handle_users_reply))
-    updater.dispatcher.add_handler(MessageHandler(Filters.text, handle_users_reply))
-    updater.dispatcher.add_handler(PreCheckoutQueryHandler(precheckout_callback))
-    updater.dispatcher.add_handler(MessageHandler(Filters.successful_payment, successful_payment_callback))
-    updater.dispatcher.add_handler(CommandHandler('start', start))
-    updater.dispatcher.add_error_handler(error)
+    return {
+        'config': config,
+        'access_keeper': access_keeper,
+        'db': db,
+        'catalog_cache': catalog_cache,
+        'menu_pages': MenuPages(catalog_cache, config['products_on_page']),
+        'cart_mirror': cart_mirror,
+        'scheduler': scheduler,
+        'geocode_cache': geocode_cache,
+    }
+
+
+async def close_bot_data(bot_data: Dict[str, Any]) -> None:
+    """Stop background tasks of :init_bot_data: and close connections."""
+    await bot_data['scheduler'].stop()
+    await bot_data['cart_mirror'].stop_sync_worker()
+    await bot_data['access_keeper'].stop_auto_refresh()
+    await bot_data['access_keeper'].client.close()
+    await bot_data['geocode_cache'].close()
+    await bot_data['db'].close()
+
 
+async def post_init(application: Application) -> None:
     # can't use telegram Persistence classes because they don't support classes
-    config = get_config()
-    updater.dispatcher.bot_data['config'] = config
-    access_keeper = Access(config['motlin_client_id'], config['motlin_client_secret'])
+    application.bot_data.update(await init_bot_data(application.bot_data['config'], application.bot))
 
-    db = Redis(
-        host=config['redis_db_address'],
-        port=config['redis_db_port'],
-        password=config['redis_db_password']
-    )
 
-    updater.dispatcher.bot_data['access_keeper'] = access_keeper
-    updater.dispatcher.bot_data['db'] = db
+async def post_stop(application: Application) -> None:
+    await close_bot_data(application.bot_data)
+
 
-    updater.start_polling()
+def main():
+    logging.basicConfig(format='%(asctime)s  %(name)s  %(levelname)s  %(message)s', level=logging.DEBUG)
+
+    config = get_config()
+
+    if config['proxy']:
+        logger.debug(f'Using proxy - {config["proxy"]}')
+    # messages wait their turn in outgoing queue, senders are started and stopped with bot
+    outgoing_queue = OutgoingQueue(
+        config['tg_global_rate_limit'],
+        config['tg_chat_rate_limit'],
+        config['tg_chat_burst'],
+        workers=config['tg_sender_workers'],
+    )
+    builder = (
+        Application.builder()
+        .token(config['tg_bot_token'])
+        .rate_limiter(outgoing_queue)
+        # connections are used by senders of outgoing queue and by answers to queries which are not queued
+        .connection_pool_size(config['tg_sender_workers'] + 16)
+        .pool_timeout(10)
+        .post_init(post_init)
+        .post_stop(post_stop)
+    )
+    if config['proxy']:
+        builder = builder.proxy_url(config['proxy']).get_updates_proxy_url(config['proxy'])
+    application = builder.build()
+
+    # handlers wait HTTP most of the time, so every chat is handled by own task and doesn't block other chats.
+    # Application only puts update to queue of chat, so updates of chat are queued in order they came.
+    application.bot_data['chat_queues'] = ChatQueues(
+        application.create_task,
+        handle_chat_update,
+        application.process_error,
+        max_running=config['bot_concurrent_updates'],
+    )
+    application.bot_data['config'] = config
+    application.add_handler(CallbackQueryHandler(handle_users_reply))
+    application.add_handler(MessageHandler(filters.TEXT, handle_users_reply))
+    application.add_handler(PreCheckoutQueryHandler(precheckout_callback, block=False))
+    application.add_handler(MessageHandler(filters.SUCCESSFUL_PAYMENT, successful_payment_callback, block=False))
+    application.add_handler(CommandHandler('start', start))
+    application.add_error_handler(error)
+
+    if config['metrics_port']:
+        metrics_utils.start_http_server(config['metrics_port'])
+    if config['metrics_file']:
+        metrics_utils.start_file_writer(config['metrics_file'], config['metrics_file_interval_seconds'])
+
+    if config['bot_mode'] == 'webhook':
+        webhook_server = WebhookServer(
+            application,
+            config['webhook_listen'],
+            config['webhook_port'],
+            config['webhook_path'],
+            config['webhook_secret_token'],
+        )
+        asyncio.run(webhook_server.run(config['webhook_url']))
+        return
 
-    # need to job queue work
-    # https://stackoverflow.com/questions/70673175/runtimeerror-cannot-schedule-new-futures-after-interpreter-shutdown/70722653#70722653
-    updater.idle()
+    application.run_polling()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,12 @@
+import asyncio
+
+
+async def wait_event(event: asyncio.Event, timeout: float) -> bool:
+    """Wait :event: not longer than :timeout: seconds, the same as threading.Event.wait.
+    :return: bool, True if event was set
+    """
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        return False
+    return True
@@ -1,19 +1,19 @@
+from typing import Dict, Any, Optional
 import logging
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext.callbackcontext import CallbackContext
-from telegram.update import Update
-
-import motlin_api
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
+from telegram.ext import CallbackContext
 
 logger = logging.getLogger(__name__)
 
 
-def send_cart_info(context: CallbackContext, update: Update) -> str:
+async def send_cart_info(context: CallbackContext, update: Update,
+                         cart_items_info: Optional[Dict[str, Any]] = None) -> str:
     """Send message with cart info (name, description, price per unit, quantity, total_price)."""
     bot = context.bot
     chat_id = update.effective_chat.id
-    cart_items_info = motlin_api.get_cart_items_info(context.bot_data['access_keeper'], chat_id)
+    if cart_items_info is None:
+        cart_items_info = await context.bot_data['cart_mirror'].get_cart_items_info(chat_id)
     total_price = cart_items_info['total_price']
     product_messages = []
     keyboard = []
@@ -33,7 +33,10 @@ def send_cart_info(context: CallbackContext, update: Update) -> str:
 
     msg = '\n\n'.join(product_messages) + f'\n\nОбщая цена: {total_price}'
     context.user_data['cart_msg'] = msg
+    # invoice is sent only for cart which user saw
+    context.user_data['cart_version'] = cart_items_info['version']
+    context.user_data['cart_total_price_amount'] = cart_items_info['total_price_amount']
 
-    bot.send_message(text=msg, chat_id=chat_id, reply_markup=reply_markup)
+    await bot.send_message(text=msg, chat_id=chat_id, reply_markup=reply_markup)
 
     return 'HANDLE_CART'
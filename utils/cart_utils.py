@@ -0,0 +1,292 @@
+from typing import Dict, Any, List
+import asyncio
+import json
+import logging
+
+import httpx
+from redis.exceptions import RedisError, WatchError
+
+import motlin_async_api
+from utils.async_utils import wait_event
+from utils.catalog_utils import CatalogCache
+from utils.lock_utils import LockKeeper
+
+logger = logging.getLogger(__name__)
+
+CART_SYNC_DIRTY_DB_KEY = 'cart_sync_dirty'
+
+
+def format_price(amount: int) -> str:
+    """Format price in pennies as human price."""
+    return f'{amount / 100:.2f} руб.'
+
+
+class CartMirror:
+    """
+    This class keep copy of Motlin carts in Redis.
+    Carts are read from Redis and changes are applied to Redis at once, then background task makes Motlin cart
+    the same as the copy: quantities of copy are compared with Motlin cart and only the difference is sent,
+    so sync can be repeated after any failure without doubled quantities.
+    Before payment cart is synced and compared with Motlin, so user pays Motlin total.
+    One cart is synced under Redis lock, so several bot processes can sync carts together.
+    Every change increments version of cart, rendered cart is cached as snapshot of version until next change.
+    """
+
+    def __init__(self, access_keeper: "motlin_async_api.AsyncAccess", db, catalog_cache: CatalogCache,
+                 sync_interval_seconds: float = 1, cart_ttl_seconds: int = 7 * 24 * 60 * 60):
+        """Init mirror, should be called in running event loop
+        :param access_keeper: object, AsyncAccess class instance
+        :param db: object, asyncio Redis instance
+        :param catalog_cache: object, CatalogCache class instance, cart items are described by products of catalog
+        :param sync_interval_seconds: float, how often background task sends changes to Motlin
+        :param cart_ttl_seconds: int, how long cart copy is kept in Redis after last change (Motlin carts live 7 days)
+        """
+        self.access_keeper = access_keeper
+        self.db = db
+        self.catalog_cache = catalog_cache
+        self.sync_interval_seconds = sync_interval_seconds
+        self.cart_ttl_seconds = cart_ttl_seconds
+
+        self._stop_sync = asyncio.Event()
+        self._sync_task = None
+
+    @staticmethod
+    def _cart_key(chat_id: int) -> str:
+        return f'cart:{chat_id}'
+
+    @staticmethod
+    def _loaded_key(chat_id: int) -> str:
+        return f'cart:{chat_id}:loaded'
+
+    @staticmethod
+    def _version_key(chat_id: int) -> str:
+        return f'cart:{chat_id}:version'
+
+    @staticmethod
+    def _snapshot_key(chat_id: int) -> str:
+        return f'cart:{chat_id}:snapshot'
+
+    async def get_version(self, chat_id: int) -> int:
+        """Get version of cart, it changes on every change of cart."""
+        return int(await self.db.get(self._version_key(chat_id)) or 0)
+
+    async def add_product(self, chat_id: int, product_id: str, quantity: int) -> None:
+        """Add :quantity: of product to cart, Motlin will be updated in background."""
+        await self._ensure_loaded(chat_id)
+        operation = {'operation': 'add', 'product_id': product_id, 'quantity': int(quantity)}
+        await self._apply_locally(chat_id, operation)
+        logger.debug(f'product {product_id} was added to cart of {chat_id}, quantity: {quantity}')
+
+    async def delete_product(self, chat_id: int, product_id: str) -> None:
+        """Delete product from cart, Motlin will be updated in background."""
+        await self._ensure_loaded(chat_id)
+        operation = {'operation': 'delete', 'product_id': product_id}
+        await self._apply_locally(chat_id, operation)
+        logger.debug(f'product {product_id} was deleted from cart of {chat_id}')
+
+    async def get_cart_items_info(self, chat_id: int) -> Dict[str, Any]:
+        """Get all products in cart, the same as :motlin_async_api.get_cart_items_info: but without Motlin query.
+        Cart item id is product id, it can be transferred to :delete_product:.
+        Result also has 'version' of cart.
+        """
+        snapshot = await self.db.get(self._snapshot_key(chat_id))
+        if snapshot is not None:
+            logger.debug(f'cart of {chat_id} was taken from snapshot')
+            return json.loads(snapshot)
+
+        await self._ensure_loaded(chat_id)
+        pipe = self.db.pipeline(transaction=True)
+        pipe.hgetall(self._cart_key(chat_id))
+        pipe.get(self._version_key(chat_id))
+        quantities, version = await pipe.execute()
+        version = int(version or 0)
+
+        products_by_id = await self.catalog_cache.get_products_by_id()
+
+        items_in_cart_for_response = {'products': []}
+        total_price_amount = 0
+        for product_id, quantity in quantities.items():
+            product_id = product_id.decode('utf-8')
+            quantity = int(quantity)
+            product = products_by_id.get(product_id)
+            if product is None:
+                logger.warning(f'product {product_id} is not in catalog, taking cart {chat_id} from motlin')
+                return await self.reconcile(chat_id)
+
+            price_per_unit_amount = product['meta']['display_price']['with_tax']['amount']
+            item_total_price_amount = price_per_unit_amount * quantity
+            total_price_amount += item_total_price_amount
+
+            item_in_cart = {
+                'description': product['description'],
+                'name': product['name'],
+                'quantity': quantity,
+                'price_per_unit': format_price(price_per_unit_amount),
+                'total_price': format_price(item_total_price_amount),
+                'product_id': product_id,
+                'cart_item_id': product_id
+            }
+            items_in_cart_for_response['products'].append(item_in_cart)
+
+        items_in_cart_for_response['total_price'] = format_price(total_price_amount)
+        items_in_cart_for_response['total_price_amount'] = total_price_amount
+        items_in_cart_for_response['version'] = version
+        await self._save_snapshot(chat_id, items_in_cart_for_response)
+
+        return items_in_cart_for_response
+
+    async def reconcile(self, chat_id: int) -> Dict[str, Any]:
+        """Send all changes of cart to Motlin and take cart from Motlin.
+        Copy in Redis is replaced if it differs from Motlin.
+        :return: dict, cart from Motlin in format of :get_cart_items_info:
+        """
+        await self.sync(chat_id)
+        cart_items_info = await motlin_async_api.get_cart_items_info(self.access_keeper, chat_id)
+
+        motlin_quantities = self._get_quantities(cart_items_info)
+        local_quantities = await self._get_local_quantities(chat_id)
+        if motlin_quantities != local_quantities:
+            logger.warning(f'cart of {chat_id} differs from motlin, copy will be replaced')
+            await self._save_loaded(chat_id, motlin_quantities)
+
+        for item in cart_items_info['products']:
+            item['cart_item_id'] = item['product_id']
+        cart_items_info['version'] = await self.get_version(chat_id)
+
+        return cart_items_info
+
+    async def sync(self, chat_id: int) -> None:
+        """Make Motlin cart the same as copy in Redis."""
+        # lock is extended while cart is synced, so other process doesn't sync the cart at the same time
+        async with self.db.lock(f'cart:{chat_id}:sync_lock', timeout=60) as sync_lock, LockKeeper(sync_lock):
+            # removed before reading copy, so changes made while sending mark cart again
+            await self.db.srem(CART_SYNC_DIRTY_DB_KEY, chat_id)
+            try:
+                local_quantities = await self._get_local_quantities(chat_id)
+                cart_items_info = await motlin_async_api.get_cart_items_info(self.access_keeper, chat_id)
+                motlin_items = {}
+                for item in cart_items_info['products']:
+                    motlin_items.setdefault(item['product_id'], []).append(item)
+
+                for product_id in set(local_quantities) | set(motlin_items):
+                    try:
+                        await self._sync_product(chat_id, product_id, local_quantities.get(product_id, 0),
+                                                 motlin_items.get(product_id, []))
+                    except httpx.HTTPStatusError as e:
+                        if e.response.status_code == 429:
+                            raise
+                        # copy is replaced by Motlin cart before payment
+                        logger.warning(f'product {product_id} of cart {chat_id} was rejected by motlin and skipped')
+            except BaseException:
+                # cart differs from Motlin yet, so worker retries it, also when handler was cancelled
+                await self.db.sadd(CART_SYNC_DIRTY_DB_KEY, chat_id)
+                raise
+
+        logger.debug(f'cart of {chat_id} was synced')
+
+    def start_sync_worker(self) -> None:
+        """Start background task which sends changes of carts to Motlin."""
+        self._sync_task = asyncio.create_task(self._sync_worker(), name='cart-sync')
+        logger.debug('cart sync worker was started')
+
+    async def stop_sync_worker(self) -> None:
+        self._stop_sync.set()
+        if self._sync_task is not None:
+            await self._sync_task
+
+    async def _sync_worker(self) -> None:
+        while not await wait_event(self._stop_sync, self.sync_interval_seconds):
+            try:
+                dirty_chat_ids = await self.db.smembers(CART_SYNC_DIRTY_DB_KEY)
+            except RedisError:
+                logger.exception('carts to sync were not read, will retry')
+                continue
+
+            for chat_id in dirty_chat_ids:
+                chat_id = int(chat_id)
+                try:
+                    await self.sync(chat_id)
+                except (httpx.HTTPError, RedisError):
+                    logger.exception(f'cart of {chat_id} was not synced, will retry')
+
+    async def _get_local_quantities(self, chat_id: int) -> Dict[str, int]:
+        return {
+            product_id.decode('utf-8'): int(quantity)
+            for product_id, quantity in (await self.db.hgetall(self._cart_key(chat_id))).items()
+        }
+
+    async def _apply_locally(self, chat_id: int, operation: Dict[str, Any]) -> None:
+        cart_key = self._cart_key(chat_id)
+        pipe = self.db.pipeline()
+        if operation['operation'] == 'add':
+            pipe.hincrby(cart_key, operation['product_id'], operation['quantity'])
+        else:
+            pipe.hdel(cart_key, operation['product_id'])
+        pipe.sadd(CART_SYNC_DIRTY_DB_KEY, chat_id)
+        pipe.incr(self._version_key(chat_id))
+        pipe.delete(self._snapshot_key(chat_id))
+        pipe.expire(cart_key, self.cart_ttl_seconds)
+        pipe.expire(self._loaded_key(chat_id), self.cart_ttl_seconds)
+        pipe.expire(self._version_key(chat_id), self.cart_ttl_seconds)
+        await pipe.execute()
+
+    async def _sync_product(self, chat_id: int, product_id: str, quantity: int,
+                            motlin_items: List[Dict[str, Any]]) -> None:
+        """Make quantity of product in Motlin cart equal to :quantity:.
+        Quantity of existing item is set, not incremented, so repeated sync doesn't change it again.
+        """
+        if sum(int(item['quantity']) for item in motlin_items) == quantity:
+            return
+
+        if quantity and len(motlin_items) == 1:
+            await motlin_async_api.update_cart_item(self.access_keeper, chat_id, motlin_items[0]['cart_item_id'],
+                                                    quantity)
+            return
+
+        for item in motlin_items:
+            await motlin_async_api.delete_cart_item(self.access_keeper, chat_id, item['cart_item_id'])
+        if quantity:
+            await motlin_async_api.add_product_to_cart(self.access_keeper, product_id, quantity, chat_id)
+
+    async def _ensure_loaded(self, chat_id: int) -> None:
+        """Take cart from Motlin if there is no copy in Redis yet."""
+        if await self.db.exists(self._loaded_key(chat_id)):
+            return
+
+        logger.debug(f'cart of {chat_id} is not in redis, taking from motlin')
+        cart_items_info = await motlin_async_api.get_cart_items_info(self.access_keeper, chat_id)
+        await self._save_loaded(chat_id, self._get_quantities(cart_items_info))
+
+    async def _save_loaded(self, chat_id: int, quantities: Dict[str, int]) -> None:
+        cart_key = self._cart_key(chat_id)
+        pipe = self.db.pipeline()
+        pipe.delete(cart_key)
+        if quantities:
+            pipe.hset(cart_key, mapping=quantities)
+            pipe.expire(cart_key, self.cart_ttl_seconds)
+        pipe.set(self._loaded_key(chat_id), 1, ex=self.cart_ttl_seconds)
+        pipe.incr(self._version_key(chat_id))
+        pipe.expire(self._version_key(chat_id), self.cart_ttl_seconds)
+        pipe.delete(self._snapshot_key(chat_id))
+        await pipe.execute()
+
+    async def _save_snapshot(self, chat_id: int, cart_items_info: Dict[str, Any]) -> None:
+        """Save rendered cart if cart was not changed while it was rendered."""
+        version_key = self._version_key(chat_id)
+        async with self.db.pipeline() as pipe:
+            try:
+                await pipe.watch(version_key)
+                if int(await pipe.get(version_key) or 0) != cart_items_info['version']:
+                    return
+                pipe.multi()
+                pipe.set(self._snapshot_key(chat_id), json.dumps(cart_items_info), ex=self.cart_ttl_seconds)
+                await pipe.execute()
+            except WatchError:
+                logger.debug(f'cart of {chat_id} was changed while snapshot was saved')
+
+    @staticmethod
+    def _get_quantities(cart_items_info: Dict[str, Any]) -> Dict[str, int]:
+        quantities = {}
+        for item in cart_items_info['products']:
+            quantities[item['product_id']] = quantities.get(item['product_id'], 0) + int(item['quantity'])
+        return quantities
@@ -0,0 +1,139 @@
+from typing import Dict, Any, List, Optional, Tuple
+import asyncio
+import json
+import logging
+import time
+
+import httpx
+from redis.exceptions import RedisError
+
+import motlin_async_api
+
+logger = logging.getLogger(__name__)
+
+
+class CatalogCache:
+    """
+    This class keep products of Motlin in memory.
+    When cache is older than "ttl_seconds" stale products are returned and update runs in background task,
+    so user never waits catalog download except the first time.
+    If Redis is transferred, catalog is shared between bot processes.
+    While Motlin is not available the last good catalog is served, from Redis too if process has no catalog yet.
+    """
+
+    def __init__(self, access_keeper: "motlin_async_api.AsyncAccess", ttl_seconds: int = 300, db=None,
+                 db_key: str = 'catalog_products'):
+        """Init cache
+        :param access_keeper: object, AsyncAccess class instance
+        :param ttl_seconds: int, how many seconds catalog considered as fresh
+        :param db: object, Redis instance to share catalog between bot processes (catalog is not shared if not transfer)
+        :param db_key: str, key of catalog in Redis
+        """
+        self.access_keeper = access_keeper
+        self.ttl_seconds = ttl_seconds
+        self.db = db
+        self.db_key = db_key
+
+        self.products = None
+        self.products_by_id = {}
+        self.updated_at = 0
+        # changes every time new products are loaded, things built from products can be cached by version
+        self.version = 0
+
+        self._lock = asyncio.Lock()
+        self._revalidation_task = None
+
+    async def get_products(self) -> List[Dict[str, Any]]:
+        """Get products from cache, update cache if it's needed.
+        :return: list of dicts, list of products where product is dict
+        """
+        if self.products is None:
+            async with self._lock:
+                # products could be loaded by other task while this task was waiting lock
+                if self.products is None:
+                    await self._update_products()
+            return self.products
+
+        if time.time() - self.updated_at > self.ttl_seconds:
+            self._start_revalidation()
+
+        return self.products
+
+    async def get_products_with_version(self) -> Tuple[List[Dict[str, Any]], float]:
+        """Get products from cache with their version as one snapshot, update cache if it's needed.
+        :return: tuple, list of products and version of the products
+        """
+        await self.get_products()
+        # products and version are changed together without await between, so they are one snapshot
+        return self.products, self.version
+
+    async def get_products_by_id(self) -> Dict[str, Dict[str, Any]]:
+        """Get products from cache as dict where key is product id."""
+        await self.get_products()
+        return self.products_by_id
+
+    def invalidate(self) -> None:
+        """Mark cache as stale, next reading will start update."""
+        self.updated_at = 0
+
+    def _start_revalidation(self) -> None:
+        if self._revalidation_task is not None:
+            return
+
+        logger.debug('catalog is stale, revalidating in background')
+        self._revalidation_task = asyncio.create_task(self._revalidate(), name='catalog-revalidation')
+
+    async def _revalidate(self) -> None:
+        try:
+            await self._update_products()
+        except (httpx.HTTPError, RedisError):
+            logger.exception('catalog was not revalidated, stale catalog will be used')
+        finally:
+            self._revalidation_task = None
+
+    async def _update_products(self) -> None:
+        products, updated_at = await self._load_shared_products(self.ttl_seconds)
+        if products is None:
+            try:
+                products = await motlin_async_api.get_all_products(self.access_keeper)
+            except motlin_async_api.MotlinUnavailable:
+                if self.products is not None:
+                    raise
+                # the last good catalog of any age is better than no menu
+                products, updated_at = await self._load_shared_products()
+                if products is None:
+                    raise
+                logger.warning('motlin is not available, catalog was taken from stale snapshot in redis')
+            else:
+                updated_at = time.time()
+                await self._save_shared_products(products, updated_at)
+
+        self.products_by_id = {product['id']: product for product in products}
+        self.products = products
+        self.updated_at = updated_at
+        self.version = updated_at
+        logger.debug(f'catalog was updated, {len(products)} products in catalog')
+
+    async def _load_shared_products(self, max_age_seconds: float = None
+                                    ) -> Tuple[Optional[List[Dict[str, Any]]], float]:
+        """Load catalog from Redis if other process updated it not earlier than :max_age_seconds: ago."""
+        if self.db is None:
+            return None, 0
+
+        shared_catalog = await self.db.get(self.db_key)
+        if shared_catalog is None:
+            return None, 0
+
+        catalog = json.loads(shared_catalog)
+        if max_age_seconds is not None and time.time() - catalog['updated_at'] > max_age_seconds:
+            return None, 0
+
+        logger.debug('catalog was taken from redis')
+        return catalog['products'], catalog['updated_at']
+
+    async def _save_shared_products(self, products: List[Dict[str, Any]], updated_at: float) -> None:
+        if self.db is None:
+            return
+
+        catalog = {'products': products, 'updated_at': updated_at}
+        await self.db.set(self.db_key, json.dumps(catalog))
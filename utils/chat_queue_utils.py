@@ -0,0 +1,70 @@
+from collections import deque
+from typing import Callable, Any, Awaitable, Deque, Optional, Tuple
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ChatQueues:
+    """
+    This class keep queue of updates for every chat which has unhandled updates.
+    Updates are put in order they came, queue of chat is drained by one task at a time,
+    so updates of one chat are handled one by one in order and chats are handled concurrently.
+    Queue is removed when it's drained, so only busy chats are kept in memory.
+    """
+
+    def __init__(self, create_task: Callable[..., Any], handle_update: Callable[[Any, Any], Awaitable[None]],
+                 handle_error: Callable[[Any, Exception], Awaitable[None]], max_pending: int = 20,
+                 max_running: Optional[int] = None):
+        """Init queues
+        :param create_task: function, runs coroutine as task of event loop (Application.create_task)
+        :param handle_update: coroutine function, handles update with context
+        :param handle_error: coroutine function, is called with update and error when :handle_update: fails
+        :param max_pending: int, maximum number of updates waiting in queue of one chat, the newest are skipped
+        :param max_running: int, maximum number of updates handled at once by all chats, not limited if None
+        """
+        self.create_task = create_task
+        self.handle_update = handle_update
+        self.handle_error = handle_error
+        self.max_pending = max_pending
+
+        self._queues = {}
+        self._semaphore = asyncio.Semaphore(max_running) if max_running else None
+
+    def put(self, chat_id: int, update: Any, context: Any) -> None:
+        """Put update to queue of chat, start task if chat has no task yet.
+        Should be called from event loop in order updates came.
+        """
+        queue = self._queues.get(chat_id)
+        if queue is not None:
+            # queue is drained by task already, the task will take the update
+            if len(queue) >= self.max_pending:
+                logger.warning(f'Update of {chat_id} was skipped, {len(queue)} updates of chat are waiting')
+                return
+            queue.append((update, context))
+            return
+
+        queue = deque([(update, context)])
+        self._queues[chat_id] = queue
+        self.create_task(self._drain(chat_id, queue), update=update)
+
+    async def _drain(self, chat_id: int, queue: Deque[Tuple[Any, Any]]) -> None:
+        try:
+            while queue:
+                update, context = queue.popleft()
+                try:
+                    await self._handle(update, context)
+                except Exception as e:
+                    await self.handle_error(update, e)
+        finally:
+            # queue is removed even if task was cancelled, so next update of chat starts new task
+            del self._queues[chat_id]
+
+    async def _handle(self, update: Any, context: Any) -> None:
+        if self._semaphore is None:
+            await self.handle_update(update, context)
+            return
+
+        async with self._semaphore:
+            await self.handle_update(update, context)
@@ -0,0 +1,66 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitBreaker:
+    """
+    This class stop queries to service which fails, so threads don't wait timeouts of dead service.
+    After :failure_threshold: failures in a row circuit is open and queries are rejected at once.
+    After :reset_timeout_seconds: one trial query is allowed, circuit is closed if it succeeds, else opened again.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = 5, reset_timeout_seconds: float = 30):
+        """Init breaker
+        :param name: str, name of service for logs
+        :param failure_threshold: int, number of failures in a row which opens circuit
+        :param reset_timeout_seconds: float, how long circuit is open before trial query
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout_seconds = reset_timeout_seconds
+
+        self.state = CLOSED
+        self.failures_count = 0
+        self.opened_at = 0
+
+        self._lock = threading.Lock()
+
+    def allow_request(self) -> bool:
+        """Check that query can be sent, in half open state only one trial query is allowed."""
+        with self._lock:
+            if self.state == CLOSED:
+                return True
+
+            if self.state == OPEN and time.monotonic() - self.opened_at >= self.reset_timeout_seconds:
+                self.state = HALF_OPEN
+                logger.debug(f'circuit of {self.name} is half open, sending trial query')
+                return True
+
+            return False
+
+    def record_success(self) -> None:
+        with self._lock:
+            if self.state != CLOSED:
+                logger.warning(f'circuit of {self.name} is closed')
+            self.state = CLOSED
+            self.failures_count = 0
+
+    def record_failure(self) -> bool:
+        """Count failure.
+        :return: bool, True if circuit was opened by this failure
+        """
+        with self._lock:
+            self.failures_count += 1
+            if self.state == HALF_OPEN or (self.state == CLOSED and self.failures_count >= self.failure_threshold):
+                self.state = OPEN
+                self.opened_at = time.monotonic()
+                logger.warning(f'circuit of {self.name} is open for {self.reset_timeout_seconds} sec')
+                return True
+            return False
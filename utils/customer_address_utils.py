@@ -0,0 +1,76 @@
+from typing import Dict, Any, Tuple, Optional
+import json
+import logging
+
+import motlin_async_api
+
+logger = logging.getLogger(__name__)
+
+CUSTOMER_ADDRESSES_DB_KEY = 'customer_addresses_index'
+# index was rebuilt recently, addresses saved after it are in index already
+CUSTOMER_ADDRESSES_REBUILT_DB_KEY = 'customer_addresses_index_rebuilt'
+CUSTOMER_ADDRESSES_REBUILD_INTERVAL_SECONDS = 60
+
+
+async def save_customer_address(access_keeper: "motlin_async_api.AsyncAccess", db, config: Dict[str, Any],
+                                customer_id: str, lat: float, lon: float) -> None:
+    """Write customer location to cms and to index of latest customer locations."""
+    customer_addresses_flow_slug = config['customer_addresses_flow_slug']
+    entry = {
+        'data': {
+            'type': 'entry',
+            config['customer_addresses_customer_id_slug']: customer_id,
+            config['customer_addresses_longitude_slug']: float(lon),
+            config['customer_addresses_latitude_slug']: float(lat),
+        }
+    }
+    await motlin_async_api.upload_entry_to_flow(access_keeper, entry, customer_addresses_flow_slug)
+
+    await db.hset(CUSTOMER_ADDRESSES_DB_KEY, customer_id, json.dumps([float(lat), float(lon)]))
+    logger.debug(f'address of customer {customer_id} was saved')
+
+
+async def rebuild_customer_addresses_index(access_keeper: "motlin_async_api.AsyncAccess", db,
+                                           config: Dict[str, Any]) -> int:
+    """Add customers which are missing in index of latest customer locations from all entries of cms flow.
+    Customers which are in index already are not overwritten: their address could be saved during the scan.
+    :return: int, number of customers added to index
+    """
+    logger.debug('rebuilding customer addresses index...')
+    flow_slug = config['customer_addresses_flow_slug']
+    customer_addresses = {}
+    # entries go in order of creation, so the last entry of customer is the latest address
+    async for entry in motlin_async_api.iterate_entries_of_flow(access_keeper, flow_slug, prefetch=True):
+        lat = entry[config['customer_addresses_latitude_slug']]
+        lon = entry[config['customer_addresses_longitude_slug']]
+        customer_addresses[entry[config['customer_addresses_customer_id_slug']]] = json.dumps([lat, lon])
+
+    pipeline = db.pipeline(transaction=False)
+    for customer_id, customer_address in customer_addresses.items():
+        pipeline.hsetnx(CUSTOMER_ADDRESSES_DB_KEY, customer_id, customer_address)
+    added_count = sum(await pipeline.execute())
+    logger.debug(f'customer addresses index was rebuilt, {added_count} customers were added to index')
+
+    return added_count
+
+
+async def get_customer_lat_lon(access_keeper: "motlin_async_api.AsyncAccess", db, config: Dict[str, Any],
+                               customer_id: str) -> Optional[Tuple[float, float]]:
+    """Get latest location of customer from index, rebuild index from cms if customer is not in index.
+    Index is rebuilt not more often than once in :CUSTOMER_ADDRESSES_REBUILD_INTERVAL_SECONDS: by all bot processes,
+    so misses during the interval are answered from index without scan of all entries.
+    """
+    customer_address = await db.hget(CUSTOMER_ADDRESSES_DB_KEY, customer_id)
+    if customer_address is None:
+        logger.warning(f'customer {customer_id} is not in addresses index')
+        is_rebuild_allowed = await db.set(CUSTOMER_ADDRESSES_REBUILT_DB_KEY, 1, nx=True,
+                                          ex=CUSTOMER_ADDRESSES_REBUILD_INTERVAL_SECONDS)
+        if is_rebuild_allowed:
+            await rebuild_customer_addresses_index(access_keeper, db, config)
+            customer_address = await db.hget(CUSTOMER_ADDRESSES_DB_KEY, customer_id)
+
+    if customer_address is None:
+        return None
+
+    lat, lon = json.loads(customer_address)
+    return lat, lon
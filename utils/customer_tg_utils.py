@@ -1,36 +1,81 @@
-from typing import Tuple
+from typing import Tuple, Optional
+import asyncio
 import logging
 
-from telegram.ext.callbackcontext import CallbackContext
-from telegram.update import Update
+from telegram import Update
+from telegram.ext import CallbackContext
 
-import motlin_api
+import motlin_async_api
 
 logger = logging.getLogger(__name__)
 
+CUSTOMER_IDS_DB_KEY = 'customer_ids'
 
-def get_customer_id(context: CallbackContext, update: Update, access_keeper: "motlin_api.Access") -> str:
+
+async def save_customer_id(context: CallbackContext, chat_id: int, customer_id: str) -> None:
+    """Remember customer_id of chat for all bot processes."""
+    context.user_data['customer_id'] = customer_id
+    await context.bot_data['db'].hset(CUSTOMER_IDS_DB_KEY, chat_id, customer_id)
+    logger.debug(f'customer id of {chat_id} was saved')
+
+
+async def find_customer_id(access_keeper: "motlin_async_api.AsyncAccess", db, chat_id: int, customer_email: str,
+                           customer_name: str) -> str:
+    """Get customer_id from redis or from api.
+    Context is not touched, so it can be run as separate task, result is saved by :save_customer_id:.
+    """
+    customer_id = await db.hget(CUSTOMER_IDS_DB_KEY, chat_id)
+    if customer_id is not None:
+        return customer_id.decode('utf-8')
+
+    return await motlin_async_api.get_customer_id_by_name_and_email(access_keeper, customer_email, customer_name)
+
+
+def submit_customer_id_search(context: CallbackContext, update: Update,
+                              access_keeper: "motlin_async_api.AsyncAccess") -> Optional[asyncio.Task]:
+    """Start :find_customer_id: as separate task.
+    :return: asyncio.Task or None if customer_id is already known
+    """
+    if context.user_data.get('customer_id') is not None:
+        return None
+
+    return asyncio.create_task(find_customer_id(access_keeper, context.bot_data['db'], update.effective_chat.id,
+                                                context.user_data.get('email', ''), update.effective_user.username))
+
+
+async def get_customer_id(context: CallbackContext, update: Update,
+                          access_keeper: "motlin_async_api.AsyncAccess") -> str:
     """Get customer_id from cache or from api."""
     customer_id = context.user_data.get('customer_id', None)
     if customer_id is not None:
         return customer_id
 
+    chat_id = update.effective_chat.id
     customer_email = context.user_data.get('email', '')
     customer_name = update.effective_user.username
-    customer_id = motlin_api.get_customer_id_by_name_and_email(access_keeper, customer_email, customer_name)
+    customer_id = await find_customer_id(access_keeper, context.bot_data['db'], chat_id, customer_email,
+                                         customer_name)
+    await save_customer_id(context, chat_id, customer_id)
     return customer_id
 
 
-def get_customer_id_or_waiting_email(context: CallbackContext, update: Update,
-                                     access_keeper: "motlin_api.Access", chat_id: int) -> Tuple[str, str]:
-    """Get customer_id or return WAITING_EMAIL condition if it was error while getting customer id."""
+async def get_customer_id_or_waiting_email(context: CallbackContext, update: Update,
+                                           access_keeper: "motlin_async_api.AsyncAccess", chat_id: int,
+                                           customer_id_task: Optional[asyncio.Task] = None) -> Tuple[str, str]:
+    """Get customer_id or return WAITING_EMAIL condition if it was error while getting customer id.
+    If :customer_id_task: of :submit_customer_id_search: is transferred, customer_id is taken from it.
+    """
     try:
         logger.debug('getting customer id')
-        customer_id = get_customer_id(context, update, access_keeper)
+        if customer_id_task is not None:
+            customer_id = await customer_id_task
+            await save_customer_id(context, chat_id, customer_id)
+        else:
+            customer_id = await get_customer_id(context, update, access_keeper)
         logger.debug('got customer id')
         return customer_id, ''
-    except motlin_api.WrongCustomersNumber:
+    except motlin_async_api.WrongCustomersNumber:
         logger.warning('Can not find user by email')
         msg = 'Что-то пошло не так, пожалуйста, укажите снова свой emaıl'
-        context.bot.send_message(text=msg, chat_id=chat_id)
+        await context.bot.send_message(text=msg, chat_id=chat_id)
         return '', 'WAITING_EMAIL'
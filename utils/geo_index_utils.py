@@ -0,0 +1,160 @@
+from typing import Dict, Any, List, Tuple, Callable, Optional
+import heapq
+import logging
+import math
+
+from geopy import distance
+
+from utils.geo_utils import get_address_entry_lat_lon
+
+logger = logging.getLogger(__name__)
+
+EARTH_RADIUS_KM = 6371.0088
+
+# ellipsoid geodesic distance differs from sphere distance less than 0.6%, so search on sphere takes margin
+SPHERE_ERROR_MARGIN = 1.01
+
+
+class _Node:
+    __slots__ = ('point', 'index', 'axis', 'left', 'right')
+
+    def __init__(self, point, index, axis, left, right):
+        self.point = point
+        self.index = index
+        self.axis = axis
+        self.left = left
+        self.right = right
+
+
+def lat_lon_to_unit_vector(lat: float, lon: float) -> Tuple[float, float, float]:
+    lat_rad = math.radians(float(lat))
+    lon_rad = math.radians(float(lon))
+    return (
+        math.cos(lat_rad) * math.cos(lon_rad),
+        math.cos(lat_rad) * math.sin(lon_rad),
+        math.sin(lat_rad),
+    )
+
+
+def km_to_chord(distance_km: float) -> float:
+    """Convert distance on earth surface to straight line distance between unit vectors."""
+    central_angle = min(distance_km / EARTH_RADIUS_KM, math.pi)
+    return 2 * math.sin(central_angle / 2)
+
+
+class PizzeriaIndex:
+    """
+    This class keep KD-tree of address entries on unit sphere.
+    Tree is built once when addresses are updated, queries look only through few nearest tree nodes
+    and only found candidates are refined with exact geodesic distance.
+    """
+
+    def __init__(self, entries: List[Dict[str, Any]],
+                 get_lat_lon: Callable[[Dict[str, Any]], Tuple[float, float]] = get_address_entry_lat_lon):
+        """Init index
+        :param entries: list of dicts, address entries of flow
+        :param get_lat_lon: function, returns latitude and longitude of entry
+        """
+        self.entries = entries
+        self.lat_lons = [get_lat_lon(entry) for entry in entries]
+        points = [(lat_lon_to_unit_vector(lat, lon), index) for index, (lat, lon) in enumerate(self.lat_lons)]
+        self.root = self._build(points, depth=0)
+        logger.debug(f'index of {len(entries)} addresses was built')
+
+    def __len__(self):
+        return len(self.entries)
+
+    def nearest(self, lat: float, lon: float, k: int = 1) -> List[Tuple[Dict[str, Any], float]]:
+        """Find :k: nearest entries.
+        :param lat: float, latitude of point
+        :param lon: float, longitude of point
+        :param k: int, number of entries
+        :return: list of tuples, entry and geodesic distance in km, sorted by distance
+        """
+        # few extra candidates because order on sphere can slightly differ from order on ellipsoid
+        candidates_count = k + 3
+        target = lat_lon_to_unit_vector(lat, lon)
+        heap = []
+        self._search_nearest(self.root, target, candidates_count, heap)
+        candidates = [index for _, index in heap]
+
+        return self._refine(candidates, lat, lon)[:k]
+
+    def within_radius(self, lat: float, lon: float, radius_km: float) -> List[Tuple[Dict[str, Any], float]]:
+        """Find all entries not further than :radius_km:.
+        :param lat: float, latitude of point
+        :param lon: float, longitude of point
+        :param radius_km: float, radius of search in km
+        :return: list of tuples, entry and geodesic distance in km, sorted by distance
+        """
+        target = lat_lon_to_unit_vector(lat, lon)
+        max_chord = km_to_chord(radius_km * SPHERE_ERROR_MARGIN)
+        candidates = []
+        self._search_radius(self.root, target, max_chord ** 2, candidates)
+
+        return [
+            (entry, distance_km) for entry, distance_km in self._refine(candidates, lat, lon)
+            if distance_km <= radius_km
+        ]
+
+    def _refine(self, candidates: List[int], lat: float, lon: float) -> List[Tuple[Dict[str, Any], float]]:
+        refined = [
+            (self.entries[index], distance.distance(self.lat_lons[index], (float(lat), float(lon))).km)
+            for index in candidates
+        ]
+        return sorted(refined, key=lambda entry_distance: entry_distance[1])
+
+    def _build(self, points: List[Tuple[Tuple[float, float, float], int]], depth: int) -> Optional[_Node]:
+        if not points:
+            return None
+
+        axis = depth % 3
+        points.sort(key=lambda point: point[0][axis])
+        median = len(points) // 2
+        point, index = points[median]
+
+        return _Node(
+            point,
+            index,
+            axis,
+            self._build(points[:median], depth + 1),
+            self._build(points[median + 1:], depth + 1),
+        )
+
+    @staticmethod
+    def _squared_distance(a: Tuple[float, float, float], b: Tuple[float, float, float]) -> float:
+        return (a[0] - b[0]) ** 2 + (a[1] - b[1]) ** 2 + (a[2] - b[2]) ** 2
+
+    def _search_nearest(self, node: Optional[_Node], target: Tuple[float, float, float], k: int,
+                        heap: List[Tuple[float, int]]) -> None:
+        """Keep :k: nearest nodes in :heap: as max-heap of negative squared distances."""
+        if node is None:
+            return
+
+        squared_distance = self._squared_distance(node.point, target)
+        if len(heap) < k:
+            heapq.heappush(heap, (-squared_distance, node.index))
+        elif squared_distance < -heap[0][0]:
+            heapq.heapreplace(heap, (-squared_distance, node.index))
+
+        axis_difference = target[node.axis] - node.point[node.axis]
+        near, far = (node.left, node.right) if axis_difference < 0 else (node.right, node.left)
+
+        self._search_nearest(near, target, k, heap)
+        if len(heap) < k or axis_difference ** 2 < -heap[0][0]:
+            self._search_nearest(far, target, k, heap)
+
+    def _search_radius(self, node: Optional[_Node], target: Tuple[float, float, float], max_squared_distance: float,
+                       found: List[int]) -> None:
+        if node is None:
+            return
+
+        if self._squared_distance(node.point, target) <= max_squared_distance:
+            found.append(node.index)
+
+        axis_difference = target[node.axis] - node.point[node.axis]
+        near, far = (node.left, node.right) if axis_difference < 0 else (node.right, node.left)
+
+        self._search_radius(near, target, max_squared_distance, found)
+        if axis_difference ** 2 <= max_squared_distance:
+            self._search_radius(far, target, max_squared_distance, found)
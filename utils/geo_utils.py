@@ -1,19 +1,48 @@
+from collections import OrderedDict
 from typing import Dict, Any, Tuple, Optional
+import json
 import logging
+import re
 
-import requests
+import httpx
+
+from utils import metrics_utils
 
 logger = logging.getLogger(__name__)
 
+# https://dvmn.org/encyclopedia/api-docs/yandex-geocoder-api/
+GEOCODER_URL = "https://geocode-maps.yandex.ru/1.x"
+GEOCODER_CONNECT_TIMEOUT_SECONDS = 3.05
+
+
+def create_geocoder_session(pool_size: int = 10) -> httpx.AsyncClient:
+    """Create pooled keep-alive asyncio client of geocoder, so every query doesn't cost TCP+TLS handshake.
+    Failed connection is retried once, timed out reading is not retried.
+    :param pool_size: int, maximum number of kept alive connections, connections over it are closed after query
+    """
+    transport = httpx.AsyncHTTPTransport(
+        retries=1,
+        limits=httpx.Limits(max_connections=None, max_keepalive_connections=pool_size),
+    )
+    return httpx.AsyncClient(transport=transport)
 
-def fetch_coordinates(apikey: str, address: str) -> Optional[Tuple[float, float]]:
-    # https://dvmn.org/encyclopedia/api-docs/yandex-geocoder-api/
-    base_url = "https://geocode-maps.yandex.ru/1.x"
-    response = requests.get(base_url, params={
-        "geocode": address,
-        "apikey": apikey,
-        "format": "json",
-    })
+
+async def fetch_coordinates(apikey: str, address: str, session: httpx.AsyncClient, base_url: str = GEOCODER_URL,
+                            timeout: Tuple[float, float] = (GEOCODER_CONNECT_TIMEOUT_SECONDS, 5)
+                            ) -> Optional[Tuple[float, float]]:
+    """Find coordinates of address by yandex geocoder.
+    :param session: httpx.AsyncClient, pooled client, see :create_geocoder_session:
+    :param timeout: tuple, seconds to wait connection and response, handler never waits geocoder longer
+    :return: tuple, longitude and latitude, None if address was not found
+    """
+    connect_timeout, read_timeout = timeout
+    with metrics_utils.registry.timer('geocoder_request_duration_seconds'):
+        response = await session.get(base_url, params={
+            "geocode": address,
+            "apikey": apikey,
+            "format": "json",
+        }, timeout=httpx.Timeout(read_timeout, connect=connect_timeout))
+    metrics_utils.registry.increment('geocoder_responses_total', status=response.status_code)
     response.raise_for_status()
     found_places = response.json()['response']['GeoObjectCollection']['featureMember']
 
@@ -25,6 +54,93 @@ def fetch_coordinates(apikey: str, address: str) -> Optional[Tuple[float, float]
     return lon, lat
 
 
+def normalize_address(address: str) -> str:
+    """Make the same key for addresses which differ only in case, spaces and punctuation."""
+    address = address.lower().replace('ё', 'е')
+    address = re.sub(r'[^\w]+', ' ', address)
+    return ' '.join(address.split())
+
+
+class GeocodeCache:
+    """
+    This class keep coordinates of addresses which were already found by geocoder.
+    Recently used addresses are kept in memory, other addresses are evicted.
+    If Redis is transferred, coordinates are also kept in Redis for :ttl_seconds:.
+    Not found addresses are cached too, so the same wrong address does not go to geocoder again.
+    """
+
+    def __init__(self, apikey: str, max_size: int = 10000, db=None, ttl_seconds: int = 30 * 24 * 60 * 60,
+                 db_key_prefix: str = 'geocode', geocoder_url: str = GEOCODER_URL, timeout: float = 5,
+                 pool_size: int = 10):
+        """Init cache
+        :param apikey: str, yandex geocoder API key
+        :param max_size: int, maximum number of addresses in memory
+        :param db: object, asyncio Redis instance to keep coordinates between restarts (not kept if not transfer)
+        :param ttl_seconds: int, how many seconds coordinates are kept in Redis
+        :param db_key_prefix: str, prefix of Redis keys
+        :param geocoder_url: str, url of geocoder API
+        :param timeout: float, seconds to wait geocoder response, connection is waited not more than
+            GEOCODER_CONNECT_TIMEOUT_SECONDS
+        :param pool_size: int, maximum number of kept alive connections to geocoder
+        """
+        self.apikey = apikey
+        self.max_size = max_size
+        self.db = db
+        self.ttl_seconds = ttl_seconds
+        self.db_key_prefix = db_key_prefix
+        self.geocoder_url = geocoder_url
+        self.timeout = (min(GEOCODER_CONNECT_TIMEOUT_SECONDS, timeout), timeout)
+        self.session = create_geocoder_session(pool_size)
+
+        self._coordinates = OrderedDict()
+
+    async def fetch_coordinates(self, address: str) -> Optional[Tuple[float, float]]:
+        """Get coordinates from cache or from geocoder, the same as :fetch_coordinates: function."""
+        address_key = normalize_address(address)
+        if not address_key:
+            return None
+
+        if address_key in self._coordinates:
+            self._coordinates.move_to_end(address_key)
+            logger.debug('coordinates were taken from memory')
+            return self._coordinates[address_key]
+
+        found, coordinates = await self._load_shared_coordinates(address_key)
+        if not found:
+            coordinates = await fetch_coordinates(self.apikey, address, self.session, self.geocoder_url, self.timeout)
+            await self._save_shared_coordinates(address_key, coordinates)
+
+        self._coordinates[address_key] = coordinates
+        self._coordinates.move_to_end(address_key)
+        if len(self._coordinates) > self.max_size:
+            self._coordinates.popitem(last=False)
+
+        return coordinates
+
+    async def close(self) -> None:
+        await self.session.aclose()
+
+    async def _load_shared_coordinates(self, address_key: str) -> Tuple[bool, Optional[Tuple[float, float]]]:
+        if self.db is None:
+            return False, None
+
+        shared_coordinates = await self.db.get(f'{self.db_key_prefix}:{address_key}')
+        if shared_coordinates is None:
+            return False, None
+
+        logger.debug('coordinates were taken from redis')
+        coordinates = json.loads(shared_coordinates)
+        if coordinates is None:
+            return True, None
+        return True, tuple(coordinates)
+
+    async def _save_shared_coordinates(self, address_key: str, coordinates: Optional[Tuple[float, float]]) -> None:
+        if self.db is None:
+            return
+
+        await self.db.set(f'{self.db_key_prefix}:{address_key}', json.dumps(coordinates), ex=self.ttl_seconds)
+
+
 def get_address_entry_lat_lon(entry: Dict[str, Any]) -> Tuple[float, float]:
     return entry['pizzeria-addresses-latitude'], entry['pizzeria-addresses-longitude']
 
@@ -0,0 +1,43 @@
+import asyncio
+import logging
+
+from redis.exceptions import RedisError
+
+from utils.async_utils import wait_event
+
+logger = logging.getLogger(__name__)
+
+
+class LockKeeper:
+    """
+    This class extend redis lock while code under the lock works, so the lock expires only if bot process dies.
+    Lock timeout is reset every :timeout/3: seconds by background task, the task stops on exit from context.
+    """
+
+    def __init__(self, lock):
+        """Init keeper
+        :param lock: redis.asyncio.lock.Lock, acquired lock with timeout
+        """
+        self.lock = lock
+        self.interval_seconds = lock.timeout / 3
+
+        self._stopped = asyncio.Event()
+        self._task = None
+
+    async def __aenter__(self) -> 'LockKeeper':
+        self._task = asyncio.create_task(self._keep(), name=f'lock-keeper-{self.lock.name}')
+        return self
+
+    async def __aexit__(self, *exc_info) -> None:
+        # task is not cancelled, so query to redis is never interrupted in the middle
+        self._stopped.set()
+        await self._task
+
+    async def _keep(self) -> None:
+        while not await wait_event(self._stopped, self.interval_seconds):
+            try:
+                await self.lock.reacquire()
+            except RedisError:
+                # LockError is RedisError too, lock is lost, so there is nothing to keep
+                logger.warning(f'Lock {self.lock.name} was not extended')
+                return
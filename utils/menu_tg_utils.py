@@ -0,0 +1,92 @@
+from typing import Dict, Any, List
+import logging
+import math
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from utils.catalog_utils import CatalogCache
+
+logger = logging.getLogger(__name__)
+
+
+class MenuPages:
+    """
+    This class keep buttons of all menu pages built from catalog.
+    Pages are rebuilt only when catalog version changes, for user only products in cart are decorated.
+    """
+
+    def __init__(self, catalog_cache: CatalogCache, products_on_page: int):
+        """Init pages
+        :param catalog_cache: object, CatalogCache class instance
+        :param products_on_page: int, maximum number of products on page
+        """
+        self.catalog_cache = catalog_cache
+        self.products_on_page = products_on_page
+
+        self.pages = []
+        self.catalog_version = None
+
+    async def get_keyboard(self, page_number: int, products_in_cart: Dict[str, Dict[str, Any]]) -> InlineKeyboardMarkup:
+        """Build keyboard of menu page.
+        :param page_number: int, number of page from 1
+        :param products_in_cart: dict, key is product id and value is cart item with 'quantity'
+        :return: InlineKeyboardMarkup, menu keyboard
+        """
+        pages = await self._get_pages()
+        page = pages[min(max(page_number, 1), len(pages)) - 1]
+
+        keyboard = []
+        for product_button in page['product_buttons']:
+            product_in_cart = products_in_cart.get(product_button.callback_data)
+            if product_in_cart:
+                msg = f'{product_button.text} ({product_in_cart["quantity"]} шт. в корзине)'
+                product_button = InlineKeyboardButton(msg, callback_data=product_button.callback_data)
+            keyboard.append([product_button])
+
+        keyboard.extend(page['other_buttons'])
+
+        return InlineKeyboardMarkup(keyboard)
+
+    async def _get_pages(self) -> List[Dict[str, Any]]:
+        products, catalog_version = await self.catalog_cache.get_products_with_version()
+        if catalog_version == self.catalog_version:
+            return self.pages
+
+        # pages are built without await, so other task can't build them at the same time
+        self.pages = self._build_pages(products)
+        self.catalog_version = catalog_version
+        logger.debug(f'{len(self.pages)} menu pages were built, catalog version: {catalog_version}')
+
+        return self.pages
+
+    def _build_pages(self, products: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        first_page_number = 1
+        pages_count = max(math.ceil(len(products) / self.products_on_page), first_page_number)
+        last_page_number = pages_count
+        has_other_pages = pages_count > 1
+
+        pages = []
+        for page_number in range(first_page_number, last_page_number + 1):
+            start_product_index = (page_number - 1) * self.products_on_page
+            end_product_index = page_number * self.products_on_page
+            product_buttons = [
+                InlineKeyboardButton(product['name'], callback_data=product['id'])
+                for product in products[start_product_index:end_product_index]
+            ]
+
+            next_page_button = InlineKeyboardButton('>>', callback_data=f'page-{page_number + 1}')
+            prev_page_button = InlineKeyboardButton('<<', callback_data=f'page-{page_number - 1}')
+
+            other_buttons = []
+            if page_number == first_page_number and has_other_pages:
+                other_buttons.append([next_page_button])
+            elif page_number == last_page_number and has_other_pages:
+                other_buttons.append([prev_page_button])
+            elif has_other_pages:
+                other_buttons.append([prev_page_button, next_page_button])
+
+            other_buttons.append([InlineKeyboardButton('Корзина', callback_data='cart')])
+
+            pages.append({'product_buttons': product_buttons, 'other_buttons': other_buttons})
+
+        return pages
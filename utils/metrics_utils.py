@@ -0,0 +1,162 @@
+from contextlib import contextmanager
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Tuple
+import bisect
+import logging
+import os
+import threading
+import time
+
+from redis.asyncio import Redis
+from redis.asyncio.client import Pipeline
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class MetricsRegistry:
+    """
+    This class keep counters and histograms of durations in memory and render them in Prometheus text format.
+    Metric is identified by name and labels, for example name 'motlin_call_duration_seconds'
+    and labels {'function': 'get_all_products'}.
+    """
+
+    def __init__(self, buckets: Tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counters = {}
+        self.histograms = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _get_labels_key(labels: Dict[str, object]) -> Tuple[Tuple[str, str], ...]:
+        return tuple(sorted((label_name, str(label_value)) for label_name, label_value in labels.items()))
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = (name, self._get_labels_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, self._get_labels_key(labels))
+        bucket_index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = {'buckets': [0] * (len(self.buckets) + 1), 'sum': 0, 'count': 0}
+                self.histograms[key] = histogram
+            histogram['buckets'][bucket_index] += 1
+            histogram['sum'] += value
+            histogram['count'] += 1
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        """Observe duration of code block in seconds."""
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started_at, **labels)
+
+    @staticmethod
+    def _format_labels(labels_key: Tuple[Tuple[str, str], ...], **extra_labels) -> str:
+        labels = list(labels_key) + list(extra_labels.items())
+        if not labels:
+            return ''
+        formatted_labels = ','.join(
+            f'{label_name}="{label_value}"'.replace('\n', ' ') for label_name, label_value in labels
+        )
+        return f'{{{formatted_labels}}}'
+
+    def render(self) -> str:
+        """Render all metrics in Prometheus text format."""
+        with self._lock:
+            counters = dict(self.counters)
+            histograms = {
+                key: {'buckets': list(histogram['buckets']), 'sum': histogram['sum'], 'count': histogram['count']}
+                for key, histogram in self.histograms.items()
+            }
+
+        lines = []
+        typed_names = set()
+        for (name, labels_key), value in sorted(counters.items()):
+            if name not in typed_names:
+                lines.append(f'# TYPE {name} counter')
+                typed_names.add(name)
+            lines.append(f'{name}{self._format_labels(labels_key)} {value}')
+
+        for (name, labels_key), histogram in sorted(histograms.items()):
+            if name not in typed_names:
+                lines.append(f'# TYPE {name} histogram')
+                typed_names.add(name)
+            cumulative_count = 0
+            for bucket, bucket_count in zip(self.buckets + ('+Inf',), histogram['buckets']):
+                cumulative_count += bucket_count
+                lines.append(f'{name}_bucket{self._format_labels(labels_key, le=bucket)} {cumulative_count}')
+            lines.append(f'{name}_sum{self._format_labels(labels_key)} {histogram["sum"]}')
+            lines.append(f'{name}_count{self._format_labels(labels_key)} {histogram["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+
+registry = MetricsRegistry()
+
+
+def start_http_server(port: int, listen: str = '0.0.0.0') -> ThreadingHTTPServer:
+    """Start daemon thread which returns metrics on GET /metrics."""
+    class MetricsRequestHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(HTTPStatus.NOT_FOUND)
+                return
+
+            body = registry.render().encode('utf-8')
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    httpd = ThreadingHTTPServer((listen, port), MetricsRequestHandler)
+    httpd.daemon_threads = True
+    thread = threading.Thread(target=httpd.serve_forever, name='metrics', daemon=True)
+    thread.start()
+    logger.debug(f'metrics are served on {listen}:{port}/metrics')
+
+    return httpd
+
+
+def start_file_writer(path: str, interval_seconds: float = 15) -> None:
+    """Start daemon thread which rewrites file with metrics every :interval_seconds:."""
+    def write_metrics():
+        while True:
+            time.sleep(interval_seconds)
+            tmp_path = f'{path}.tmp'
+            with open(tmp_path, 'w') as f:
+                f.write(registry.render())
+            os.replace(tmp_path, path)
+
+    thread = threading.Thread(target=write_metrics, name='metrics-file', daemon=True)
+    thread.start()
+    logger.debug(f'metrics are written to {path} every {interval_seconds} sec')
+
+
+class InstrumentedPipeline(Pipeline):
+    async def execute(self, raise_on_error=True):
+        with registry.timer('redis_command_duration_seconds', command='PIPELINE'):
+            return await super().execute(raise_on_error)
+
+
+class InstrumentedRedis(Redis):
+    """Asyncio Redis client which observes duration of every command."""
+
+    async def execute_command(self, *args, **options):
+        with registry.timer('redis_command_duration_seconds', command=str(args[0]).split(' ')[0].upper()):
+            return await super().execute_command(*args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return InstrumentedPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
@@ -0,0 +1,65 @@
+from typing import Dict, Any, Optional, Callable, Awaitable
+import json
+import logging
+import uuid
+
+logger = logging.getLogger(__name__)
+
+
+def get_pending_order_key(payload: str) -> str:
+    return f'pending_order:{payload}'
+
+
+async def create_pending_order(db, order: Dict[str, Any], ttl_seconds: int) -> str:
+    """Save order which waits payment.
+    :param db: object, Redis instance
+    :param order: dict, order data (type, chat_id, amount, etc...), should be JSON serializable
+    :param ttl_seconds: int, how long order waits payment
+    :return: str, invoice payload, order can be found by it after payment
+    """
+    order_id = uuid.uuid4().hex
+    payload = f'order:{order_id}'
+    order = dict(order, order_id=order_id)
+    await db.set(get_pending_order_key(payload), json.dumps(order), ex=ttl_seconds)
+    logger.debug(f'pending order {order_id} was created')
+
+    return payload
+
+
+async def get_pending_order(db, payload: str) -> Optional[Dict[str, Any]]:
+    """Get order which waits payment by invoice payload."""
+    order = await db.get(get_pending_order_key(payload))
+    if order is None:
+        return None
+    return json.loads(order)
+
+
+async def delete_pending_order(db, payload: str) -> None:
+    """Delete order which was paid, it should be handed to scheduler before."""
+    await db.delete(get_pending_order_key(payload))
+
+
+def get_completed_steps_key(order_id: str) -> str:
+    return f'order_completed_steps:{order_id}'
+
+
+async def run_order_step(db, order_id: str, step: str, func: Callable[[], Awaitable[Any]],
+                         ttl_seconds: int = 24 * 60 * 60) -> None:
+    """Run step of paid order completion once, so retry of failed completion doesn't repeat done steps.
+    :param db: object, Redis instance
+    :param order_id: str, id of order
+    :param step: str, name of step, for example 'deliveryman_message'
+    :param func: coroutine function without params which does the step
+    :param ttl_seconds: int, how long done steps of order are remembered
+    """
+    completed_steps_key = get_completed_steps_key(order_id)
+    if await db.sismember(completed_steps_key, step):
+        logger.debug(f'step {step} of order {order_id} was done before, skipped')
+        return
+
+    await func()
+
+    pipe = db.pipeline(transaction=True)
+    pipe.sadd(completed_steps_key, step)
+    pipe.expire(completed_steps_key, ttl_seconds)
+    await pipe.execute()
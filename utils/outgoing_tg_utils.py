@@ -0,0 +1,206 @@
+from collections import OrderedDict
+from typing import Callable, Coroutine, Optional, Any, Dict, List
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from utils import metrics_utils
+from utils.async_utils import wait_event
+from utils.rate_limit_utils import TokenBucket
+
+logger = logging.getLogger(__name__)
+
+# requests with less priority are sent first
+PRIORITY_HIGH = 0  # payments and deliveryman notifications
+PRIORITY_NORMAL = 1  # answers to user
+PRIORITY_LOW = 2  # feedback and promotional messages
+
+# endpoints which are sent through queue and their default priority, other requests are sent at once
+QUEUED_ENDPOINTS = {
+    'sendMessage': PRIORITY_NORMAL,
+    'sendPhoto': PRIORITY_NORMAL,
+    'sendLocation': PRIORITY_NORMAL,
+    'sendInvoice': PRIORITY_HIGH,
+    'deleteMessage': PRIORITY_NORMAL,
+}
+# deleting is not a new message for chat, so only global limit is applied
+NOT_CHAT_LIMITED_ENDPOINTS = {'deleteMessage'}
+
+
+class _OutgoingRequest:
+    __slots__ = ('func', 'chat_id', 'priority', 'is_chat_limited', 'sequence', 'future', 'retries', 'queued_at')
+
+    def __init__(self, func, chat_id, priority, is_chat_limited, sequence, future):
+        self.func = func
+        self.chat_id = chat_id
+        self.priority = priority
+        self.is_chat_limited = is_chat_limited
+        self.sequence = sequence
+        self.future = future
+        self.retries = 0
+        self.queued_at = time.monotonic()
+
+
+class OutgoingQueue(BaseRateLimiter):
+    """
+    This class send requests to telegram not faster than telegram allows, it's rate limiter of PTB Application.
+    All queued requests pass global token bucket and messages also pass token bucket of their chat.
+    Request of chat which exhausted its bucket is put aside until the bucket refills, so other chats are not blocked.
+    Ready requests are sent by priority and then in order they came. Request is put aside again on RetryAfter.
+    Priority of request is transferred as :rate_limit_args: of bot method, for example
+    bot.send_message(..., rate_limit_args=PRIORITY_HIGH).
+    """
+
+    def __init__(self, global_rate: float = 30, chat_rate: float = 1, chat_burst: float = 3, max_retries: int = 5,
+                 max_chats: int = 10000, workers: int = 8):
+        """Init queue
+        :param global_rate: float, requests per second to telegram from bot
+        :param chat_rate: float, messages per second to one chat
+        :param chat_burst: float, how many messages can be sent to one chat at once
+        :param max_retries: int, how many times request is retried on RetryAfter
+        :param max_chats: int, maximum number of chat buckets in memory, the least recently used are evicted
+        :param workers: int, number of sender tasks, they are started with bot
+        """
+        self.global_bucket = TokenBucket(global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        self.workers = workers
+
+        self._ready = []  # heap of (priority, sequence, request)
+        self._delayed = []  # heap of (not_before, priority, sequence, request)
+        self._sequence = itertools.count()
+        self._changed: Optional[asyncio.Event] = None
+        self._stopped = False
+        self._senders: List[asyncio.Task] = []
+
+        self._chat_buckets = OrderedDict()
+
+    async def initialize(self) -> None:
+        """Start sender tasks, it's called by Bot.initialize."""
+        self._changed = asyncio.Event()
+        self._stopped = False
+        for worker_number in range(self.workers):
+            self._senders.append(asyncio.create_task(self._send_requests(), name=f'tg-sender-{worker_number}'))
+        logger.debug(f'{self.workers} telegram senders were started')
+
+    async def shutdown(self) -> None:
+        """Stop sender tasks, it's called by Bot.shutdown."""
+        if self._changed is None:
+            return
+
+        self._stopped = True
+        self._changed.set()
+        await asyncio.gather(*self._senders)
+        self._senders = []
+
+    async def process_request(self, callback: Callable[..., Coroutine[Any, Any, Any]], args: Any,
+                              kwargs: Dict[str, Any], endpoint: str, data: Dict[str, Any],
+                              rate_limit_args: Optional[int]) -> Any:
+        """Put request to queue if it's message and wait its result, other requests are sent at once."""
+        if endpoint not in QUEUED_ENDPOINTS:
+            return await callback(*args, **kwargs)
+
+        priority = rate_limit_args if rate_limit_args is not None else QUEUED_ENDPOINTS[endpoint]
+        future = self.submit(lambda: callback(*args, **kwargs), data.get('chat_id'), priority,
+                             is_chat_limited=endpoint not in NOT_CHAT_LIMITED_ENDPOINTS)
+        return await future
+
+    def submit(self, func: Callable[[], Coroutine[Any, Any, Any]], chat_id: Optional[int] = None,
+               priority: int = PRIORITY_NORMAL, is_chat_limited: bool = True) -> asyncio.Future:
+        """Put request to queue.
+        :param func: function without params which returns coroutine sending request to telegram
+        :param chat_id: int, chat of request, None if request is not addressed to chat
+        :param priority: int, PRIORITY_HIGH, PRIORITY_NORMAL or PRIORITY_LOW
+        :param is_chat_limited: bool, should request pass token bucket of chat
+        :return: asyncio.Future, result of :func:
+        """
+        future = asyncio.get_running_loop().create_future()
+        request = _OutgoingRequest(func, chat_id, priority, is_chat_limited, next(self._sequence), future)
+        heapq.heappush(self._ready, (request.priority, request.sequence, request))
+        self._changed.set()
+        return future
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def _take_request(self) -> Optional[_OutgoingRequest]:
+        while not self._stopped:
+            now = time.monotonic()
+            while self._delayed and self._delayed[0][0] <= now:
+                _, priority, sequence, request = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (priority, sequence, request))
+
+            if self._ready:
+                return heapq.heappop(self._ready)[-1]
+
+            self._changed.clear()
+            if self._delayed:
+                await wait_event(self._changed, self._delayed[0][0] - now)
+            else:
+                await self._changed.wait()
+
+        return None
+
+    def _delay(self, request: _OutgoingRequest, seconds: float) -> None:
+        not_before = time.monotonic() + seconds
+        heapq.heappush(self._delayed, (not_before, request.priority, request.sequence, request))
+        # sleeping sender should recompute time to wait
+        self._changed.set()
+
+    async def _send_requests(self) -> None:
+        while True:
+            request = await self._take_request()
+            if request is None:
+                return
+
+            if request.chat_id is not None and request.is_chat_limited:
+                seconds_to_wait = self._get_chat_bucket(request.chat_id).try_acquire()
+                if seconds_to_wait:
+                    self._delay(request, seconds_to_wait)
+                    continue
+
+            seconds_to_wait = self.global_bucket.try_acquire()
+            while seconds_to_wait:
+                await asyncio.sleep(seconds_to_wait)
+                seconds_to_wait = self.global_bucket.try_acquire()
+            await self._send(request)
+
+    async def _send(self, request: _OutgoingRequest) -> None:
+        metrics_utils.registry.observe('tg_outgoing_queue_wait_seconds', time.monotonic() - request.queued_at,
+                                       priority=request.priority)
+        try:
+            result = await request.func()
+        except RetryAfter as e:
+            metrics_utils.registry.increment('tg_retry_after_total')
+            if request.retries < self.max_retries:
+                request.retries += 1
+                logger.warning(f'telegram asked to retry after {e.retry_after} sec, chat: {request.chat_id}')
+                self._delay(request, e.retry_after)
+                return
+            _set_exception(request.future, e)
+        except Exception as e:
+            _set_exception(request.future, e)
+        else:
+            if not request.future.done():
+                request.future.set_result(result)
+
+
+def _set_exception(future: asyncio.Future, error: Exception) -> None:
+    # handler could be cancelled while request waited in queue
+    if not future.done():
+        future.set_exception(error)
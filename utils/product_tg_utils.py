@@ -0,0 +1,61 @@
+import logging
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest
+from telegram.ext import CallbackContext
+
+import motlin_async_api
+
+logger = logging.getLogger(__name__)
+
+TG_FILE_IDS_DB_KEY = 'product_image_tg_file_ids'
+IMAGE_HREFS_DB_KEY = 'product_image_hrefs'
+
+
+async def get_image_href(context: CallbackContext, image_id: str) -> str:
+    """Get href of product image from cache or from api."""
+    image_hrefs = context.bot_data.setdefault('product_image_hrefs', {})
+    image_href = image_hrefs.get(image_id)
+    if image_href is not None:
+        return image_href
+
+    db = context.bot_data['db']
+    image_href = await db.hget(IMAGE_HREFS_DB_KEY, image_id)
+    if image_href is not None:
+        image_href = image_href.decode('utf-8')
+    else:
+        image_href = await motlin_async_api.get_file_href_by_id(context.bot_data['access_keeper'], image_id)
+        await db.hset(IMAGE_HREFS_DB_KEY, image_id, image_href)
+
+    image_hrefs[image_id] = image_href
+    return image_href
+
+
+async def has_tg_file_id(db, image_id: str) -> bool:
+    """Check that image was sent before, so it can be sent by telegram file_id without href."""
+    return bool(await db.hexists(TG_FILE_IDS_DB_KEY, image_id))
+
+
+async def send_product_photo(context: CallbackContext, chat_id: int, image_id: str, caption: str,
+                       reply_markup: InlineKeyboardMarkup, image_href: str = None) -> None:
+    """Send product image by telegram file_id if image was sent before, else by href and remember file_id."""
+    bot = context.bot
+    db = context.bot_data['db']
+
+    tg_file_id = await db.hget(TG_FILE_IDS_DB_KEY, image_id)
+    if tg_file_id is not None:
+        try:
+            await bot.send_photo(chat_id=chat_id, photo=tg_file_id.decode('utf-8'), caption=caption,
+                                 reply_markup=reply_markup)
+            logger.debug(f'image {image_id} was sent by telegram file_id')
+            return
+        except BadRequest:
+            logger.warning(f'telegram file_id of image {image_id} is not valid anymore')
+            await db.hdel(TG_FILE_IDS_DB_KEY, image_id)
+
+    if image_href is None:
+        image_href = await get_image_href(context, image_id)
+    message = await bot.send_photo(chat_id=chat_id, photo=image_href, caption=caption, reply_markup=reply_markup)
+    # the biggest size is the last one, telegram will send it by file_id as is
+    await db.hset(TG_FILE_IDS_DB_KEY, image_id, message.photo[-1].file_id)
+    logger.debug(f'image {image_id} was sent by href, telegram file_id was saved')
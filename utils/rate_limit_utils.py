@@ -0,0 +1,45 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    This class limit rate of actions from many threads.
+    Bucket gets :rate: tokens per second up to :capacity:, every action takes token or waits for it.
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """Init bucket
+        :param rate: float, tokens per second
+        :param capacity: float, maximum tokens in bucket (burst size), equal to :rate: if not transferred
+        """
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def try_acquire(self, tokens: float = 1) -> float:
+        """Take tokens if bucket has them.
+        :return: float, 0 if tokens were taken, else seconds to wait until bucket will have them
+        """
+        with self._lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Take tokens, wait if bucket has not enough tokens."""
+        while True:
+            seconds_to_wait = self.try_acquire(tokens)
+            if not seconds_to_wait:
+                return
+            time.sleep(seconds_to_wait)
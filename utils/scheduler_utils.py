@@ -0,0 +1,244 @@
+from typing import Dict, Any, Callable, Optional, List
+import asyncio
+import json
+import logging
+import time
+import uuid
+
+from redis.exceptions import LockError, RedisError
+
+from utils.async_utils import wait_event
+from utils.lock_utils import LockKeeper
+
+logger = logging.getLogger(__name__)
+
+# moves jobs with expired lease back to schedule, then takes due jobs to processing with new lease of the worker
+CLAIM_JOBS_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[2], '-inf', ARGV[1])
+for _, job_id in ipairs(expired) do
+    redis.call('ZREM', KEYS[2], job_id)
+    redis.call('HDEL', KEYS[3], job_id)
+    redis.call('ZADD', KEYS[1], ARGV[1], job_id)
+end
+local job_ids = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[3])
+for _, job_id in ipairs(job_ids) do
+    redis.call('ZREM', KEYS[1], job_id)
+    redis.call('ZADD', KEYS[2], ARGV[2], job_id)
+    redis.call('HSET', KEYS[3], job_id, ARGV[4])
+end
+return job_ids
+"""
+
+# lease is extended only by the worker which holds it
+EXTEND_LEASE_SCRIPT = """
+if redis.call('HGET', KEYS[2], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZADD', KEYS[1], 'XX', ARGV[3], ARGV[1])
+return 1
+"""
+
+# job is done (or moved to dead letter hash if ARGV[3] is job) only by the worker which holds its lease
+FINISH_JOB_SCRIPT = """
+if redis.call('HGET', KEYS[4], ARGV[1]) ~= ARGV[2] then
+    return 0
+end
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+redis.call('HDEL', KEYS[3], ARGV[1])
+redis.call('HDEL', KEYS[4], ARGV[1])
+if ARGV[3] ~= '' then
+    redis.call('HSET', KEYS[6], ARGV[1], ARGV[3])
+else
+    redis.call('SET', KEYS[5], 1, 'EX', ARGV[4])
+end
+return 1
+"""
+
+# job is not scheduled if job with the same id is waiting or was done recently
+SCHEDULE_JOB_SCRIPT = """
+if redis.call('EXISTS', KEYS[3]) == 1 then
+    return 0
+end
+if redis.call('HSETNX', KEYS[2], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[3], ARGV[1])
+return 1
+"""
+
+
+class DelayedJobScheduler:
+    """
+    This class keep delayed jobs in Redis, so jobs survive restarts and can be run by any bot process.
+    Jobs wait in sorted set by time of run. Worker takes due jobs one by one with lease which is extended while
+    job runs. If worker dies before job is done, job is run again after lease expires, so every job is run at least
+    once. Job is done only by the worker which holds its lease, so slow worker doesn't finish job of other worker.
+    Job which failed :max_attempts: times is moved to dead letter hash, so broken job is not retried forever.
+    Job id works as dedup key: the same job is not scheduled twice.
+    """
+
+    def __init__(self, db, bot, job_handlers: Dict[str, Callable], poll_interval_seconds: float = 1,
+                 lease_seconds: int = 60, batch_size: int = 10, done_ttl_seconds: int = 24 * 60 * 60,
+                 max_attempts: int = 5, db_key_prefix: str = 'scheduled_jobs'):
+        """Init scheduler
+        :param db: object, asyncio Redis instance
+        :param bot: object, telegram Bot instance, it's transferred to job handlers
+        :param job_handlers: dict, key is type of job and value is coroutine function (bot, **job_params)
+        :param poll_interval_seconds: float, how often worker checks due jobs
+        :param lease_seconds: int, job is run again if worker did not extend lease during this time
+        :param batch_size: int, maximum number of jobs run by worker before it sleeps, jobs are taken one by one
+        :param done_ttl_seconds: int, how long done job id is remembered for deduplication
+        :param max_attempts: int, how many times job is run before it's moved to dead letter hash
+        :param db_key_prefix: str, prefix of Redis keys
+        """
+        self.db = db
+        self.bot = bot
+        self.job_handlers = job_handlers
+        self.poll_interval_seconds = poll_interval_seconds
+        self.lease_seconds = lease_seconds
+        self.batch_size = batch_size
+        self.done_ttl_seconds = done_ttl_seconds
+        self.max_attempts = max_attempts
+
+        self.scheduled_key = f'{db_key_prefix}:scheduled'
+        self.processing_key = f'{db_key_prefix}:processing'
+        self.jobs_key = f'{db_key_prefix}:jobs'
+        self.done_key_prefix = f'{db_key_prefix}:done'
+        self.attempts_key = f'{db_key_prefix}:attempts'
+        self.dead_jobs_key = f'{db_key_prefix}:dead'
+        self.leases_key = f'{db_key_prefix}:leases'
+
+        self._claim_jobs = db.register_script(CLAIM_JOBS_SCRIPT)
+        self._schedule_job = db.register_script(SCHEDULE_JOB_SCRIPT)
+        self._extend_lease = db.register_script(EXTEND_LEASE_SCRIPT)
+        self._finish_job = db.register_script(FINISH_JOB_SCRIPT)
+        self._stop_workers = asyncio.Event()
+        self._workers: List[asyncio.Task] = []
+
+    async def schedule(self, job_type: str, job_params: Dict[str, Any], delay_seconds: float,
+                 job_id: Optional[str] = None) -> bool:
+        """Schedule job.
+        :param job_type: str, type of job, one of keys of :job_handlers:
+        :param job_params: dict, params of job handler, should be JSON serializable
+        :param delay_seconds: float, job will be run after this time
+        :param job_id: str, dedup key of job, random if not transferred
+        :return: bool, True if job was scheduled, False if the same job was scheduled before
+        """
+        job_id = job_id or uuid.uuid4().hex
+        job = json.dumps({'type': job_type, 'params': job_params})
+        run_at = time.time() + delay_seconds
+
+        is_scheduled = bool(await self._schedule_job(
+            keys=[self.scheduled_key, self.jobs_key, f'{self.done_key_prefix}:{job_id}'],
+            args=[job_id, job, run_at],
+        ))
+        logger.debug(f'job {job_id} was {"scheduled" if is_scheduled else "already scheduled"}')
+
+        return is_scheduled
+
+    def start(self, workers: int = 1) -> None:
+        """Start tasks which run due jobs, it should be called from running event loop."""
+        for worker_number in range(workers):
+            self._workers.append(asyncio.create_task(self._work(), name=f'scheduler-{worker_number}'))
+        logger.debug(f'{workers} scheduler workers were started')
+
+    async def stop(self) -> None:
+        """Stop workers, running jobs are finished before."""
+        self._stop_workers.set()
+        await asyncio.gather(*self._workers)
+        self._workers = []
+
+    async def run_due_jobs(self) -> int:
+        """Take due jobs one by one and run them, so lease of job starts when job starts.
+        :return: int, number of taken jobs
+        """
+        jobs_count = 0
+        while jobs_count < self.batch_size:
+            now = time.time()
+            lease_token = uuid.uuid4().hex
+            job_ids = await self._claim_jobs(
+                keys=[self.scheduled_key, self.processing_key, self.leases_key],
+                args=[now, now + self.lease_seconds, 1, lease_token],
+            )
+            if not job_ids:
+                break
+
+            await self._run_job(job_ids[0].decode('utf-8'), lease_token)
+            jobs_count += 1
+
+        return jobs_count
+
+    async def extend_lease(self, job_id: str, lease_token: str) -> bool:
+        """Extend lease of job for :lease_seconds:.
+        :return: bool, False if lease was taken by other worker
+        """
+        return bool(await self._extend_lease(
+            keys=[self.processing_key, self.leases_key],
+            args=[job_id, lease_token, time.time() + self.lease_seconds],
+        ))
+
+    async def _work(self) -> None:
+        while not self._stop_workers.is_set():
+            try:
+                jobs_count = await self.run_due_jobs()
+            except RedisError:
+                logger.exception('scheduler can not take jobs')
+                jobs_count = 0
+
+            if not jobs_count:
+                await wait_event(self._stop_workers, self.poll_interval_seconds)
+
+    async def _run_job(self, job_id: str, lease_token: str) -> None:
+        job = await self.db.hget(self.jobs_key, job_id)
+        if job is None:
+            logger.warning(f'job {job_id} has no data, skipped')
+            await self._finish(job_id, lease_token)
+            return
+
+        # attempt is counted before run, so job which kills worker is counted too
+        attempt = await self.db.hincrby(self.attempts_key, job_id, 1)
+        if attempt > self.max_attempts:
+            if await self._finish(job_id, lease_token, dead_job=job):
+                logger.error(f'job {job_id} failed {self.max_attempts} times, moved to {self.dead_jobs_key}')
+            return
+
+        job = json.loads(job)
+        try:
+            # lease is extended while handler waits, for example, queue of outgoing messages
+            async with LockKeeper(_JobLease(self, job_id, lease_token)):
+                await self.job_handlers[job['type']](self.bot, **job['params'])
+        except Exception:
+            # job stays in processing and will be run again when lease expires
+            logger.exception(f'job {job_id} failed, attempt {attempt} of {self.max_attempts}')
+            return
+
+        if await self._finish(job_id, lease_token):
+            logger.debug(f'job {job_id} was done')
+        else:
+            logger.warning(f'job {job_id} was done, but its lease was taken by other worker')
+
+    async def _finish(self, job_id: str, lease_token: str, dead_job: bytes = b'') -> bool:
+        """Remove job, mark it as done or move to dead letter hash if :dead_job: is transferred.
+        :return: bool, False if lease was taken by other worker, job is not changed then
+        """
+        return bool(await self._finish_job(
+            keys=[self.processing_key, self.jobs_key, self.attempts_key, self.leases_key,
+                  f'{self.done_key_prefix}:{job_id}', self.dead_jobs_key],
+            args=[job_id, lease_token, dead_job, self.done_ttl_seconds],
+        ))
+
+
+class _JobLease:
+    """Lease of job which looks like redis lock for LockKeeper."""
+
+    def __init__(self, scheduler: DelayedJobScheduler, job_id: str, lease_token: str):
+        self.scheduler = scheduler
+        self.job_id = job_id
+        self.lease_token = lease_token
+        self.name = f'lease of job {job_id}'
+        self.timeout = scheduler.lease_seconds
+
+    async def reacquire(self) -> None:
+        if not await self.scheduler.extend_lease(self.job_id, self.lease_token):
+            raise LockError(f'{self.name} was taken by other worker')
@@ -0,0 +1,49 @@
+from typing import Dict, Any, Tuple, Optional
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+# fields of context.user_data which are kept in redis between updates
+SESSION_FIELDS = (
+    'cart_msg',
+    'cart_version',
+    'cart_total_price_amount',
+    'email',
+    'customer_id',
+    'nearest_pizzeria',
+)
+
+
+def get_session_key(chat_id: int) -> str:
+    return f'session:{chat_id}'
+
+
+async def load_session(db, chat_id: int) -> Tuple[Optional[str], Dict[str, Any]]:
+    """Load state and session fields of chat by one query.
+    :return: tuple, state of user (None if chat has no session) and dict with session fields
+    """
+    raw_session = await db.hgetall(get_session_key(chat_id))
+
+    user_state = raw_session.pop(b'state', None)
+    if user_state is not None:
+        user_state = user_state.decode('utf-8')
+
+    session = {field.decode('utf-8'): json.loads(value) for field, value in raw_session.items()}
+    logger.debug(f'session of {chat_id} was loaded, fields: {list(session)}')
+
+    return user_state, session
+
+
+async def save_session(db, chat_id: int, user_state: str, session: Dict[str, Any], ttl_seconds: int) -> None:
+    """Replace state and session fields of chat by one transaction, session expires after :ttl_seconds: of idle."""
+    session_key = get_session_key(chat_id)
+    mapping = {field: json.dumps(value) for field, value in session.items()}
+    mapping['state'] = user_state
+
+    pipe = db.pipeline(transaction=True)
+    pipe.delete(session_key)
+    pipe.hset(session_key, mapping=mapping)
+    pipe.expire(session_key, ttl_seconds)
+    await pipe.execute()
+    logger.debug(f'session of {chat_id} was saved')
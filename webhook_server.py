@@ -0,0 +1,170 @@
+import asyncio
+import hmac
+import json
+import logging
+import signal
+import threading
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+from telegram.ext import Application
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+# batch of updates from balancer is far less, bigger body is not read to memory
+MAX_BODY_BYTES = 10 * 1024 * 1024
+
+
+class WebhookServer:
+    """
+    This class keep local HTTP listener which receives telegram updates and puts them to application queue.
+    Listener only checks secret token and parses updates in its threads,
+    handlers run in event loop of application as in polling mode.
+    Request body can be one update or list of updates, if updates come from balancer in batches.
+    """
+
+    def __init__(self, application: Application, listen: str, port: int, url_path: str, secret_token: str):
+        """Init server
+        :param application: object, telegram Application instance with handlers
+        :param listen: str, IP address to listen
+        :param port: int, port to listen
+        :param url_path: str, path of webhook, for example '/telegram'
+        :param secret_token: str, telegram sends it in every request, requests without it are rejected
+        """
+        if not secret_token:
+            raise ValueError('Secret token is required for webhook')
+
+        self.application = application
+        self.url_path = '/' + url_path.strip('/')
+        self.secret_token = secret_token
+
+        self.httpd = ThreadingHTTPServer((listen, port), self._make_request_handler())
+        self.httpd.daemon_threads = True
+
+        self._loop = None
+        self._httpd_thread = None
+
+    async def start(self, webhook_url: str = None, max_connections: int = 40) -> None:
+        """Start listener, application should be started before.
+        :param webhook_url: str, public url of webhook, if transferred telegram will be told to send updates to it
+        :param max_connections: int, maximum number of simultaneous telegram connections to webhook
+        """
+        self._loop = asyncio.get_running_loop()
+
+        if webhook_url:
+            await self.application.bot.set_webhook(url=webhook_url, max_connections=max_connections,
+                                                   secret_token=self.secret_token)
+            logger.debug(f'Webhook was set to {webhook_url}')
+
+        self._httpd_thread = threading.Thread(target=self.httpd.serve_forever, name='webhook', daemon=True)
+        self._httpd_thread.start()
+        logger.debug(f'Webhook server listens {self.httpd.server_address}{self.url_path}')
+
+    async def stop(self) -> None:
+        """Stop listener, requests which are read already put their updates before."""
+        if self._httpd_thread is not None:
+            # shutdown waits loop of listener, so it's not run in event loop
+            await asyncio.to_thread(self.httpd.shutdown)
+            self._httpd_thread = None
+        self.httpd.server_close()
+        logger.debug('Webhook server was stopped')
+
+    async def run(self, webhook_url: str = None, max_connections: int = 40) -> None:
+        """Run application and listener until SIGINT or SIGTERM, the same way as Application.run_polling."""
+        application = self.application
+        stop_signal = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(signum, stop_signal.set)
+
+        await application.initialize()
+        try:
+            if application.post_init:
+                await application.post_init(application)
+            await application.start()
+            await self.start(webhook_url, max_connections)
+
+            await stop_signal.wait()
+            logger.debug('Received stop signal, stopping webhook server')
+        finally:
+            await self.stop()
+            if application.running:
+                await application.stop()
+            if application.post_stop:
+                await application.post_stop(application)
+            await application.shutdown()
+            if application.post_shutdown:
+                await application.post_shutdown(application)
+
+    def put_updates(self, body: bytes) -> int:
+        """Parse updates from request body and put them to application queue, it's called from listener threads.
+        All updates are parsed before any of them is queued, so retry of invalid batch doesn't queue updates twice.
+        :param body: bytes, request body with one update or list of updates
+        :return: int, number of updates
+        :raise ValueError: body is not update or list of updates
+        """
+        updates_data = json.loads(body)
+        if isinstance(updates_data, dict):
+            updates_data = [updates_data]
+        if not isinstance(updates_data, list) or not all(isinstance(data, dict) for data in updates_data):
+            raise ValueError('Body should be update or list of updates')
+
+        bot = self.application.bot
+        try:
+            updates = [Update.de_json(update_data, bot) for update_data in updates_data]
+        except (AttributeError, TypeError, KeyError) as e:
+            raise ValueError(f'Invalid update: {e}') from e
+
+        for update in updates:
+            self._loop.call_soon_threadsafe(self.application.update_queue.put_nowait, update)
+
+        return len(updates)
+
+    def _make_request_handler(self):
+        server = self
+
+        class WebhookRequestHandler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                if self.path != server.url_path:
+                    self.send_error(HTTPStatus.NOT_FOUND)
+                    return
+
+                secret_token = self.headers.get(SECRET_TOKEN_HEADER, '')
+                if not hmac.compare_digest(secret_token, server.secret_token):
+                    logger.warning(f'Webhook request with wrong secret token from {self.client_address}')
+                    self.send_error(HTTPStatus.FORBIDDEN)
+                    return
+
+                try:
+                    content_length = int(self.headers.get('Content-Length', 0))
+                except ValueError:
+                    content_length = -1
+                if content_length < 0:
+                    logger.warning(f'Webhook request with invalid Content-Length from {self.client_address}')
+                    self.send_error(HTTPStatus.BAD_REQUEST)
+                    return
+                if content_length > MAX_BODY_BYTES:
+                    logger.warning(f'Webhook request with {content_length} bytes body from {self.client_address}')
+                    self.send_error(HTTPStatus.REQUEST_ENTITY_TOO_LARGE)
+                    return
+
+                body = self.rfile.read(content_length)
+                try:
+                    updates_count = server.put_updates(body)
+                except ValueError:
+                    # JSONDecodeError is ValueError too
+                    logger.warning('Webhook request with invalid updates')
+                    self.send_error(HTTPStatus.BAD_REQUEST)
+                    return
+
+                logger.debug(f'{updates_count} updates were received by webhook')
+                self.send_response(HTTPStatus.OK)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+
+            def log_message(self, format, *args):
+                logger.debug(f'{self.client_address[0]} {format % args}')
+
+        return WebhookRequestHandler